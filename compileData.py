@@ -0,0 +1,36 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import argparse
+from util.Data import *
+
+####################################################################################################
+####
+#### Compiles the airport, airspace, state and census block group datasets into a bundle that
+#### runState.py can load in seconds (python runState.py NC 0.1 500 --bundle data/bundle).
+#### Only needs to be rerun when one of the datasets changes.
+####
+####################################################################################################
+
+parser = argparse.ArgumentParser(description='Compile the datasets used for airspace risk classification')
+parser.add_argument('bundle_dir', type=str, nargs='?', default='data/bundle',
+                    help='directory to write the compiled bundle to')
+parser.add_argument('--bg', type=str, default='data/blockgroup/processed/BG.parquet',
+                    help='processed census block group layer (python/buildBG.py) or shapefile')
+
+args = parser.parse_args()
+
+# specify your path to the em-core repository
+try:
+    path_to_emcore = os.environ['AEM_DIR_CORE']
+except:
+    print("PATH TO EMCORE NOT FOUND")
+    path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
+
+print('loading data...')
+data = readData(path_to_emcore, bg_path=args.bg)
+
+print('compiling bundle...')
+compileData(data, args.bundle_dir)
+
+print('Finished! Bundle written to {}'.format(args.bundle_dir))
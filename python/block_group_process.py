@@ -3,92 +3,352 @@
 # This product uses the Census Bureau Data API but is not endorsed or certified by the Census Bureau.
 
 ## Import python modules
+import os
+import glob
+import json
+import time
+import asyncio
+import argparse
+import aiohttp
 import geopandas
 import numpy as np
-import requests
-import urllib
-from us import states
-import time
-from p_tqdm import p_map
+import pandas as pd
+
+########################################################################################################
+####
+#### Generates the population density of every census block group. The population of all of the
+#### block groups of a county comes from one wildcard query of the Census API, and every response is
+#### cached on disk, so an interrupted build picks up where it left off when it is started again.
+####
+########################################################################################################
 
-#loading census api key
-census_api = str(np.loadtxt('../API.txt',dtype=str))
+# total population table of the ACS 5-year estimates
+CENSUS_URL = 'https://api.census.gov/data/{year}/acs/acs5'
+POPULATION = 'B01003_001E'
 
-# creating session object to query API
-s = requests.Session()
+# square meters to square miles
+SQ_MILES = 0.00000038610215855
 
-print('loading data...')
+## key columns of a block group, in the TIGER files and in density_values.csv
+BG_COLUMNS = ['STATEFP','COUNTYFP','TRACTCE','BLKGRPCE']
 
-# reading in the single block group shape file
-bg_df = geopandas.read_file('../data/blockgroup/BG.dbf')
 
-print('data loaded!')
+class FatalResponse(Exception):
+    """
+    Answer of the Census API that will not change when the request is retried, i.e. a 4xx other than 429
+    (bad or missing key, bad query), a 204 without content, or a body that is not JSON.
 
 
-def getDensity(bg,tract,county,state,aland,awater):
-    '''
-    Given a (lon,lat) shapely point, determines what census BG this point belongs to and the corresponding population density.
+    """
+
+
+class ResponseCache:
+    """
+    On-disk cache of Census API responses, one JSON file per year and county
+    (cache_dir/year/state_county.json). Files are written atomically, so a file that
+    exists holds a complete response.
 
 
     Parameters:
     -----------
-    point {shapely obj}: (lon,lat) shapely point
-    config {class}: class object containing config hyperparameters.
+    cache_dir {string}: directory of the cache.
+    year {int}: year of the ACS 5-year estimates.
 
 
-    Returns:
-    --------
-    density {float}: population density for a census block group.
+    """
+
+    def __init__(self, cache_dir, year):
+        self.path = os.path.join(cache_dir,str(year))
+        os.makedirs(self.path,exist_ok=True)
+
+
+    def _file(self, state, county):
+        return os.path.join(self.path,'{}_{}.json'.format(state,county))
+
+
+    def __contains__(self, geography):
+        return os.path.exists(self._file(*geography))
 
 
-    '''
+    def get(self, state, county):
+        with open(self._file(state,county)) as f:
+            return json.load(f)
 
-    # area of land/ area of water in census block group
-    aland = float(aland)
-    awater = float(awater)
+
+    def put(self, state, county, response):
+        tmp = self._file(state,county) + '.tmp'
+        with open(tmp,'w') as f:
+            json.dump(response,f)
+        os.replace(tmp,self._file(state,county))
+
+
+
+class CensusClient:
+    """
+    Concurrent, rate-limited client of the Census API. Every request asks for the population of all
+    block groups of one county. Timeouts, 429 and 5xx answers are retried with capped exponential backoff,
+    other answers that are not a population table (FatalResponse) fail the county right away. Each answer
+    is written to the cache as soon as it arrives.
+
+
+    Parameters:
+    -----------
+    cache {ResponseCache}: cache the responses are written to.
+    year {int}: year of the ACS 5-year estimates.
+    key {string}: (optional) Census API key.
+    url {string}: query url, formatted with the year. Can be pointed to a local server for testing.
+    concurrency {int}: maximum number of requests in flight (and pooled connections).
+    rate {float}: maximum number of requests started per second.
+    timeout {float}: timeout in seconds for each request.
+    max_retries {int}: number of retries after the first failed request of a county.
+    backoff {float}: wait in seconds after the first failed request. Doubled after every failure.
+    max_backoff {float}: cap in seconds on the wait between retries.
+
+
+    Attributes:
+    -----------
+    errors {dict}: last error of every (state, county) that failed, as a string.
 
 
-    # base URL to query census API
-    base_url = 'https://api.census.gov/data/2018/acs/acs5?get=B01003_001E&for=block%20group:{}&in=state:{}%20county:{}%20tract:{}'.format(bg,state,county,tract)
-    response = None
+    """
 
-    # this loop will try to connect to the census API and grab data up to 250 times before breaking out
+    def __init__(self, cache, year, key=None, url=CENSUS_URL, concurrency=8, rate=20, timeout=60,
+                 max_retries=6, backoff=1, max_backoff=60):
 
-    count = 0
-    while True:
+        self.cache = cache
+        self.year = year
+        self.key = key
+        self.url = url.format(year=year)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.errors = {}
+
+
+    def fetch(self, counties):
+        """
+        Fetches and caches the responses of every (state, county) not in the cache yet.
+
+
+        Parameters:
+        -----------
+        counties {list}: (state, county) FIPS code pairs.
+
+
+        Returns:
+        --------
+        failed {list}: (state, county) pairs without a response after all retries. Their last error is in errors.
+
+
+        """
+
+        todo = [c for c in counties if c not in self.cache]
+        if len(todo) == 0:
+            return []
+
+        loop = asyncio.new_event_loop()
         try:
-            data_url = f'{base_url}&key={census_api}'
-            response=s.get(data_url).json()
-        except:
-            time.sleep(0.01)
-            count += 1
-            if count == 250:
-                response = None
-                break
+            return loop.run_until_complete(self._fetchAll(todo))
+        finally:
+            loop.close()
+
+
+    async def _fetchAll(self, counties):
+
+        loop = asyncio.get_event_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._next_slot = loop.time()
+        self._done = 0
+        self._start = time.time()
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            ok = await asyncio.gather(*[self._fetch(session,state,county,len(counties)) for state,county in counties])
+
+        return [c for c,success in zip(counties,ok) if not success]
+
+
+    async def _waitForSlot(self):
+        # spacing out request starts to respect the request rate
+        loop = asyncio.get_event_loop()
+        slot = max(loop.time(),self._next_slot)
+        self._next_slot = slot + 1.0/self.rate
+        await asyncio.sleep(slot - loop.time())
+
+
+    async def _fetch(self, session, state, county, total):
+
+        params = {'get': POPULATION,
+                  'for': 'block group:*',
+                  'in': 'state:{} county:{} tract:*'.format(state,county)}
+        if self.key:
+            params['key'] = self.key
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self._waitForSlot()
+                try:
+                    async with session.get(self.url,params=params,timeout=timeout) as response:
+                        body = await response.text()
+                        if response.status == 204 or (400 <= response.status < 500 and response.status != 429):
+                            raise FatalResponse('HTTP {}: {}'.format(response.status,body.strip()[:200]))
+                        response.raise_for_status()
+
+                    try:
+                        payload = json.loads(body)
+                    except ValueError:
+                        raise FatalResponse('HTTP {}, not JSON: {}'.format(response.status,body.strip()[:200]))
+
+                    # header row plus one row per block group
+                    if not isinstance(payload,list) or len(payload) == 0 or POPULATION not in payload[0]:
+                        raise FatalResponse('unexpected response: {}'.format(body.strip()[:200]))
+
+                    self.cache.put(state,county,payload)
+                    self.errors.pop((state,county),None)
+                    self._done += 1
+                    if self._done % 100 == 0 or self._done == total:
+                        print('> {}/{} counties | Total Time: {}s'.format(self._done,total,int(time.time() - self._start)))
+                    return True
+                except FatalResponse as e:
+                    self.errors[(state,county)] = str(e)
+                    return False
+                except Exception as e:
+                    # timeouts, dropped connections, 429 and 5xx answers are retried
+                    self.errors[(state,county)] = '{}: {}'.format(type(e).__name__,e)
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(min(self.max_backoff,self.backoff*2**attempt))
+
+        return False
+
+
+
+def cachedPopulation(cache, counties):
+    """
+    Returns the population of every block group of a set of counties from the cached responses.
+
+
+    Parameters:
+    -----------
+    cache {ResponseCache}: cache of the responses.
+    counties {list}: (state, county) FIPS code pairs. Counties without a cached response are skipped.
+
+
+    Returns:
+    --------
+    population {dataframe}: one row per block group, with the BG_COLUMNS and 'population'. Block groups the API
+                            gives an annotation code instead of an estimate have no population.
+
+
+    """
+
+    frames = []
+    for state,county in counties:
+        if (state,county) not in cache:
             continue
 
+        response = cache.get(state,county)
+        header = response[0]
+        df = pd.DataFrame(response[1:],columns=header,dtype=object)
+
+        # negative values are the annotation codes of the API (i.e. -666666666), not populations
+        population = pd.to_numeric(df[POPULATION],errors='coerce')
+        population = population.where(population >= 0)
+
+        frames.append(pd.DataFrame({'STATEFP': df['state'],'COUNTYFP': df['county'],'TRACTCE': df['tract'],
+                                    'BLKGRPCE': df['block group'],'population': population}))
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=BG_COLUMNS + ['population'])
+
+    return pd.concat(frames,ignore_index=True)
 
-        break
 
-    if response == None:
-        return np.nan
 
-    total_pop = int(response[1][0])
+def blockGroupDensity(bg_df, population):
+    """
+    Returns the population density of every block group.
+
+
+    Parameters:
+    -----------
+    bg_df {dataframe}: block groups with the BG_COLUMNS and their land and water areas (ALAND, AWATER) in square meters.
+    population {dataframe}: population of the block groups, from cachedPopulation.
+
+
+    Returns:
+    --------
+    density {dataframe}: one row per block group of bg_df, with the BG_COLUMNS and 'density' in people per square mile.
+                         Block groups without a population have no density.
+
+
+    """
+
+    bg_df = bg_df.merge(population,on=BG_COLUMNS,how='left')
 
     # area is in square meters. Need to convert to square miles
-    area = (aland + awater)*0.00000038610215855
+    area = (bg_df['ALAND'].astype(float) + bg_df['AWATER'].astype(float))*SQ_MILES
+    bg_df['density'] = bg_df['population']/area
+
+    return bg_df.loc[:,BG_COLUMNS + ['density']]
+
+
+
+parser = argparse.ArgumentParser(description='Generate the population density of the census block groups from the Census API')
+parser.add_argument('--year', type=int, default=2018,
+                    help='year of the ACS 5-year estimates')
+parser.add_argument('--raw', type=str, default='../data/blockgroup/raw/tl_*_*_bg.dbf',
+                    help='glob of the per-state TIGER block group files')
+parser.add_argument('--cache_dir', type=str, default='../data/blockgroup/cache',
+                    help='directory the API responses are cached in, by year and county')
+parser.add_argument('--key_file', type=str, default='../API.txt',
+                    help='file with the Census API key')
+parser.add_argument('--url', type=str, default=CENSUS_URL,
+                    help='Census API url, {year} is replaced by the year. Can be pointed to a local server that replays recorded responses')
+parser.add_argument('--concurrency', type=int, default=8,
+                    help='maximum number of requests in flight')
+parser.add_argument('--rate', type=float, default=20,
+                    help='maximum number of requests started per second')
+parser.add_argument('--out', type=str, default='../data/blockgroup/processed/density_values.csv',
+                    help='csv file the density of every block group is written to')
+
+
+# the classes and functions above are imported by the tests
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    #loading census api key
+    census_api = str(np.loadtxt(args.key_file,dtype=str)) if os.path.exists(args.key_file) else None
+
+    print('loading data...')
+
+    # reading the key and area columns of the per-state block group files
+    columns = BG_COLUMNS + ['ALAND','AWATER']
+    bg_df = pd.concat([pd.DataFrame(geopandas.read_file(f).loc[:,columns]) for f in sorted(glob.glob(args.raw))],ignore_index=True)
+
+    print('data loaded!')
+
+    # one query per county, the cached ones are not queried again
+    counties = sorted(set(zip(bg_df['STATEFP'],bg_df['COUNTYFP'])))
+    cache = ResponseCache(args.cache_dir,args.year)
 
-    density = total_pop/area
+    print('> {} block groups in {} counties | {} counties cached'.format(len(bg_df),len(counties),sum(c in cache for c in counties)))
 
-    return density
+    client = CensusClient(cache,args.year,key=census_api,url=args.url,concurrency=args.concurrency,rate=args.rate)
+    failed = client.fetch(counties)
 
-bg_df['density'] = p_map(getDensity, bg_df['BLKGRPCE'],bg_df['TRACTCE'],bg_df['COUNTYFP'],bg_df['STATEFP'],bg_df['ALAND'],bg_df['AWATER'])
+    if len(failed) > 0:
+        print('> {} counties failed, run again to retry them:'.format(len(failed)))
+        for state,county in failed:
+            print('>   state {} county {}: {}'.format(state,county,client.errors.get((state,county))))
 
-# saving off snapshot so that the density values can be reused next time without API
-sub_df = bg_df.loc[:,['STATEFP','COUNTYFP','TRACTCE',"BLKGRPCE","density"]]
-sub_df.to_csv('../data/blockgroup/processed/density_values.csv',index=False)
+    sub_df = blockGroupDensity(bg_df,cachedPopulation(cache,counties))
 
-print('Finished Processing')
+    # saving off snapshot so that the density values can be reused next time without API
+    sub_df.to_csv(args.out,index=False)
 
-# saving processed dataframe
-bg_df.to_file("../data/blockgroup/processed/bg.shp")
+    print('Finished Processing')
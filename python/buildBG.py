@@ -0,0 +1,159 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import glob
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from p_tqdm import p_map
+
+########################################################################################################
+####
+#### Builds the national census block group layer in one pass: the per-state TIGER files are read in
+#### parallel and concatenated once, the population density is attached through the integer GEOID, the
+#### geometries are optionally simplified, and the layer is written as GeoParquet sorted along a Hilbert
+#### curve, with the bounds of every block group stored so that bbox reads only touch a few row groups.
+####
+########################################################################################################
+
+## key columns of a block group, in the TIGER files and in density_values.csv
+BG_COLUMNS = ['STATEFP','COUNTYFP','TRACTCE','BLKGRPCE']
+
+
+def readState(path, tolerance=None):
+    """
+    Reads the block groups of one TIGER file, keeping only their integer GEOID and geometry. The block groups
+    of a state tessellate it, so they are simplified together as a coverage: an edge shared by two block groups
+    is simplified once, and no slivers or overlaps open between them. The boundary of the state is kept as is,
+    so it still matches the neighbouring states.
+
+
+    Parameters:
+    -----------
+    path {string}: path to a tl_<year>_<state>_bg file.
+    tolerance {float}: (optional) simplification tolerance in degrees. Needs shapely >= 2.1.
+
+
+    Returns:
+    --------
+    df {geo dataframe}: block groups with the columns GEOID and geometry.
+
+
+    """
+
+    df = gpd.read_file(path)
+
+    if 'GEOID' in df.columns:
+        geoid = df['GEOID']
+    else:
+        geoid = df[BG_COLUMNS].astype(str).sum(axis=1)
+
+    geometry = df.geometry.values
+    if tolerance is not None:
+        geometry = shapely.coverage_simplify(np.asarray(geometry),tolerance,simplify_boundary=False)
+
+    return gpd.GeoDataFrame({'GEOID': geoid.astype(np.int64).values},geometry=geometry,crs=df.crs)
+
+
+
+def hilbertIndex(x, y, bounds, bits=16):
+    """
+    Returns the position of every point along a Hilbert curve over bounds, on a 2**bits x 2**bits grid.
+
+
+    Parameters:
+    -----------
+    x {array}: x coordinates of the points.
+    y {array}: y coordinates of the points.
+    bounds {tuple}: (minx,miny,maxx,maxy) extent of the curve.
+    bits {int}: order of the curve.
+
+
+    Returns:
+    --------
+    d {array}: int64 Hilbert distance of every point.
+
+
+    """
+
+    n = 2**bits
+    minx,miny,maxx,maxy = bounds
+    xi = np.clip(((x - minx)/max(maxx - minx,1e-12)*(n - 1)).astype(np.int64),0,n - 1)
+    yi = np.clip(((y - miny)/max(maxy - miny,1e-12)*(n - 1)).astype(np.int64),0,n - 1)
+
+    d = np.zeros(len(xi),dtype=np.int64)
+    s = n//2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s*s*((3*rx) ^ ry)
+
+        ## rotating the quadrant
+        flip = ~ry & rx
+        xi = np.where(flip,n - 1 - xi,xi)
+        yi = np.where(flip,n - 1 - yi,yi)
+        swap = ~ry
+        xi,yi = np.where(swap,yi,xi),np.where(swap,xi,yi)
+        s //= 2
+
+    return d
+
+
+
+parser = argparse.ArgumentParser(description='Build the national census block group layer with population density')
+parser.add_argument('--raw', type=str, default='../data/blockgroup/raw/tl_*_*_bg.dbf',
+                    help='glob of the per-state TIGER block group files')
+parser.add_argument('--density', type=str, default='../data/blockgroup/processed/density_values.csv',
+                    help='population density of every block group (block_group_process.py)')
+parser.add_argument('--out', type=str, default='../data/blockgroup/processed/BG.parquet',
+                    help='GeoParquet file to write')
+parser.add_argument('--workers', type=int, default=None,
+                    help='(optional) number of processes reading the state files. Default is one per cpu')
+parser.add_argument('--simplify', type=float, default=None,
+                    help='(optional) simplify the geometries with this tolerance in degrees (1e-4 is ~11 m). The block groups of each state are simplified together, so neighbouring block groups keep sharing their edges. Needs shapely >= 2.1')
+parser.add_argument('--row_group_size', type=int, default=2048,
+                    help='number of block groups per row group, the unit of bbox reads')
+
+
+args = parser.parse_args()
+
+if args.simplify is not None and not hasattr(shapely,'coverage_simplify'):
+    parser.error('--simplify needs shapely >= 2.1 (coverage_simplify), found {}'.format(shapely.__version__))
+
+start = time.time()
+
+files = sorted(glob.glob(args.raw))
+print('reading {} state files...'.format(len(files)))
+
+# reading the state files in parallel and concatenating them once
+kwargs = {} if args.workers is None else {'num_cpus': args.workers}
+frames = p_map(readState,files,[args.simplify]*len(files),**kwargs)
+bg_df = gpd.GeoDataFrame(pd.concat(frames,ignore_index=True),crs=frames[0].crs if len(frames) > 0 else None)
+
+print('> {} block groups | Time: {}s'.format(len(bg_df),int(time.time()-start)))
+
+# attaching the density through the integer GEOID
+density = pd.read_csv(args.density,dtype=str)
+geoid = density[BG_COLUMNS].sum(axis=1).astype(np.int64)
+density = pd.Series(density['density'].astype(float).values,index=geoid.values)
+
+bg_df['density'] = bg_df['GEOID'].map(density).values
+print('> {} block groups without density'.format(int(bg_df['density'].isnull().sum())))
+
+# sorting along a Hilbert curve of the block group centers, so that nearby block groups share row groups
+bounds = bg_df.geometry.bounds
+cx = ((bounds.minx + bounds.maxx)/2).values
+cy = ((bounds.miny + bounds.maxy)/2).values
+order = np.argsort(hilbertIndex(cx,cy,(cx.min(),cy.min(),cx.max(),cy.max())),kind='stable')
+
+bg_df = bg_df.iloc[order].reset_index(drop=True)
+bounds = bounds.iloc[order].reset_index(drop=True)
+
+# only the geometry and density are kept, plus the bounds used to skip row groups in bbox reads
+bg_df = gpd.GeoDataFrame({'density': bg_df['density'].values,'xmin': bounds.minx.values,'ymin': bounds.miny.values,
+                          'xmax': bounds.maxx.values,'ymax': bounds.maxy.values},geometry=bg_df.geometry.values,crs=bg_df.crs)
+bg_df.to_parquet(args.out,index=False,row_group_size=args.row_group_size)
+
+print('Finished! {} block groups written to {} | Total Time: {}s'.format(len(bg_df),args.out,int(time.time()-start)))
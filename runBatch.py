@@ -0,0 +1,174 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import time
+import argparse
+import pathlib
+import traceback
+import multiprocessing
+from util.Batch import *
+from util.Data import *
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+parser = argparse.ArgumentParser(description='Classify airspace risk for a set of states, tile by tile')
+parser.add_argument('states', type=str, nargs='+',
+                    help='states for processing, i.e. NC VA. Use ALL for every state in the states dataset (CONUS, AK and HI)')
+parser.add_argument('--spacing', type=float, default=0.1,
+                    help='longitude/latitude degree spacing')
+parser.add_argument('--alt_ft_agl', type=float, default=500,
+                    help='altitude to run airspace risk classification')
+parser.add_argument('--tile_deg', type=float, default=1.0,
+                    help='size of the lon/lat tiles in degrees. Each tile is classified and saved on its own')
+parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='number of worker processes')
+parser.add_argument('--tile_dir', type=str, default='output/tiles',
+                    help='directory of the tile checkpoints. Tiles found here are not run again')
+parser.add_argument('--format', type=str, default='parquet', choices=['parquet','tif','shp'],
+                    help='output format of the merged states: GeoParquet, GeoTIFF or shapefiles')
+parser.add_argument('--dem', type=str, default=None,
+                    help='(optional) directory of GridFloat DEM tiles used for elevation. USGS API is used for points off the tiles')
+parser.add_argument('--elevation_cache', type=str, default='output/elevation.sqlite',
+                    help='(optional) SQLite file used to keep elevations between runs')
+parser.add_argument('--bundle', type=str, default=None,
+                    help='(optional) data bundle written by compileData.py. If not specified the datasets are read from em-core')
+parser.add_argument('--stage_log', type=str, default=None,
+                    help='(optional) JSON lines file the record of every classification step is appended to: wall and CPU time, points in and out, peak memory, elevation and polygon join counters')
+parser.add_argument('--profile', type=str, default=None,
+                    help='(optional) directory to write a profile of every classification to')
+parser.add_argument('--profiler', type=str, default='cProfile', choices=['cProfile','pyinstrument'],
+                    help='profiler used with --profile')
+
+
+args = parser.parse_args()
+
+SPACING_deg = float(args.spacing)
+ALTITUDE = args.alt_ft_agl
+TILE_DIR = os.path.join(args.tile_dir,'alt_{}'.format(ALTITUDE),'spacing_{}'.format(SPACING_deg),'tile_{}'.format(args.tile_deg))
+
+# using local DEM tiles for elevation if provided, falling back to the USGS API
+if args.dem is not None:
+    provider = DEMElevation(args.dem, fallback=AsyncEPQSElevation())
+else:
+    provider = AsyncEPQSElevation()
+
+# the SQLite cache is shared by all of the workers, each one opens its own connection
+elevation_cache = CachedElevation(provider, db_path=args.elevation_cache)
+setElevationProvider(elevation_cache)
+
+# the workers do not print the classification steps (util/Instrument.py), their records are written with --stage_log
+sinks = [PrintSink()]
+if args.stage_log is not None:
+    sinks.append(JSONLinesSink(args.stage_log))
+if args.profile is not None:
+    sinks.append(ProfileSink(args.profile, profiler=args.profiler))
+setStageSinks(*sinks)
+
+
+if args.bundle is not None:
+    # loading the compiled datasets
+    data = loadData(args.bundle)
+else:
+    # specify your path to the em-core repository
+    try:
+        path_to_emcore = os.environ['AEM_DIR_CORE']
+    except:
+        print("PATH TO EMCORE NOT FOUND")
+        path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
+
+    # reading in airport, airspace, state and preprocessed census block group data
+    data = readData(path_to_emcore)
+
+states_df = data.states_df
+
+if [s.upper() for s in args.states] == ['ALL']:
+    STATES = sorted(states_df.iso_3166_2.dropna().unique())
+else:
+    STATES = [s.upper() for s in args.states]
+
+# state polygons, shared with the workers through fork
+polygons = {}
+for STATE in STATES:
+    state = states_df.loc[states_df.iso_3166_2 == STATE]
+    if len(state) == 0:
+        raise ValueError('state {} not found in the states dataset'.format(STATE))
+    polygons[STATE] = state.geometry.unary_union
+
+
+def runTile(tile):
+    """
+    Classifies and saves one tile. Runs in a worker process.
+
+
+    Parameters:
+    -----------
+    tile {Tile}: tile to classify.
+
+
+    Returns:
+    --------
+    tile {Tile}: the input tile.
+    n {int}: number of classified points, or None if the tile failed.
+    error {string}: traceback of the failure, None otherwise.
+
+
+    """
+
+    try:
+        # the per step output of the classification is not useful when tiles run side by side
+        with quietOutput():
+            result = classifyTile(tile, SPACING_deg, polygons[tile.state], data, alt_ft_agl=ALTITUDE)
+        writeTile(TILE_DIR, tile, result)
+        return tile,len(result),None
+    except Exception:
+        return tile,None,traceback.format_exc()
+
+
+### Splitting the states into tiles, skipping tiles that already have a checkpoint
+tiles = [tile for STATE in STATES for tile in stateTiles(STATE, polygons[STATE], args.tile_deg)]
+todo = [tile for tile in tiles if not os.path.exists(tilePath(TILE_DIR, tile))]
+
+print("Batch Classification")
+print("------------------------------------------------------------------------------")
+print("> {} states | {} tiles | {} already done | {} to run on {} workers".format(
+    len(STATES), len(tiles), len(tiles) - len(todo), len(todo), args.workers))
+print(" ")
+
+start = time.time()
+failed = set()
+
+if len(todo) > 0:
+    # fork, so that the datasets loaded above are shared with the workers instead of pickled
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for k,(tile,n,error) in enumerate(pool.imap_unordered(runTile, todo, chunksize=1)):
+            if error is None:
+                print("> [{}/{}] tile {}: {} points | Total Time: {}s".format(k + 1, len(todo), tile.id, n, int(time.time()-start)))
+            else:
+                failed.add(tile.state)
+                print("> [{}/{}] tile {} FAILED".format(k + 1, len(todo), tile.id))
+                print(error)
+
+print("------------------------------------------------------------------------------")
+print(" ")
+
+
+### Merging the tiles of every complete state into the per state outputs
+for STATE in STATES:
+    if STATE in failed:
+        print("> {}: some tiles failed, rerun to retry them before merging".format(STATE))
+        continue
+
+    out_dir = 'output/states/{}/alt_{}/spacing_{}'.format(STATE, ALTITUDE, SPACING_deg)
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    writer = resultWriter(args.format, out_dir, grid=stateGrid(SPACING_deg, polygons[STATE]))
+    n = mergeTiles(TILE_DIR, STATE, writer)
+    if n == 0:
+        print("> {}: no points at spacing {}".format(STATE, SPACING_deg))
+        continue
+
+    print("> {}: {} points saved to {}".format(STATE, n, out_dir))
+
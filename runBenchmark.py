@@ -0,0 +1,378 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import json
+import time
+import queue
+import platform
+import argparse
+import resource
+import subprocess
+import traceback
+import multiprocessing
+from util.Synthetic import *
+from util.Service import *
+from util.Route import *
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+## benchmarked functions. Functions that take one point at a time, and classifyRoutes (one route of
+## ROUTE_LEGS legs per point), are run on at most --max_scalar points, and generate_grid_in_polygon is
+## only run on one worker.
+STAGES = ['RiskClassification','Low_Risk_Airspace','Medium_Risk_Airspace','classifyRoutes','ckdnearest','calc_distance',
+          'geodesic_distance','generate_grid_in_polygon']
+SCALAR = ['calc_distance','classifyRoutes']
+
+## routes of classifyRoutes: ROUTE_LEGS legs of ROUTE_LEG_NM from every point
+ROUTE_LEGS = 4
+ROUTE_LEG_NM = 5.0
+SERIAL = ['generate_grid_in_polygon']
+
+parser = argparse.ArgumentParser(description='Benchmark the classification pipeline on synthetic data, without em-core or network access')
+parser.add_argument('--points', type=int, nargs='+', default=[10**3,10**4,10**5,10**6,10**7],
+                    help='numbers of points to run every stage on')
+parser.add_argument('--workers', type=int, nargs='+', default=sorted({1,os.cpu_count()}),
+                    help='numbers of worker processes the points are split across')
+parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES,
+                    help='functions to benchmark')
+parser.add_argument('--alt_ft_agl', type=float, default=500,
+                    help='altitude of the points')
+parser.add_argument('--repeat', type=int, default=1,
+                    help='number of timed runs of every case, the fastest one is reported')
+parser.add_argument('--bounds', type=float, nargs=4, default=[-80.0,35.0,-77.0,37.0],
+                    help='minx miny maxx maxy of the synthetic state')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the synthetic data and points')
+parser.add_argument('--elevation', type=str, default='stub', choices=['stub','local'],
+                    help='stub: AsyncEPQSElevation against a local Elevation Point Query Service stub. local: the same terrain, answered in process')
+parser.add_argument('--concurrency', type=int, default=64,
+                    help='requests in flight to the elevation stub')
+parser.add_argument('--max_scalar', type=int, default=10**5,
+                    help='largest number of points for the functions that take one point at a time')
+parser.add_argument('--out', type=str, default=None,
+                    help='(optional) JSON file to write the results to. Default is output/benchmark/benchmark_<commit>.json')
+parser.add_argument('--compare', type=str, default=None,
+                    help='(optional) JSON file of an earlier run to compare the results with')
+parser.add_argument('--profile', type=str, default=None,
+                    help='(optional) directory to write a profile of every classification of the single worker cases to. The timings then include the overhead of the profiler')
+parser.add_argument('--profiler', type=str, default='cProfile', choices=['cProfile','pyinstrument'],
+                    help='profiler used with --profile')
+
+
+def gitCommit():
+    """
+    Returns the short hash of the checked out commit, with a + when the tree has changes, or None.
+
+
+    """
+
+    try:
+        commit = subprocess.check_output(['git','rev-parse','--short','HEAD'],stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git','diff','--quiet','HEAD'],stderr=subprocess.DEVNULL) != 0
+        return commit + ('+' if dirty else '')
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+
+def randomPoints(n, polygon, rng):
+    """
+    Returns n uniformly distributed lon/lat points within a polygon.
+
+
+    """
+
+    minx,miny,maxx,maxy = polygon.bounds
+    points = [np.empty((0,2))]
+    count = 0
+    while count < n:
+        xy = np.column_stack((rng.uniform(minx,maxx,n),rng.uniform(miny,maxy,n)))
+        xy = xy[contains(polygon,xy[:,0],xy[:,1])]
+        points.append(xy)
+        count += len(xy)
+
+    return np.concatenate(points)[:n]
+
+
+
+def routeWaypoints(lonlats_deg):
+    """
+    Returns one route per point: ROUTE_LEGS legs of ROUTE_LEG_NM, each on a random heading, starting at the point.
+
+
+    """
+
+    rng = np.random.default_rng(args.seed)
+    heading = rng.uniform(0,2*np.pi,(len(lonlats_deg),ROUTE_LEGS))
+    dlat = np.cumsum(ROUTE_LEG_NM/60.0*np.cos(heading),axis=1)
+    dlon = np.cumsum(ROUTE_LEG_NM/60.0*np.sin(heading),axis=1)/np.cos(np.radians(lonlats_deg[:,1:]))
+
+    lon = np.column_stack((lonlats_deg[:,0],lonlats_deg[:,:1] + dlon))
+    lat = np.column_stack((lonlats_deg[:,1],lonlats_deg[:,1:] + dlat))
+
+    return list(np.stack((lon,lat),axis=2))
+
+
+
+def runStage(stage, lonlats_deg):
+    """
+    Runs one benchmarked function on a set of points.
+
+
+    """
+
+    if stage == 'RiskClassification':
+        RiskClassification(lonlats_deg,data,alt_ft_agl=args.alt_ft_agl)
+    elif stage == 'Low_Risk_Airspace':
+        Low_Risk_Airspace(lonlats_deg,data,alt_ft_agl=args.alt_ft_agl)
+    elif stage == 'Medium_Risk_Airspace':
+        Medium_Risk_Airspace(lonlats_deg,data,alt_ft_agl=args.alt_ft_agl)
+    elif stage == 'classifyRoutes':
+        classifyRoutes(routeWaypoints(lonlats_deg),data,alt_ft_agl=args.alt_ft_agl)
+    elif stage == 'ckdnearest':
+        ckdnearest(geopandas.GeoDataFrame(geometry=geopandas.points_from_xy(lonlats_deg[:,0],lonlats_deg[:,1])),data.ap)
+    elif stage == 'calc_distance':
+        [calc_distance(lat1,lon1,lat2,lon2) for (lon1,lat1),(lon2,lat2) in zip(lonlats_deg,pairs[:len(lonlats_deg)])]
+    elif stage == 'geodesic_distance':
+        geodesic_distance(lonlats_deg[:,1],lonlats_deg[:,0],pairs[:len(lonlats_deg),1],pairs[:len(lonlats_deg),0])
+    elif stage == 'generate_grid_in_polygon':
+        ## spacing of a grid of about len(lonlats_deg) points over the bounds of the state
+        minx,miny,maxx,maxy = state.geometry.iloc[0].bounds
+        generate_grid_in_polygon(np.sqrt((maxx - minx)*(maxy - miny)/len(lonlats_deg)),state)
+
+
+
+def stageSummary(records):
+    """
+    Sums the stage records (see util/Instrument.py) of one run by stage: calls, wall and CPU time, points
+    in and out and counters, and keeps the largest memory growth of a call.
+
+
+    """
+
+    stages = {}
+    for r in records:
+        s = stages.setdefault(r['stage'],{'calls': 0,'wall_s': 0.0,'cpu_s': 0.0,'points_in': None,'points_out': None,'counters': {},
+                                          'rss_growth_mb': None})
+        s['calls'] += 1
+        s['wall_s'] += r['wall_s']
+        s['cpu_s'] += r['cpu_s']
+        if r.get('rss_growth_mb') is not None:
+            s['rss_growth_mb'] = max(s['rss_growth_mb'] or 0.0,r['rss_growth_mb'])
+        for k in ('points_in','points_out'):
+            if r[k] is not None:
+                s[k] = (s[k] or 0) + r[k]
+        for k,v in r['counters'].items():
+            s['counters'][k] = s['counters'].get(k,0) + v
+
+    return stages
+
+
+
+def compileNumba():
+    # compiles geodesic_distance in this process, outside of the timed runs
+    geodesic_distance(points[:10,1],points[:10,0],pairs[:10,1],pairs[:10,0])
+
+
+
+def startWorker(ready):
+    # workers are only timed once all of them are ready
+    compileNumba()
+    ready.wait()
+
+
+
+def runChunk(k):
+    # runs in a worker process, on the k-th part of the points of the case
+    with quietOutput():
+        runStage(case_stage,case_chunks[k])
+
+
+
+def runCase(stage, n, workers, channel):
+    """
+    Times one (stage, points, workers) case. Runs in its own process so that its peak memory is its own.
+
+
+    """
+
+    global case_stage,case_chunks
+
+    try:
+        lonlats_deg = points[:n]
+        resetPeakRSS()
+
+        pool = None
+        if workers > 1:
+            # fork, so that the datasets and indexes are shared with the workers instead of pickled
+            case_stage,case_chunks = stage,np.array_split(lonlats_deg,workers)
+            ready = multiprocessing.get_context('fork').Barrier(workers + 1)
+            pool = multiprocessing.get_context('fork').Pool(workers,initializer=startWorker,initargs=(ready,))
+            ready.wait()
+        else:
+            compileNumba()
+
+        # the stages of the single worker runs are recorded, those of the fastest run are reported
+        records = []
+        sinks = [CallbackSink(records.append)]
+        if args.profile is not None and pool is None:
+            sinks.append(ProfileSink(args.profile,profiler=args.profiler))
+        setStageSinks(*sinks)
+
+        seconds = []
+        stages = None
+        cpu = time.process_time()
+        for _ in range(args.repeat):
+            del records[:]
+            start = time.perf_counter()
+            if pool is None:
+                runStage(stage,lonlats_deg)
+            else:
+                pool.map(runChunk,range(workers))
+            seconds.append(time.perf_counter() - start)
+            if pool is None and seconds[-1] == min(seconds):
+                stages = stageSummary(records)
+        cpu = time.process_time() - cpu
+
+        worker_rss = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu += children.ru_utime + children.ru_stime
+            worker_rss = children.ru_maxrss/1024.0
+
+        channel.put({'seconds': min(seconds),'seconds_all': seconds,'cpu_seconds': cpu,
+                   'peak_rss_mb': peakRSS(),'worker_peak_rss_mb': worker_rss,'stages': stages})
+    except Exception:
+        channel.put({'error': traceback.format_exc()})
+
+
+
+def compareResults(results, path):
+    """
+    Prints the speedup of every case over the same case of an earlier run.
+
+
+    """
+
+    with open(path) as f:
+        before = json.load(f)
+    seconds = {(r['stage'],r['points'],r['workers']): r.get('seconds') for r in before['results']}
+
+    print("Comparison with {} ({})".format(path,before.get('commit')))
+    print("------------------------------------------------------------------------------")
+    for r in results:
+        old = seconds.get((r['stage'],r['points'],r['workers']))
+        if old is None or r.get('seconds') is None:
+            continue
+        print("> {:<26} {:>9} points | {:>3} workers | {:9.3f}s -> {:9.3f}s | x{:.2f}".format(
+            r['stage'],r['points'],r['workers'],old,r['seconds'],old/max(r['seconds'],1e-12)))
+    print("------------------------------------------------------------------------------")
+    print(" ")
+
+
+
+args = parser.parse_args()
+
+commit = gitCommit()
+out = args.out or os.path.join('output','benchmark','benchmark_{}.json'.format(commit or time.strftime('%Y%m%d_%H%M%S')))
+
+print("Benchmark")
+print("------------------------------------------------------------------------------")
+
+### Synthetic datasets and points
+start = time.time()
+data = syntheticData(tuple(args.bounds),seed=args.seed)
+state = data.states_df
+data_seconds = time.time() - start
+
+rng = np.random.default_rng(args.seed)
+points = randomPoints(max(args.points),state.geometry.iloc[0],rng)
+
+## a random aerodrome for every point, the other end of the distance stages
+pairs = np.column_stack((data.ap.geometry.x.values,data.ap.geometry.y.values))[rng.integers(0,len(data.ap),len(points))]
+
+print("> {} block groups | {} aerodromes | {} airspace shelves | Time: {:.1f}s".format(
+    len(data.bg_df),len(data.ap),len(data.airspace),data_seconds))
+
+### Elevation, from the local stub of the query service or in process
+stub = None
+if args.elevation == 'stub':
+    stub = ElevationStub()
+    setElevationProvider(AsyncEPQSElevation(url=stub.url,concurrency=args.concurrency,rate=10**6))
+    print("> elevation stub at {}".format(stub.url))
+else:
+    setElevationProvider(SyntheticElevation())
+
+### Building the indexes and cell covers once, before the cases fork from this process. The numba functions
+### are compiled in every case instead: not every numba threading layer can be used across a fork.
+with quietOutput():
+    warmData(data)
+
+print("> {} stages | points {} | workers {} | Time: {:.1f}s".format(len(args.stages),args.points,args.workers,time.time() - start))
+print("------------------------------------------------------------------------------")
+print(" ")
+
+results = []
+for stage in args.stages:
+    for n in sorted(args.points):
+        for workers in sorted(args.workers):
+            if (stage in SCALAR and n > args.max_scalar) or (stage in SERIAL and workers > 1):
+                continue
+
+            requests = stub.requests if stub is not None else 0
+            channel = multiprocessing.get_context('fork').Queue()
+            process = multiprocessing.get_context('fork').Process(target=runCase,args=(stage,n,workers,channel))
+            process.start()
+
+            # a case that runs out of memory is killed without reporting back
+            result = None
+            while result is None:
+                try:
+                    result = channel.get(timeout=1)
+                except queue.Empty:
+                    if not process.is_alive():
+                        result = {'error': 'case process exited with code {}'.format(process.exitcode)}
+            process.join()
+
+            result.update({'stage': stage,'points': n,'workers': workers,
+                           'elevation_requests': (stub.requests - requests) if stub is not None else None})
+            results.append(result)
+
+            if 'error' in result:
+                print("> {:<26} {:>9} points | {:>3} workers | FAILED".format(stage,n,workers))
+                print(result['error'])
+                continue
+
+            result['points_per_second'] = n/max(result['seconds'],1e-12)
+            print("> {:<26} {:>9} points | {:>3} workers | {:9.3f}s | {:12,.0f} points/s | peak RSS {:7.1f} MB".format(
+                stage,n,workers,result['seconds'],result['points_per_second'],
+                max(result['peak_rss_mb'],result['worker_peak_rss_mb'] or 0)))
+
+if stub is not None:
+    stub.close()
+
+print(" ")
+
+### Saving the results, to compare runs across commits
+os.makedirs(os.path.dirname(out) or '.',exist_ok=True)
+with open(out,'w') as f:
+    json.dump({'commit': commit,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'args': vars(args),
+               'data': {'block_groups': len(data.bg_df),'aerodromes': len(data.ap),'airspace': len(data.airspace),
+                        'seconds': data_seconds},
+               'results': results},f,indent=1)
+
+print("Results written to {}".format(out))
+print(" ")
+
+if args.compare is not None:
+    compareResults(results,args.compare)
@@ -0,0 +1,84 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import argparse
+from util.Stream import *
+from util.Data import *
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+parser = argparse.ArgumentParser(description='Classify airspace risk for the points of a CSV or Parquet file, one chunk at a time')
+parser.add_argument('points', type=str,
+                    help='.csv or .parquet file with lon, lat and (optionally) alt columns')
+parser.add_argument('output', type=str,
+                    help='.csv or .parquet file to write the classified points to')
+parser.add_argument('--alt_ft_agl', type=float, default=500,
+                    help='altitude used for the points when the file does not have an alt column')
+parser.add_argument('--chunk_size', type=int, default=100000,
+                    help='number of points classified at a time. Sets the peak memory of the run')
+parser.add_argument('--lon', type=str, default='lon',
+                    help='name of the longitude column')
+parser.add_argument('--lat', type=str, default='lat',
+                    help='name of the latitude column')
+parser.add_argument('--alt', type=str, default='alt',
+                    help='name of the altitude (ft AGL) column')
+parser.add_argument('--dem', type=str, default=None,
+                    help='(optional) directory of GridFloat DEM tiles used for elevation. USGS API is used for points off the tiles')
+parser.add_argument('--elevation_cache', type=str, default='output/elevation.sqlite',
+                    help='(optional) SQLite file used to keep elevations between runs')
+parser.add_argument('--bundle', type=str, default=None,
+                    help='(optional) data bundle written by compileData.py. If not specified the datasets are read from em-core')
+parser.add_argument('--quiet', action='store_true',
+                    help='(optional) do not print the per step output of the classification')
+parser.add_argument('--stage_log', type=str, default=None,
+                    help='(optional) JSON lines file the record of every classification step is appended to: wall and CPU time, points in and out, peak memory, elevation and polygon join counters')
+parser.add_argument('--profile', type=str, default=None,
+                    help='(optional) directory to write a profile of every classification to')
+parser.add_argument('--profiler', type=str, default='cProfile', choices=['cProfile','pyinstrument'],
+                    help='profiler used with --profile')
+
+
+args = parser.parse_args()
+
+# using local DEM tiles for elevation if provided, falling back to the USGS API
+if args.dem is not None:
+    provider = DEMElevation(args.dem, fallback=AsyncEPQSElevation())
+else:
+    provider = AsyncEPQSElevation()
+
+# caching elevations so that points are only looked up once across the low/medium risk checks and across runs
+elevation_cache = CachedElevation(provider, db_path=args.elevation_cache)
+setElevationProvider(elevation_cache)
+
+# the record of every classification step (util/Instrument.py) is printed unless --quiet, and written with --stage_log
+sinks = [] if args.quiet else [PrintSink()]
+if args.stage_log is not None:
+    sinks.append(JSONLinesSink(args.stage_log))
+if args.profile is not None:
+    sinks.append(ProfileSink(args.profile, profiler=args.profiler))
+setStageSinks(*sinks)
+
+
+if args.bundle is not None:
+    # loading the compiled datasets
+    data = loadData(args.bundle)
+else:
+    # specify your path to the em-core repository
+    try:
+        path_to_emcore = os.environ['AEM_DIR_CORE']
+    except:
+        print("PATH TO EMCORE NOT FOUND")
+        path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
+
+    # reading in airport, airspace, state and preprocessed census block group data
+    data = readData(path_to_emcore)
+
+
+chunks = fileChunks(args.points, chunk_size=args.chunk_size, lon=args.lon, lat=args.lat, alt=args.alt, alt_ft_agl=args.alt_ft_agl)
+n = StreamClassification(chunks, data, chunkWriter(args.output))
+
+print("> {} points saved to {}".format(n, args.output))
+print(elevation_cache.summary())
@@ -0,0 +1,65 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import argparse
+import pathlib
+from util.Regions import *
+from util.Data import *
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+parser = argparse.ArgumentParser(description='Build the LR/MR/HR region layer of a state at one altitude by overlaying the block groups, aerodrome buffers and airspace shelves')
+parser.add_argument('state', type=str, default='NC',
+                    help='a state for processing')
+parser.add_argument('alt_ft_agl', type=float, default=500,
+                    help='altitude of the region layer')
+parser.add_argument('--bundle', type=str, default=None,
+                    help='(optional) data bundle written by compileData.py. If not specified the datasets are read from em-core')
+parser.add_argument('--format', type=str, default='parquet', choices=['parquet','shp'],
+                    help='output format: GeoParquet or shapefiles')
+parser.add_argument('--vertices', type=int, default=256,
+                    help='number of vertices of the 5 nm aerodrome buffers')
+
+
+args = parser.parse_args()
+
+STATE = args.state.upper()
+ALTITUDE = args.alt_ft_agl
+
+OUT_DIR = 'output/regions/{}/alt_{}'.format(STATE, ALTITUDE)
+pathlib.Path(OUT_DIR).mkdir(parents=True, exist_ok=True)
+
+if args.bundle is not None:
+    # loading the compiled datasets
+    data = loadData(args.bundle)
+else:
+    # specify your path to the em-core repository
+    try:
+        path_to_emcore = os.environ['AEM_DIR_CORE']
+    except:
+        print("PATH TO EMCORE NOT FOUND")
+        path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
+
+    # reading in airport, airspace, state and preprocessed census block group data
+    data = readData(path_to_emcore)
+
+states_df = data.states_df
+
+# grabbing state polygon
+state = states_df.loc[states_df.iso_3166_2 == STATE]
+poly = unary_union(list(state.geometry))
+
+layer = buildRegions(poly, data, alt_ft_agl=ALTITUDE, n=args.vertices)
+
+# the faces are read back with readRegions for point queries, the dissolved regions are for maps
+ext = 'parquet' if args.format == 'parquet' else 'shp'
+layer.save(os.path.join(OUT_DIR, 'RiskRegionFaces.{}'.format(ext)))
+if args.format == 'parquet':
+    layer.regions.to_parquet(os.path.join(OUT_DIR, 'RiskRegions.parquet'))
+else:
+    layer.regions.to_file(os.path.join(OUT_DIR, 'RiskRegions.shp'))
+
+print("> {} regions ({} faces) saved to {} ({})".format(len(layer.regions), len(layer), OUT_DIR, args.format))
@@ -0,0 +1,85 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import signal
+import argparse
+import threading
+from util.Service import *
+from util.Data import *
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+parser = argparse.ArgumentParser(description='Serve airspace risk classification of lon/lat/alt points over a local HTTP or Unix socket API')
+parser.add_argument('--host', type=str, default='127.0.0.1',
+                    help='address to listen on')
+parser.add_argument('--port', type=int, default=8765,
+                    help='port to listen on')
+parser.add_argument('--socket', type=str, default=None,
+                    help='(optional) path of a Unix socket to listen on instead of host:port')
+parser.add_argument('--dem', type=str, default=None,
+                    help='(optional) directory of GridFloat DEM tiles used for elevation. USGS API is used for points off the tiles')
+parser.add_argument('--elevation_cache', type=str, default='output/elevation.sqlite',
+                    help='(optional) SQLite file used to keep elevations between runs')
+parser.add_argument('--bundle', type=str, default=None,
+                    help='(optional) data bundle written by compileData.py. If not specified the datasets are read from em-core')
+parser.add_argument('--verbose', action='store_true',
+                    help='log every request')
+
+
+args = parser.parse_args()
+
+# using local DEM tiles for elevation if provided, falling back to the USGS API
+if args.dem is not None:
+    provider = DEMElevation(args.dem, fallback=AsyncEPQSElevation())
+else:
+    provider = AsyncEPQSElevation()
+
+# the elevation cache stays warm for the life of the service
+elevation_cache = CachedElevation(provider, db_path=args.elevation_cache)
+setElevationProvider(elevation_cache)
+
+
+if args.bundle is not None:
+    # loading the compiled datasets, again on every reload
+    load = lambda: loadData(args.bundle)
+else:
+    # specify your path to the em-core repository
+    try:
+        path_to_emcore = os.environ['AEM_DIR_CORE']
+    except:
+        print("PATH TO EMCORE NOT FOUND")
+        path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
+
+    # reading in airport, airspace, state and preprocessed census block group data
+    load = lambda: readData(path_to_emcore)
+
+
+print("Classification Service")
+print("------------------------------------------------------------------------------")
+print("> Loading and indexing the datasets...")
+
+service = ClassificationService(load)
+server = makeServer(service, host=args.host, port=args.port, socket_path=args.socket, verbose=args.verbose)
+
+# SIGHUP reloads the datasets, same as POST /reload
+signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=service.reload, daemon=True).start())
+
+if args.socket is not None:
+    print("> Listening on {}".format(args.socket))
+else:
+    print("> Listening on http://{}:{}".format(args.host, args.port))
+print("------------------------------------------------------------------------------")
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    service.close()
+    if args.socket is not None and os.path.exists(args.socket):
+        os.remove(args.socket)
+    print(elevation_cache.summary())
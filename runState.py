@@ -3,18 +3,12 @@
 import os
 import argparse
 import pathlib
-import numpy as np
-import geopandas
-from p_tqdm import p_map
 from util.AirspaceRiskClassification import *
-from shapely.vectorized import contains
-
-# specify your path to the em-core repository
-try:
-    path_to_emcore = os.environ['AEM_DIR_CORE']
-except:
-    print("PATH TO EMCORE NOT FOUND")
-    path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
+from util.Data import *
+from util.Stream import *
+from util.Adaptive import *
+from util.Output import *
+from util.Raster import *
 
 ####################################################################################################
 ####################################################################################################
@@ -28,78 +22,132 @@ parser.add_argument('spacing', type=float, default=0.1,
                     help='longitude/latitude degree spacing')
 parser.add_argument('alt_ft_agl', type=float, default=500,
                     help='altitude to run airspace risk classification')
+parser.add_argument('--dem', type=str, default=None,
+                    help='(optional) directory of GridFloat DEM tiles used for elevation. USGS API is used for points off the tiles')
+parser.add_argument('--elevation_cache', type=str, default='output/elevation.sqlite',
+                    help='(optional) SQLite file used to keep elevations between runs')
+parser.add_argument('--bundle', type=str, default=None,
+                    help='(optional) data bundle written by compileData.py. If not specified the datasets are read from em-core')
+parser.add_argument('--format', type=str, default='parquet', choices=['parquet','tif','shp'],
+                    help='output format: GeoParquet (RiskClass.parquet), GeoTIFF (RiskClass.tif) or shapefiles (RiskClass.shp and LowRiskClass.shp)')
+parser.add_argument('--chunk_size', type=int, default=None,
+                    help='(optional) classify the grid this many points at a time and stream the results to the output. Keeps the memory use bounded for large states or fine spacings')
+parser.add_argument('--adaptive', type=int, default=None, metavar='LEVELS',
+                    help='(optional) classify a grid 2**LEVELS times coarser and only refine it down to SPACING_deg where the class changes or a boundary passes. Saves the multi-resolution cells (RiskClassCells.parquet or .shp), or the full grid for --format tif')
+parser.add_argument('--engine', type=str, default='vector', choices=['vector','raster'],
+                    help='vector: point-in-polygon joins of the grid points. raster: the layers are rasterized onto the grid and every cell is classified from them. The whole grid is classified at once, so it can not be used with --chunk_size or --adaptive')
+parser.add_argument('--quiet', action='store_true',
+                    help='(optional) do not print the per step output of the classification')
+parser.add_argument('--stage_log', type=str, default=None,
+                    help='(optional) JSON lines file the record of every classification step is appended to: wall and CPU time, points in and out, peak memory, elevation and polygon join counters')
+parser.add_argument('--profile', type=str, default=None,
+                    help='(optional) directory to write a profile of every classification to')
+parser.add_argument('--profiler', type=str, default='cProfile', choices=['cProfile','pyinstrument'],
+                    help='profiler used with --profile')
 
 
 args = parser.parse_args()
 
+if args.engine == 'raster' and (args.chunk_size is not None or args.adaptive is not None):
+    parser.error('--engine raster can not be used with --chunk_size or --adaptive')
+
 ### This code is showing lon/lat grid spaced by 0.1 degree for demonstration
 ### Change to 0.02 for 1-1.2 nm grid
 SPACING_deg = float(args.spacing)
 STATE = args.state.upper()
 ALTITUDE = args.alt_ft_agl
 
+# using local DEM tiles for elevation if provided, falling back to the USGS API
+if args.dem is not None:
+    provider = DEMElevation(args.dem, fallback=AsyncEPQSElevation())
+else:
+    provider = AsyncEPQSElevation()
+
+# caching elevations so that points are only looked up once across the low/medium risk checks and across runs
+elevation_cache = CachedElevation(provider, db_path=args.elevation_cache)
+setElevationProvider(elevation_cache)
+
+# the record of every classification step (util/Instrument.py) is printed unless --quiet, and written with --stage_log
+sinks = [] if args.quiet else [PrintSink()]
+if args.stage_log is not None:
+    sinks.append(JSONLinesSink(args.stage_log))
+if args.profile is not None:
+    sinks.append(ProfileSink(args.profile, profiler=args.profiler))
+setStageSinks(*sinks)
+
 # checking to see if path to results already exists, if not then creating it
 if not os.path.exists('output/states/{}/alt_{}/spacing_{}'.format(STATE, ALTITUDE, SPACING_deg)):
     pathlib.Path("output/states/{}/alt_{}/spacing_{}".format(STATE, ALTITUDE, SPACING_deg)).mkdir(parents=True, exist_ok=True)
 
 
-# reading in airport data
-ap = geopandas.read_file('{}/data/FAA-Airports/Airports.dbf'.format(path_to_emcore))
-
-## airspace classes
-airspace = geopandas.read_file('{}/data/FAA-NASR/Class_Airspace.dbf'.format(path_to_emcore))
+if args.bundle is not None:
+    # loading the compiled datasets
+    data = loadData(args.bundle)
+else:
+    # specify your path to the em-core repository
+    try:
+        path_to_emcore = os.environ['AEM_DIR_CORE']
+    except:
+        print("PATH TO EMCORE NOT FOUND")
+        path_to_emcore = input("Input path to em-core: (i.e ~/path/to/em-core) ")
 
+    # reading in airport, airspace, state and preprocessed census block group data
+    data = readData(path_to_emcore)
 
-## state shape file
-# reading from the em-core repository
-states_df = geopandas.read_file('{}/data/NE-Adminstrative/ne_10m_admin_1_states_provinces.dbf'.format(path_to_emcore))
-states_df = states_df.loc[states_df.iso_a2 == 'US']  ## only want to obtain US states
-states_df.loc[:, 'iso_3166_2'] = states_df.loc[:, 'iso_3166_2'].apply(lambda x: x[3:]) ## slicing off 'US' from 'US-state'
-states_df.loc[:, 'fips'] = states_df.loc[:, 'fips'].apply(lambda x: x[2:]) ## slicing off 'US' from 'USfips'
+states_df = data.states_df
 
-## preprocessed census block group shape file
-bg_df = geopandas.read_file('data/blockgroup/processed/BG.dbf')
-
-class Data:
-    def __init__(self, bg_df, airspace, ap, states_df):
-        self.bg_df = bg_df
-        self.airspace = airspace
-        self.ap = ap
-        self.states_df = states_df
+# grabbing state polygon
+state = states_df.loc[states_df.iso_3166_2 == STATE]
 
-data = Data(bg_df, airspace, ap, states_df)
+OUT_DIR = 'output/states/{}/alt_{}/spacing_{}'.format(STATE, ALTITUDE, SPACING_deg)
 
-# freeing up memory since these dataframes are now contained in the class
-del bg_df
-del airspace
-del ap
+# the GeoTIFF output is laid out on the same grid as the points. Adaptive runs save their cells directly
+grid = gridInPolygon(SPACING_deg, state)
+if args.adaptive is None or args.format == 'tif':
+    writer = resultWriter(args.format, OUT_DIR, grid=grid)
 
-### Need this function here for global "poly" variable
+if args.adaptive is not None:
+    # quadtree refinement of a coarse grid, only the corners of the refined cells are classified
+    poly = unary_union(list(state.geometry))
+    adaptive = AdaptiveClassification(SPACING_deg, poly, data, alt_ft_agl=ALTITUDE, levels=args.adaptive)
 
-def point_in(point):
-    return point.within(poly)
+    if args.format == 'tif':
+        writer.write(adaptive.expand())
+        writer.close()
+    elif args.format == 'parquet':
+        adaptive.cells().to_parquet(os.path.join(OUT_DIR, 'RiskClassCells.parquet'))
+    else:
+        adaptive.cells().to_file(os.path.join(OUT_DIR, 'RiskClassCells.shp'))
 
-# grabbing state polygon
-state = states_df.loc[states_df.iso_3166_2 == STATE]
-poly,points = generate_grid_in_polygon(SPACING_deg, state)  # generating lon,lat meshgrid
+    n = adaptive.points
+    print("> {} points classified for {} grid points ({} cells)".format(adaptive.evaluated, n, len(adaptive)))
 
-# lon/lat points corresponding to STATE
-lonlats = np.array(getLatLons(points[0], points[1])) # convert meshgrid to a list of lon/lat points.
+elif args.chunk_size is not None:
+    # streaming the grid through the classification, only one chunk of points is held in memory at a time
+    poly = unary_union(list(state.geometry))
+    chunks = gridChunks(SPACING_deg, poly, chunk_size=args.chunk_size, alt_ft_agl=ALTITUDE)
 
+    n = StreamClassification(chunks, data, writer)
 
-# The points may not all be within STATE due to the linearity of numpy meshgrid.
-# We now can trim off the points that do not fall withing the state boundary
+elif args.engine == 'raster':
+    # the cells of the grid whose center is within STATE, classified from the rasterized layers
+    print('Classifying the grid cells within the state boundary from rasterized layers...')
+    result = rasterChunk(grid, data, alt_ft_agl=ALTITUDE, mask=rasterizeMask(grid, state.geometry))
 
-print('Checking to make sure points are withing the state boundary...')
-ind2keep = contains(poly, lonlats[:, 0], lonlats[:, 1])
+    writer.write(result)
+    writer.close()
+    n = len(result)
 
-lonlats = lonlats[ind2keep == 1] ## Note: if ind2keep is a BOOLEAN array then " == 1" is optional
+else:
+    # lon/lat grid points within STATE, masked with a scanline test of the state boundary
+    print('Generating the grid points within the state boundary...')
+    lonlats = gridLonLats(SPACING_deg, state)
 
-# This is an array of shapely points
-points = np.array([Point(x,y) for x,y in lonlats], dtype=object)
+    # saving results (RiskClass and LowRiskClass)
+    writer.write(classifyChunk(lonlats, data, alt_ft_agl=ALTITUDE))
+    writer.close()
+    n = len(lonlats)
 
-df,lr_df = RiskClassification(lonlats, data, alt_ft_agl=ALTITUDE, points=points)
+print("> {} points saved to {} ({})".format(n, OUT_DIR, args.format))
 
-# saving results
-df.to_file('output/states/{}/alt_{}/spacing_{}/RiskClass.shp'.format(STATE, ALTITUDE, SPACING_deg))
-df.to_file('output/states/{}/alt_{}/spacing_{}/LowRiskClass.shp'.format(STATE, ALTITUDE, SPACING_deg))
+print(elevation_cache.summary())
@@ -0,0 +1,76 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import glob
+import time
+import argparse
+from util.Incremental import *
+from util.Data import *
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+parser = argparse.ArgumentParser(description='Reclassify stored results after a data update, only where the airspace, airports or block groups changed')
+parser.add_argument('old_bundle', type=str,
+                    help='data bundle (compileData.py) the stored results were classified with')
+parser.add_argument('new_bundle', type=str,
+                    help='data bundle (compileData.py) of the new data')
+parser.add_argument('outputs', type=str, nargs='*',
+                    help='RiskClass.parquet datasets or RiskClass.tif files to patch. Default is every one under output/states. Grid outputs are snapped back to the spacing of their spacing_<deg> directory')
+parser.add_argument('--tile_dir', type=str, default=None,
+                    help='(optional) tile checkpoints of runBatch.py to patch as well, i.e. output/tiles')
+parser.add_argument('--dem', type=str, default=None,
+                    help='(optional) directory of GridFloat DEM tiles used for elevation. USGS API is used for points off the tiles')
+parser.add_argument('--elevation_cache', type=str, default='output/elevation.sqlite',
+                    help='(optional) SQLite file used to keep elevations between runs')
+
+
+args = parser.parse_args()
+
+# using local DEM tiles for elevation if provided, falling back to the USGS API
+if args.dem is not None:
+    provider = DEMElevation(args.dem, fallback=AsyncEPQSElevation())
+else:
+    provider = AsyncEPQSElevation()
+
+# most of the reclassified points were looked up by the first run, the cache answers them
+elevation_cache = CachedElevation(provider, db_path=args.elevation_cache)
+setElevationProvider(elevation_cache)
+
+outputs = args.outputs
+if len(outputs) == 0:
+    outputs = sorted(glob.glob('output/states/*/alt_*/spacing_*/RiskClass.parquet') +
+                     glob.glob('output/states/*/alt_*/spacing_*/RiskClass.tif'))
+
+old = loadData(args.old_bundle)
+new = loadData(args.new_bundle)
+
+print("Incremental Reclassification")
+print("------------------------------------------------------------------------------")
+
+start = time.time()
+footprint, changes = diffData(old, new)
+
+for layer, c in changes.items():
+    print("> {}: {} rows removed | {} rows added".format(layer, c['removed'], c['added']))
+print("> Footprint: {} changed polygons | {} changed aerodromes (5 nm) | bounds {}".format(
+    len(footprint.polygons), len(footprint.aerodromes), None if footprint.bounds is None else [round(float(v), 4) for v in footprint.bounds]))
+print(" ")
+
+targets = list(outputs)
+if args.tile_dir is not None:
+    targets.append(args.tile_dir)
+
+for path in targets:
+    # the per step output of the classification is not useful for the small patches
+    with quietOutput():
+        if path == args.tile_dir:
+            reclassified, changed = patchTiles(path, footprint, new)
+        else:
+            reclassified, changed = patchOutput(path, footprint, new)
+
+    print("> {}: {} points reclassified | {} changed | Total Time: {}s".format(path, reclassified, changed, int(time.time()-start)))
+
+print("------------------------------------------------------------------------------")
+print(elevation_cache.summary())
@@ -8,8 +8,5 @@ wget -r -P ../data/blockgroup/raw -l1 -H -t 5 -nd -N -np -A .zip -erobots=off ht
 # now unzip the files and moving them to a new location
 unzip ../data/blockgroup/raw/*\*.zip -d ../data/blockgroup/raw/
 
-# Running python script to combine individual shape files to one file
-python python/combineBG.py
-
-# adding on the density values to the single file
-python python/addDensity.py
+# combining the individual shape files into one layer with the density values
+python python/buildBG.py
@@ -0,0 +1,13 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import sys
+
+## the tests import util and python/ the same way the run scripts do, from the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+sys.path.insert(1,os.path.join(ROOT,'python'))
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers','census(script, status): answers of the local Census API stub of a test')
@@ -0,0 +1,250 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import sys
+import json
+import socket
+import asyncio
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+import geopandas
+import pytest
+from aiohttp import web
+from shapely.geometry import box
+from block_group_process import *
+
+## recorded Census API responses, one per county (state_county.json)
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data','census')
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'python','block_group_process.py')
+
+COUNTIES = [('37','001'),('37','003'),('51','013')]
+YEAR = 2018
+
+## quick retries so that the tests do not wait on the backoff
+FAST = {'rate': 1000,'timeout': 0.5,'max_retries': 3,'backoff': 0.01}
+
+
+class CensusStub:
+    """
+    Local stand-in for the Census API. Replays the recorded responses of DATA on a background thread.
+
+
+    Parameters:
+    -----------
+    script {dict}: (optional) answers given to the first requests of a (state, county), in order, before its recorded response.
+                   An int is answered as that HTTP status, 'timeout' is answered too late.
+    status {dict}: (optional) HTTP status and body every request of a (state, county) is answered with.
+
+
+    Attributes:
+    -----------
+    url {string}: query url to give to CensusClient, formatted with the year.
+    requests {list}: (state, county) of every request received, in order.
+
+
+    """
+
+    def __init__(self, script=None, status=None, delay=2.0):
+        self.script = {k: list(v) for k,v in (script or {}).items()}
+        self.status = status or {}
+        self.delay = delay
+        self.requests = []
+
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1',0))
+        self._socket.listen(128)
+        self.url = 'http://{}:{}'.format(*self._socket.getsockname()[:2]) + '/data/{year}/acs/acs5'
+
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._serve,daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+
+        app = web.Application()
+        app.router.add_get('/data/{year}/acs/acs5',self._handle)
+        self._runner = web.AppRunner(app,access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.SockSite(self._runner,self._socket).start())
+
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+
+    async def _handle(self, request):
+        # in=state:37 county:001 tract:*
+        geography = dict(part.split(':') for part in request.query['in'].split(' '))
+        county = (geography['state'],geography['county'])
+        self.requests.append(county)
+
+        if request.query.get('get') != POPULATION or request.query.get('for') != 'block group:*':
+            return web.Response(status=400,text='error: unknown variable')
+
+        if county in self.status:
+            status,text = self.status[county]
+            return web.Response(status=status,text=text)
+
+        if len(self.script.get(county,[])) > 0:
+            answer = self.script[county].pop(0)
+            if answer == 'timeout':
+                await asyncio.sleep(self.delay)
+            else:
+                return web.Response(status=answer,text='error')
+
+        path = os.path.join(DATA,'{}_{}.json'.format(*county))
+        if not os.path.exists(path):
+            return web.Response(status=204)
+        with open(path) as f:
+            return web.Response(text=f.read(),content_type='application/json')
+
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+
+@pytest.fixture
+def stub(request):
+    marker = request.node.get_closest_marker('census')
+    server = CensusStub(**(marker.kwargs if marker is not None else {}))
+    yield server
+    server.close()
+
+
+
+def recorded(state, county):
+    with open(os.path.join(DATA,'{}_{}.json'.format(state,county))) as f:
+        return json.load(f)
+
+
+
+def test_fetch(stub, tmp_path):
+    cache = ResponseCache(str(tmp_path),YEAR)
+    client = CensusClient(cache,YEAR,url=stub.url,**FAST)
+
+    assert client.fetch(COUNTIES) == []
+    assert sorted(stub.requests) == COUNTIES
+    assert client.errors == {}
+    for county in COUNTIES:
+        assert cache.get(*county) == recorded(*county)
+
+    population = cachedPopulation(cache,COUNTIES)
+    assert list(population.columns) == BG_COLUMNS + ['population']
+    assert len(population) == 8
+    assert population.loc[(population['COUNTYFP'] == '001') & (population['TRACTCE'] == '020200'),'population'].tolist() == [2210]
+    # the annotation code of a block group without an estimate
+    assert population.loc[population['TRACTCE'] == '980100','population'].isna().all()
+
+
+
+@pytest.mark.census(script={('37','001'): [503,502],('37','003'): ['timeout'],('51','013'): [429]})
+def test_retry(stub, tmp_path):
+    cache = ResponseCache(str(tmp_path),YEAR)
+    client = CensusClient(cache,YEAR,url=stub.url,**FAST)
+
+    assert client.fetch(COUNTIES) == []
+    assert stub.requests.count(('37','001')) == 3
+    assert stub.requests.count(('37','003')) == 2
+    assert stub.requests.count(('51','013')) == 2
+    assert client.errors == {}
+    for county in COUNTIES:
+        assert cache.get(*county) == recorded(*county)
+
+
+
+@pytest.mark.census(script={('37','001'): [503]*10})
+def test_retries_exhausted(stub, tmp_path):
+    cache = ResponseCache(str(tmp_path),YEAR)
+    client = CensusClient(cache,YEAR,url=stub.url,**FAST)
+
+    assert client.fetch(COUNTIES) == [('37','001')]
+    assert stub.requests.count(('37','001')) == FAST['max_retries'] + 1
+    assert '503' in client.errors[('37','001')]
+    assert ('37','001') not in cache
+    assert ('37','003') in cache
+
+
+
+@pytest.mark.census(status={('37','003'): (403,'Invalid Key'),('51','013'): (204,'')})
+def test_fail_fast(stub, tmp_path):
+    cache = ResponseCache(str(tmp_path),YEAR)
+    client = CensusClient(cache,YEAR,url=stub.url,**FAST)
+
+    assert sorted(client.fetch(COUNTIES)) == [('37','003'),('51','013')]
+    assert stub.requests.count(('37','003')) == 1
+    assert stub.requests.count(('51','013')) == 1
+    assert client.errors[('37','003')] == 'HTTP 403: Invalid Key'
+    assert client.errors[('51','013')].startswith('HTTP 204')
+    assert ('37','001') in cache
+    assert ('37','003') not in cache
+
+
+
+def test_resume(stub, tmp_path):
+    cache = ResponseCache(str(tmp_path),YEAR)
+    cache.put('37','001',recorded('37','001'))
+
+    client = CensusClient(cache,YEAR,url=stub.url,**FAST)
+    assert client.fetch(COUNTIES) == []
+    assert sorted(stub.requests) == COUNTIES[1:]
+
+    # everything is cached now
+    client = CensusClient(ResponseCache(str(tmp_path),YEAR),YEAR,url=stub.url,**FAST)
+    assert client.fetch(COUNTIES) == []
+    assert len(stub.requests) == 2
+
+
+
+@pytest.mark.census(script={('51','013'): [503]})
+def test_density_values(stub, tmp_path):
+    # block groups of two per-state TIGER files, with one that the API does not know about
+    rows = {'37': [('001','020100','1',2.0e6,0.0),('001','020100','2',1.0e6,5.0e5),('001','020200','1',4.0e6,0.0),
+                   ('003','040100','1',8.0e5,2.0e5),('003','040100','2',1.0e6,0.0)],
+            '51': [('013','101100','1',1.5e6,0.0),('013','101100','2',9.0e5,1.0e5),('013','980100','1',3.0e6,1.0e6),
+                   ('013','101200','1',1.0e6,0.0)]}
+    raw = tmp_path/'raw'
+    raw.mkdir()
+    for state,bgs in rows.items():
+        df = pd.DataFrame(bgs,columns=['COUNTYFP','TRACTCE','BLKGRPCE','ALAND','AWATER'])
+        df.insert(0,'STATEFP',state)
+        geopandas.GeoDataFrame(df,geometry=[box(i,0,i + 1,1) for i in range(len(df))],crs='EPSG:4269') \
+                 .to_file(str(raw/'tl_2018_{}_bg.shp'.format(state)))
+
+    # the cache already has the first county
+    ResponseCache(str(tmp_path/'cache'),YEAR).put('37','001',recorded('37','001'))
+
+    out = tmp_path/'density_values.csv'
+    result = subprocess.run([sys.executable,SCRIPT,'--raw',str(raw/'tl_*_*_bg.dbf'),'--cache_dir',str(tmp_path/'cache'),
+                             '--key_file',str(tmp_path/'API.txt'),'--url',stub.url,'--out',str(out)],
+                            cwd=str(tmp_path),stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True,timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert sorted(stub.requests) == [('37','003'),('51','013'),('51','013')]
+
+    density = pd.read_csv(str(out),dtype=str)
+    assert list(density.columns) == BG_COLUMNS + ['density']
+    assert len(density) == 9
+
+    population = {('37','001','020100','1'): 1523,('37','001','020100','2'): 987,('37','001','020200','1'): 2210,
+                  ('37','003','040100','1'): 640,('37','003','040100','2'): 0,
+                  ('51','013','101100','1'): 3105,('51','013','101100','2'): 1876}
+    for state,bgs in rows.items():
+        for county,tract,group,aland,awater in bgs:
+            row = density[(density['STATEFP'] == state) & (density['COUNTYFP'] == county) &
+                          (density['TRACTCE'] == tract) & (density['BLKGRPCE'] == group)]
+            assert len(row) == 1
+            value = row['density'].iloc[0]
+            if (state,county,tract,group) in population:
+                expected = population[(state,county,tract,group)]/((aland + awater)*0.00000038610215855)
+                np.testing.assert_allclose(float(value),expected,rtol=1e-9)
+            else:
+                # annotation code or not in the response
+                assert pd.isna(value)
@@ -0,0 +1,72 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import numpy as np
+from geopy.distance import geodesic
+from util.Geo import geodesic_distance
+
+## documented agreement with geopy (Karney): 0.5 mm
+TOLERANCE_NM = 3e-7
+
+
+def geopyDistance(lat1, lon1, lat2, lon2):
+    return np.array([geodesic((a,b),(c,d)).nm for a,b,c,d in zip(lat1,lon1,lat2,lon2)])
+
+
+
+def test_random_us_pairs():
+    # CONUS, Alaska and Hawaii
+    rng = np.random.default_rng(0)
+    n = 2000
+    lat1,lat2 = rng.uniform(18,72,n),rng.uniform(18,72,n)
+    lon1,lon2 = rng.uniform(-170,-65,n),rng.uniform(-170,-65,n)
+
+    d = geodesic_distance(lat1,lon1,lat2,lon2)
+
+    assert d.shape == (n,)
+    np.testing.assert_allclose(d,geopyDistance(lat1,lon1,lat2,lon2),rtol=0,atol=TOLERANCE_NM)
+
+
+
+def test_short_pairs():
+    # the distances of the 5 nm aerodrome test
+    rng = np.random.default_rng(1)
+    n = 2000
+    lat1,lon1 = rng.uniform(25,49,n),rng.uniform(-125,-67,n)
+    lat2,lon2 = lat1 + rng.uniform(-0.1,0.1,n),lon1 + rng.uniform(-0.1,0.1,n)
+
+    d = geodesic_distance(lat1,lon1,lat2,lon2)
+
+    np.testing.assert_allclose(d,geopyDistance(lat1,lon1,lat2,lon2),rtol=0,atol=TOLERANCE_NM)
+
+
+
+def test_coincident_points():
+    lat = np.array([35.0,0.0,-45.5,89.0])
+    lon = np.array([-79.0,0.0,170.25,-120.0])
+
+    np.testing.assert_array_equal(geodesic_distance(lat,lon,lat,lon),np.zeros(4))
+
+
+
+def test_near_antipodal():
+    # Vincenty's iteration does not converge for these pairs. They are documented to be within 0.1% of geopy,
+    # (0, 0) to (0.5, 179.7) was off by about 2 nm before they were computed with geopy.
+    lat1 = np.array([0.0,0.0,10.0,0.0,89.9])
+    lon1 = np.array([0.0,0.0,20.0,0.0,0.0])
+    lat2 = np.array([0.5,0.0,-10.1,0.1,-89.9])
+    lon2 = np.array([179.7,179.5,-160.2,179.9,180.0])
+
+    d = geodesic_distance(lat1,lon1,lat2,lon2)
+    expected = geopyDistance(lat1,lon1,lat2,lon2)
+
+    assert np.all(np.abs(d - expected) <= 1e-3*expected)
+    np.testing.assert_allclose(d,expected,rtol=0,atol=TOLERANCE_NM)
+
+
+
+def test_broadcast_and_nan():
+    d = geodesic_distance(35.0,-79.0,np.array([35.0,36.0,np.nan]),np.array([-79.0,-79.0,-79.0]))
+
+    assert d[0] == 0.0
+    np.testing.assert_allclose(d[1],geodesic((35.0,-79.0),(36.0,-79.0)).nm,rtol=0,atol=TOLERANCE_NM)
+    assert np.isnan(d[2])
@@ -0,0 +1,63 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import numpy as np
+import pytest
+import util.Elevation
+from util.Synthetic import *
+from util.Route import *
+from util.Stream import classifyChunk
+from util.Instrument import quietOutput
+
+BOUNDS = (-80.0,35.0,-79.0,36.0)
+
+
+@pytest.fixture(scope='module')
+def data():
+    # synthetic state, with its terrain answered in process
+    provider = util.Elevation.elevation_provider
+    setElevationProvider(SyntheticElevation())
+    yield syntheticData(BOUNDS)
+    setElevationProvider(provider)
+
+
+
+def randomRoutes(n, alt, seed=0):
+    rng = np.random.default_rng(seed)
+    routes = []
+    for _ in range(n):
+        k = rng.integers(2,6)
+        routes.append(np.column_stack((rng.uniform(BOUNDS[0],BOUNDS[2],k),rng.uniform(BOUNDS[1],BOUNDS[3],k),np.full(k,alt))))
+    return routes
+
+
+
+def test_constant_altitude(data):
+    # samples between two waypoints at the same altitude are at exactly that altitude
+    routes = randomRoutes(200,500.0)
+    lonlats,alt,_,_ = resampleRoutes(routes,step_nm=0.5)
+    assert (alt == 500.0).all()
+
+    with quietOutput():
+        result = classifyRoutes(routes,data,step_nm=0.5)
+        reference = classifyChunk(lonlats,data,alt_ft_agl=500)
+
+    for name in ('risk_class','status','low_risk','lr_status'):
+        np.testing.assert_array_equal(getattr(result.samples,name),getattr(reference,name))
+
+    # routes given without an altitude are flown at alt_ft_agl
+    with quietOutput():
+        result = classifyRoutes([r[:,:2] for r in routes],data,step_nm=0.5,alt_ft_agl=500)
+
+    np.testing.assert_array_equal(result.samples.risk_class,reference.risk_class)
+    np.testing.assert_array_equal(result.samples.status,reference.status)
+
+
+
+def test_climb(data):
+    # altitudes between the waypoints stay within the altitudes of the waypoints
+    routes = [np.array([[-79.9,35.1,200.0],[-79.1,35.9,1500.0],[-79.5,35.2,500.0]])]
+    _,alt,_,segment = resampleRoutes(routes,step_nm=0.5)
+
+    assert alt[0] == 200.0 and alt[-1] == 500.0
+    assert (np.diff(alt[segment == 0]) > 0).all()
+    assert (alt >= 200.0).all() and (alt <= 1500.0).all()
@@ -0,0 +1,294 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import time
+import numpy as np
+import geopandas
+from shapely.geometry import box
+from util.Stream import *
+from util.Result import *
+
+def boundaryPoints(edges, step):
+    """
+    Densifies polygon edges so that consecutive points are no more than step apart (in x and in y).
+
+
+    Parameters:
+    -----------
+    edges {array}: (E,4) array of x1,y1,x2,y2, i.e. from polygonEdges.
+    step {float}: largest distance between points in degrees.
+
+
+    Returns:
+    --------
+    xy {array}: (N,2) array of points along the edges, the edge ends included.
+
+
+    """
+
+    if len(edges) == 0:
+        return np.empty((0,2))
+
+    x1,y1,x2,y2 = edges.T
+    pieces = np.maximum(np.ceil(np.maximum(np.abs(x2 - x1),np.abs(y2 - y1))/step),1).astype(np.int64)
+
+    edge = np.repeat(np.arange(len(edges)),pieces + 1)
+    t = (np.arange(len(edge)) - np.repeat(np.cumsum(pieces + 1) - (pieces + 1),pieces + 1))/pieces[edge]
+
+    return np.column_stack((x1[edge] + t*(x2[edge] - x1[edge]),y1[edge] + t*(y2[edge] - y1[edge])))
+
+
+
+def aerodromeRings(lonlats_deg, step, radius_nm=AERODROME_NM):
+    """
+    Returns points along the radius_nm geodesic circle around every aerodrome, no more than step degrees apart.
+
+
+    """
+
+    lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+    if len(lonlats_deg) == 0:
+        return np.empty((0,2))
+
+    lat_deg = radius_nm/60.0
+    circumference = 2*np.pi*lat_deg/np.maximum(np.cos(np.radians(np.minimum(np.abs(lonlats_deg[:,1]) + lat_deg,89.0))),1e-6)
+    n = int(np.ceil(circumference.max()/step))
+
+    return geodesicCircles(lonlats_deg,radius_nm,n).reshape(-1,2)
+
+
+
+class AdaptiveResult:
+    """
+    Quadtree classification of a grid. Every leaf is a square block of size x size points of the target
+    grid, with its lower-left point at (x[i], y[j]). All of the points of a block have the class of that
+    point, which was classified: blocks of more than one point are only kept when their four corners agree
+    and no block group, airspace, 5 nm aerodrome or state boundary passes through them.
+
+
+    Attributes:
+    -----------
+    spacing {float}: spacing of the target grid in degrees.
+    x {array}: longitudes of the target grid.
+    y {array}: latitudes of the target grid.
+    i {array}: column of the lower-left point of every leaf.
+    j {array}: row of the lower-left point of every leaf.
+    size {array}: number of target grid points along the side of every leaf.
+    result {RiskResult}: classification of the lower-left point of every leaf.
+    evaluated {int}: number of points that were classified.
+
+
+    """
+
+    def __init__(self, spacing, x, y, i, j, size, result, evaluated):
+        self.spacing = spacing
+        self.x = x
+        self.y = y
+        self.i = i
+        self.j = j
+        self.size = size
+        self.result = result
+        self.evaluated = evaluated
+
+
+    def __len__(self):
+        return len(self.i)
+
+
+    @property
+    def points(self):
+        """
+        Returns the number of target grid points covered by the leaves.
+
+
+        """
+        i1 = np.minimum(self.i + self.size,len(self.x))
+        j1 = np.minimum(self.j + self.size,len(self.y))
+
+        return int(((i1 - self.i)*(j1 - self.j)).sum())
+
+
+    def cells(self):
+        """
+        Returns the leaves as a multi-resolution grid: one square polygon per leaf, centered on the
+        points it covers, with its size in degrees and the classification of its points.
+
+
+        """
+
+        half = self.spacing/2
+        x0,y0 = self.x[self.i] - half,self.y[self.j] - half
+        side = self.size*self.spacing
+
+        df,_ = self.result.toGeoDataFrames()
+        df = df.drop(columns='geometry')
+        df.insert(0,'size_deg',side)
+        df['LR_Risk_Class'] = self.result.low_risk.astype(int)
+        df['LR_Status'] = decodeStatus(self.result.lr_status)
+
+        return geopandas.GeoDataFrame(df,geometry=[box(a,b,a + s,b + s) for a,b,s in zip(x0,y0,side)],crs='EPSG:4326')
+
+
+    def expand(self):
+        """
+        Returns the classification of every point of the target grid covered by the leaves, in the order
+        of generate_grid_in_polygon (by latitude, then longitude).
+
+
+        """
+
+        i1 = np.minimum(self.i + self.size,len(self.x))
+        j1 = np.minimum(self.j + self.size,len(self.y))
+        nx,ny = i1 - self.i,j1 - self.j
+
+        leaf = np.repeat(np.arange(len(self.i)),nx*ny)
+        k = np.arange(len(leaf)) - np.repeat(np.cumsum(nx*ny) - nx*ny,nx*ny)
+        col = self.i[leaf] + k % nx[leaf]
+        row = self.j[leaf] + k//nx[leaf]
+
+        order = np.lexsort((col,row))
+        leaf,col,row = leaf[order],col[order],row[order]
+
+        r = self.result
+        return RiskResult(self.x[col],self.y[row],r.alt[leaf],r.risk_class[leaf],r.status[leaf],r.low_risk[leaf],r.lr_status[leaf])
+
+
+
+def AdaptiveClassification(spacing, polygon, data, alt_ft_agl=500, levels=4):
+    """
+    Classifies the grid of runState.py within a polygon by quadtree refinement. A coarse grid,
+    2**levels times the target spacing, is classified first. Every cell whose four corners disagree
+    (Risk_Class or LR_Risk_Class), or that a block group, airspace, 5 nm aerodrome or polygon boundary
+    passes through, is split in four, down to the target spacing. Corners are shared between cells and
+    classified once.
+
+
+    Parameters:
+    -----------
+    spacing {float}: spacing of the target grid in degrees.
+    polygon {shapely geometry}: boundary to classify within, i.e. the union of a state.
+    data {class}: class object containing referenced data.
+    alt_ft_agl {float/int}: altitude of the points in AGL. Default is 500ft AGL.
+    levels {int}: number of times the coarse cells can be split.
+
+
+    Returns:
+    --------
+    result {AdaptiveResult}: leaves of the quadtree within the polygon.
+
+
+    Notes:
+    --------
+    Within a block whose corners agree, the class can still change with the terrain where an airspace
+    shelf is referenced to MSL. Such changes are only found where they reach a corner.
+
+
+    """
+
+    start = time.time()
+    S = 2**int(levels)
+
+    x,y = gridAxes(spacing,polygon.bounds)
+    x0,y0 = (x[0],y[0]) if len(x) > 0 and len(y) > 0 else polygon.bounds[:2]
+
+    ## target grid padded so that it is made of whole coarse cells
+    ncx,ncy = max(int(np.ceil((len(x) - 1)/S)),1),max(int(np.ceil((len(y) - 1)/S)),1)
+    nx,ny = ncx*S + 1,ncy*S + 1
+    x = np.r_[x,x0 + np.arange(len(x),nx)*spacing]
+    y = np.r_[y,y0 + np.arange(len(y),ny)*spacing]
+
+    stageLog("Adaptive Classification")
+    stageLog("------------------------------------------------------------------------------")
+    stageLog("> {} x {} target grid | {} x {} coarse cells | {} levels".format(nx,ny,ncx,ncy,levels))
+
+    ## target grid cells that a boundary passes through, grown by one cell on every side
+    bounds = (x[0] - spacing,y[0] - spacing,x[-1] + spacing,y[-1] + spacing)
+    bg_index,airspace_index = polygonIndexes(data)
+    edges = [polygonEdges(polygon)]
+    for index in (bg_index,airspace_index):
+        b = index.bounds
+        near = np.flatnonzero((b[:,2] >= bounds[0]) & (b[:,0] <= bounds[2]) & (b[:,3] >= bounds[1]) & (b[:,1] <= bounds[3]))
+        edges += [polygonEdges(index.geometries[k]) for k in near]
+
+    ap_index,_ = aerodromeIndex(data)
+    pad = 2*AERODROME_NM/60.0/max(np.cos(np.radians(max(abs(bounds[1]),abs(bounds[3])))),0.1)
+    ap = ap_index.lonlats
+    ap = ap[(ap[:,0] >= bounds[0] - pad) & (ap[:,0] <= bounds[2] + pad) & (ap[:,1] >= bounds[1] - pad) & (ap[:,1] <= bounds[3] + pad)]
+
+    xy = np.concatenate([boundaryPoints(np.concatenate(edges),spacing/2),aerodromeRings(ap,spacing/2)])
+    ci = np.floor((xy[:,0] - x0)/spacing).astype(np.int64)
+    cj = np.floor((xy[:,1] - y0)/spacing).astype(np.int64)
+    keep = (ci >= -1) & (ci <= nx) & (cj >= -1) & (cj <= ny)
+    ci,cj = ci[keep],cj[keep]
+    ci = (ci[:,None] + np.array([-1,0,1]*3)).ravel()
+    cj = (cj[:,None] + np.repeat([-1,0,1],3)).ravel()
+    keep = (ci >= 0) & (ci < nx) & (cj >= 0) & (cj < ny)
+    boundary = np.unique(cj[keep]*nx + ci[keep])
+    b_i,b_j = boundary % nx,boundary//nx
+
+    ## classified corners, kept sorted by key = row*nx + column
+    keys = np.empty(0,dtype=np.int64)
+    results = RiskResult.empty()
+    evaluated = 0
+
+    ci,cj = np.meshgrid(np.arange(ncx)*S,np.arange(ncy)*S)
+    cell_i,cell_j = ci.ravel(),cj.ravel()
+    size = S
+
+    leaves_i,leaves_j,leaves_size = [],[],[]
+    while len(cell_i) > 0:
+        ## classifying the corners that were not classified yet
+        corner_i = np.concatenate((cell_i,cell_i + size,cell_i,cell_i + size))
+        corner_j = np.concatenate((cell_j,cell_j,cell_j + size,cell_j + size))
+        corner = corner_j*nx + corner_i
+
+        new = np.setdiff1d(corner,keys)
+        if len(new) > 0:
+            r = classifyChunk(np.column_stack((x[new % nx],y[new//nx])),data,alt_ft_agl=alt_ft_agl)
+            keys = np.concatenate((keys,new))
+            order = np.argsort(keys,kind='stable')
+            keys = keys[order]
+            results = RiskResult.concat([results,r]).take(order)
+            evaluated += len(new)
+
+        k = np.searchsorted(keys,corner).reshape(4,-1)
+        risk_class,low_risk = results.risk_class[k],results.low_risk[k]
+        agree = (risk_class == risk_class[0]).all(axis=0) & (low_risk == low_risk[0]).all(axis=0)
+
+        if size == 1:
+            leaf = np.ones(len(cell_i),dtype=bool)
+        else:
+            touched = np.unique((b_j//size)*nx + b_i//size)
+            leaf = agree & ~np.isin((cell_j//size)*nx + cell_i//size,touched)
+
+        leaves_i.append(cell_i[leaf])
+        leaves_j.append(cell_j[leaf])
+        leaves_size.append(np.full(int(leaf.sum()),size))
+
+        stageLog("> cell size {} deg: {} cells | {} leaves | {} points classified | Total Time: {:.1f}s".format(
+            round(size*spacing,10),len(cell_i),int(leaf.sum()),evaluated,time.time() - start))
+
+        if size == 1:
+            break
+
+        ## splitting the other cells in four
+        half = size//2
+        split_i,split_j = cell_i[~leaf],cell_j[~leaf]
+        cell_i = np.concatenate((split_i,split_i + half,split_i,split_i + half))
+        cell_j = np.concatenate((split_j,split_j,split_j + half,split_j + half))
+        size = half
+
+    i,j,size = np.concatenate(leaves_i),np.concatenate(leaves_j),np.concatenate(leaves_size)
+
+    ## keeping the leaves within the polygon. A leaf is either a single point or has no boundary
+    ## through it, so it is within the polygon if its lower-left point is.
+    inside = contains(polygon,x[i],y[j])
+    i,j,size = i[inside],j[inside],size[inside]
+
+    k = np.searchsorted(keys,j*nx + i)
+    order = np.lexsort((i,j))
+
+    stageLog("> {} leaves | {} points classified | Time: {:.1f}s".format(len(i),evaluated,time.time() - start))
+    stageLog("------------------------------------------------------------------------------")
+    stageLog(" ")
+
+    return AdaptiveResult(spacing,x,y,i[order],j[order],size[order],results.take(k[order]),evaluated)
@@ -0,0 +1,177 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import numpy as np
+from util.Elevation import NO_ELEVATION
+
+## Outcome codes of the vertical airspace check for each point
+IN_OTHER_AIRSPACE = 0    # at least one shelf at the altitude is not in the allowed classes
+CLASS_G = 1              # no controlled airspace shelf at the altitude
+IN_ALLOWED_AIRSPACE = 2  # every shelf at the altitude is in the allowed classes
+NO_ELEV = 3              # elevation was needed but not available
+
+# upper limit used for shelves with a negative (unlimited) upper value
+UNLIMITED_FT = 6e4
+
+
+class AirspaceStack:
+    """
+    Columnar representation of the airspace shelves above a set of points, built from
+    the result of sjoin(points,airspace,how='left'). Rows are sorted by point so every point
+    is one contiguous segment and per-point results can be computed with ufunc.reduceat.
+
+
+    Parameters:
+    -----------
+    aspace_df {geo dataframe}: sjoin result with the point index in column 'number' and the
+                               airspace columns CLASS, LOWER_VAL, LOWER_CODE, UPPER_VAL, UPPER_CODE.
+
+
+    Attributes:
+    -----------
+    points {array}: point index of each segment (sorted, unique).
+    starts {array}: row where each point's segment starts.
+    row_point {array}: segment number (0..len(points)-1) of every row.
+    cls {array}: airspace class of every row.
+    lower {array}: lower shelf value of every row in feet.
+    upper {array}: upper shelf value of every row in feet (negative values replaced by 60000 ft).
+    lower_sfc {array}: True where the lower shelf is referenced to the surface.
+    upper_sfc {array}: True where the upper shelf is referenced to the surface.
+    valid {array}: False for rows of points that are not under any airspace.
+
+
+    """
+
+    def __init__(self, aspace_df):
+
+        number = aspace_df.number.values.astype(np.int64)
+        order = np.argsort(number,kind='stable')
+        number = number[order]
+
+        self.points,self.starts,self.row_point = np.unique(number,return_index=True,return_inverse=True)
+        self.row_point = self.row_point.reshape(-1)
+
+        self.cls = aspace_df.CLASS.values[order]
+        self.valid = ~aspace_df.CLASS.isnull().values[order]
+
+        self.lower = aspace_df.LOWER_VAL.values[order].astype(float)
+        self.upper = aspace_df.UPPER_VAL.values[order].astype(float)
+
+        ## fixing high-altitude airspace value
+        self.upper[self.upper < 0] = UNLIMITED_FT
+
+        self.lower_sfc = (aspace_df.LOWER_CODE.values[order] == 'SFC')
+        self.upper_sfc = (aspace_df.UPPER_CODE.values[order] == 'SFC')
+
+
+    def take(self, mask):
+        """
+        Returns the stack of a subset of the points. Points are renumbered 0..M-1.
+
+
+        Parameters:
+        -----------
+        mask {array}: boolean array, one per point, selecting the points to keep.
+
+
+        Returns:
+        --------
+        stack {AirspaceStack}: shelves above the selected points.
+
+
+        """
+
+        mask = np.asarray(mask,dtype=bool)
+        keep = mask[self.row_point]
+        new_point = np.cumsum(mask) - 1
+
+        stack = AirspaceStack.__new__(AirspaceStack)
+        stack.row_point = new_point[self.row_point[keep]]
+        stack.points = np.arange(int(mask.sum()),dtype=np.int64)
+        stack.starts = np.flatnonzero(np.r_[True,stack.row_point[1:] != stack.row_point[:-1]]) if keep.any() else np.empty(0,dtype=np.int64)
+
+        for name in ['cls','valid','lower','upper','lower_sfc','upper_sfc']:
+            setattr(stack,name,getattr(self,name)[keep])
+
+        return stack
+
+
+    def any(self, rows):
+        """
+        Per-point logical or of a boolean row array.
+
+
+        """
+        if len(self.starts) == 0:
+            return np.zeros(0,dtype=bool)
+        return np.logical_or.reduceat(rows,self.starts)
+
+
+    def all(self, rows):
+        """
+        Per-point logical and of a boolean row array.
+
+
+        """
+        if len(self.starts) == 0:
+            return np.zeros(0,dtype=bool)
+        return np.logical_and.reduceat(rows,self.starts)
+
+
+    def needsElevation(self):
+        """
+        Returns a boolean array, one per point, of the points whose shelves have to be
+        converted to AGL. Points under no airspace never need elevation.
+
+
+        """
+        under_airspace = self.any(self.valid)
+        all_sfc = self.any(self.lower_sfc) & self.any(self.upper_sfc)
+
+        return under_airspace & ~all_sfc
+
+
+
+def verticalAirspace(stack, alt_ft_agl, elevation, allowed_classes=()):
+    """
+    Evaluates the airspace shelves at the altitude of every point of an AirspaceStack.
+
+
+    Parameters:
+    -----------
+    stack {AirspaceStack}: airspace shelves above the points.
+    alt_ft_agl {float/int or array}: altitude in AGL, either one value or one per point of the stack.
+    elevation {array}: elevation in feet, one per point of the stack. Only used where stack.needsElevation().
+    allowed_classes {list}: airspace classes that are allowed at the altitude, i.e. ['B','C','D','E'].
+
+
+    Returns:
+    --------
+    outcome {array}: int8 array, one per point, of CLASS_G, IN_ALLOWED_AIRSPACE, IN_OTHER_AIRSPACE or NO_ELEV.
+
+
+    """
+
+    needs_elevation = stack.needsElevation()
+    elevation = np.where(needs_elevation,np.asarray(elevation,dtype=float),0.0)
+
+    # converting MSL shelves to AGL for the points that need it
+    row_elevation = elevation[stack.row_point]
+    lower = np.where(stack.lower_sfc,stack.lower,stack.lower - row_elevation)
+    upper = np.where(stack.upper_sfc,stack.upper,stack.upper - row_elevation)
+
+    row_alt = np.broadcast_to(np.asarray(alt_ft_agl,dtype=float),stack.points.shape)[stack.row_point]
+
+    ## shelves at the altitude of the point. Class values in FAA airspace do not include G. Therefore,
+    ## if a given lat,lon,alt is in Class G airspace, there is no shelf at its altitude.
+    at_altitude = stack.valid & (upper >= row_alt) & (lower <= row_alt)
+    allowed = np.isin(stack.cls,list(allowed_classes))
+
+    in_airspace = stack.any(at_altitude)
+    all_allowed = stack.all(~at_altitude | allowed)
+
+    outcome = np.full(len(stack.points),IN_OTHER_AIRSPACE,dtype=np.int8)
+    outcome[in_airspace & all_allowed] = IN_ALLOWED_AIRSPACE
+    outcome[~in_airspace] = CLASS_G
+    outcome[needs_elevation & (elevation == NO_ELEVATION)] = NO_ELEV
+
+    return outcome
@@ -1,11 +1,12 @@
 # Copyright 2020, MIT Lincoln Laboratory
 # SPDX-License-Identifier: BSD-2-Clause
-import geopandas
 import numpy as np
 from util.Geo import *
 from util.Elevation import *
 from util.Low_Risk import *
 from util.Medium_Risk import *
+from util.Features import *
+from util.Result import *
 
 def RiskClassification(lonlats_deg,data,alt_ft_agl=500,points=None):
     '''
@@ -18,7 +19,7 @@ def RiskClassification(lonlats_deg,data,alt_ft_agl=500,points=None):
     lonlats {array}: (lon,lat) array of input points.
     data {class}: class object containing referenced data.
     alt {int, float, or array}: altitude for lon lat points. If int/float specified, this altitude will be applied to all lon/lat points. If array is provided it must be the same shape as lonlats.
-    points {array}: (optional) array of shapely points. If not specified will be automatically created.
+    points {array}: (optional, not used) array of shapely points. The classification runs on the lonlats array, geometries are only created for the output dataframes.
 
     Returns:
     --------
@@ -27,64 +28,76 @@ def RiskClassification(lonlats_deg,data,alt_ft_agl=500,points=None):
 
     '''
 
-    # creating an empty status array. This will hold information as to why points are classified a particular class.
-    status = np.empty(len(lonlats_deg),dtype=object)
+    lonlats_deg = np.ascontiguousarray(lonlats_deg,dtype=float).reshape(-1,2)
 
-    # Running Low Risk Airspace function
-    low_risk,status = Low_Risk_Airspace(lonlats_deg,data,status,alt_ft_agl=alt_ft_agl,points=points)
-    print("Finished Low Risk Airspace Check...")
-    print("Starting Medium Risk Airspace Check...")
+    with Stage('classification',len(lonlats_deg)) as stage:
+        # Computing the block group, aerodrome and airspace features once. Both rule sets are evaluated from them.
+        features = extractFeatures(lonlats_deg,data,alt_ft_agl=alt_ft_agl)
+
+        risk_class,status,low_risk,lr_status = classifyFeatures(lonlats_deg,data,features)
+        stage.points_out = len(lonlats_deg)
+
+    result = RiskResult(lonlats_deg[:,0],lonlats_deg[:,1],features.alt,risk_class,status,low_risk,lr_status)
+
+    # the geometries keep the full precision of the input points.
+    # df has the columns [geometry, Risk_Class, Status, Type] with Type in LR/MR/HR, lr_df has Type in Not LR/LR
+    df,lr_df = result.toGeoDataFrames(lon=lonlats_deg[:,0],lat=lonlats_deg[:,1])
+
+
+    return df,lr_df
 
-    # combining the point geometries with the low risk output as a new column
-    combine_points_lr = np.append(points.reshape(-1,1),low_risk.reshape(-1,1),axis=1)
-    combine_status = np.append(combine_points_lr,status.reshape(-1,1),axis=1)
 
-    # creating the low risk dataframe
-    lr_df = geopandas.GeoDataFrame(combine_status,columns=['geometry','Risk_Class','Status'])
 
-    # Now creating a column with more explicit definitions for Risk Class
-    # For example, Risk Class == 0 represents Not LR airspace
-    lr_df.loc[lr_df.Risk_Class == 0,'Type'] = 'Not LR'
-    lr_df.loc[lr_df.Risk_Class == 1,'Type'] = 'LR'
+def classifyFeatures(lonlats_deg,data,features):
+    '''
+    Runs the low risk and medium risk rules on precomputed features and combines them into a risk class.
 
-    # Now lr_df is a dataframe that has the following columns: [geometry, Risk_Class, Status, Type]
 
+    Parameters:
+    -----------
+    lonlats_deg {array}: (lon,lat) array of input points.
+    data {class}: class object containing referenced data.
+    features {Features}: spatial features of the input points (see extractFeatures).
+
+    Returns:
+    --------
+    risk_class {array}: 0 (Low Risk), 1 (Medium Risk) or 2 (High Risk) for each point.
+    status {array}: status code of the reason each point is not in Low Risk (STATUS_NONE for Low Risk points).
+    low_risk {array}: 1 (Low Risk) or 0 (Not Low Risk) for each point.
+    lr_status {array}: status code of the reason each point is not in Low Risk, from the low risk rules only.
+
+    '''
+
+    # creating an empty status array. This will hold the status code (see util/Result.py) as to why points are classified a particular class.
+    status = np.zeros(len(lonlats_deg),dtype=np.int8)
+
+    # Running Low Risk Airspace function
+    low_risk,status = Low_Risk_Airspace(lonlats_deg,data,status,alt_ft_agl=features.alt,features=features)
+    stageLog("Finished Low Risk Airspace Check...")
+    stageLog("Starting Medium Risk Airspace Check...")
+
+    lr_status = status.copy()
 
 
     # We only need to check the medium risk critera for points that failed the low risk critera
     sub_lonlats = lonlats_deg[low_risk == 0]
-    sub_points = points[low_risk == 0]
     sub_status = status[low_risk == 0]
-
-
-    if np.size(alt_ft_agl) == 1:
-        sub_alt_ft_agl = alt_ft_agl
-    else:
-        sub_alt_ft_agl = alt_ft_agl[low_risk == 0]
+    sub_features = features.take(low_risk == 0)
 
 
     # Running Medium Risk Airspace function
-    med_risk,sub_status = Medium_Risk_Airspace(sub_lonlats,data,sub_status,alt_ft_agl=sub_alt_ft_agl,points=sub_points)
+    med_risk,sub_status = Medium_Risk_Airspace(sub_lonlats,data,sub_status,alt_ft_agl=sub_features.alt,features=sub_features)
 
 
+    risk_class = low_risk.copy()
     idx = np.arange(len(low_risk))
     idx_lr = idx[low_risk == 1]
 
 
     med_risk[med_risk == 0] = 2
     status[low_risk == 0] = sub_status
-    low_risk[low_risk == 0] = med_risk
-    low_risk[idx_lr] = 0
-
-
-    combine_points_lr = np.append(points.reshape(-1,1),low_risk.reshape(-1,1),axis=1)
-    combine_status = np.append(combine_points_lr,status.reshape(-1,1),axis=1)
+    risk_class[low_risk == 0] = med_risk
+    risk_class[idx_lr] = 0
 
-    df = geopandas.GeoDataFrame(combine_status,columns=['geometry','Risk_Class','Status'])
 
-    df.loc[df.Risk_Class == 0,'Type'] = 'LR'
-    df.loc[df.Risk_Class == 1,'Type'] = 'MR'
-    df.loc[df.Risk_Class == 2,'Type'] = 'HR'
-
-
-    return df,lr_df
+    return risk_class,status,low_risk,lr_status
@@ -0,0 +1,199 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import glob
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+from util.Stream import *
+from util.Output import *
+from util.Raster import *
+
+class Tile:
+    """
+    A fixed lon/lat tile of one state. Tiles are aligned to multiples of tile_deg so the same
+    tile always has the same id, and grid points are aligned to multiples of the spacing so
+    neighbouring tiles never share a point.
+
+
+    Parameters:
+    -----------
+    state {string}: state abbreviation, i.e. 'NC'.
+    i {int}: tile column, the tile covers lon [i*tile_deg, (i+1)*tile_deg).
+    j {int}: tile row, the tile covers lat [j*tile_deg, (j+1)*tile_deg).
+    tile_deg {float}: tile size in degrees.
+
+
+    """
+
+    def __init__(self, state, i, j, tile_deg):
+        self.state = state
+        self.i = int(i)
+        self.j = int(j)
+        self.tile_deg = float(tile_deg)
+
+
+    @property
+    def id(self):
+        return '{}_{}_{}'.format(self.state,self.i,self.j)
+
+
+    def lonlats(self, spacing, polygon):
+        """
+        Returns the (N,2) grid points of the tile that fall within the state polygon.
+
+
+        Parameters:
+        -----------
+        spacing {float}: distance between the points in degrees.
+        polygon {shapely geometry}: state boundary.
+
+
+        """
+
+        x0,y0 = self.i*self.tile_deg,self.j*self.tile_deg
+        kx = np.arange(int(np.ceil(x0/spacing - 1e-9)),int(np.ceil((x0 + self.tile_deg)/spacing - 1e-9)))
+        ky = np.arange(int(np.ceil(y0/spacing - 1e-9)),int(np.ceil((y0 + self.tile_deg)/spacing - 1e-9)))
+
+        x,y = np.round(kx*spacing,10),np.round(ky*spacing,10)
+        rows,cols = np.nonzero(gridMask(polygon,x,y))
+
+        return np.column_stack((x[cols],y[rows]))
+
+
+
+def stateTiles(state, polygon, tile_deg):
+    """
+    Returns the tiles that overlap a state polygon.
+
+
+    Parameters:
+    -----------
+    state {string}: state abbreviation.
+    polygon {shapely geometry}: state boundary.
+    tile_deg {float}: tile size in degrees.
+
+
+    Returns:
+    --------
+    tiles {list}: list of Tile objects.
+
+
+    """
+
+    minx,miny,maxx,maxy = polygon.bounds
+    tiles = []
+    for i in range(int(np.floor(minx/tile_deg)),int(np.floor(maxx/tile_deg)) + 1):
+        for j in range(int(np.floor(miny/tile_deg)),int(np.floor(maxy/tile_deg)) + 1):
+            x0,y0 = i*tile_deg,j*tile_deg
+            if polygon.intersects(box(x0,y0,x0 + tile_deg,y0 + tile_deg)):
+                tiles.append(Tile(state,i,j,tile_deg))
+
+    return tiles
+
+
+
+def classifyTile(tile, spacing, polygon, data, alt_ft_agl=500):
+    """
+    Classifies the grid points of one tile.
+
+
+    Parameters:
+    -----------
+    tile {Tile}: tile to classify.
+    spacing {float}: distance between the points in degrees.
+    polygon {shapely geometry}: state boundary.
+    data {class}: class object containing referenced data.
+    alt_ft_agl {float/int}: altitude for the points in AGL. Default is 500ft AGL.
+
+
+    Returns:
+    --------
+    result {RiskResult}: result of the tile.
+
+
+    """
+
+    return classifyChunk(tile.lonlats(spacing,polygon),data,alt_ft_agl=alt_ft_agl)
+
+
+
+def tilePath(tile_dir, tile):
+    return os.path.join(tile_dir,tile.state,tile.id + '.feather')
+
+
+
+def writeTile(tile_dir, tile, result):
+    """
+    Atomically writes the result of a tile. The file only appears once it is complete, so a
+    tile that exists was fully classified.
+
+
+    Parameters:
+    -----------
+    tile_dir {string}: root directory of the tile checkpoints.
+    tile {Tile}: tile that was classified.
+    result {RiskResult}: result of the tile.
+
+
+    """
+
+    path = tilePath(tile_dir,tile)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+
+    tmp = '{}.{}.tmp'.format(path,os.getpid())
+    result.toFrame().to_feather(tmp)
+    os.replace(tmp,path)
+
+
+
+def mergeTiles(tile_dir, state, writer):
+    """
+    Merges the tiles of a state into one output. The tiles are handed to the writer one at a time.
+
+
+    Parameters:
+    -----------
+    tile_dir {string}: root directory of the tile checkpoints.
+    state {string}: state abbreviation.
+    writer {object}: output writer, i.e. from resultWriter.
+
+
+    Returns:
+    --------
+    n {int}: number of points of the state.
+
+
+    """
+
+    n = 0
+    for f in sorted(glob.glob(os.path.join(tile_dir,state,'*.feather'))):
+        tile = RiskResult.fromFrame(pd.read_feather(f))
+        if len(tile) > 0:
+            writer.write(tile)
+            n += len(tile)
+
+    writer.close()
+
+    return n
+
+
+
+def stateGrid(spacing, polygon):
+    """
+    Returns the Grid of the tile grid points of a state, used for the GeoTIFF output.
+
+
+    Parameters:
+    -----------
+    spacing {float}: distance between the points in degrees.
+    polygon {shapely geometry}: state boundary.
+
+
+    """
+
+    minx,miny,maxx,maxy = polygon.bounds
+    kx0,ky0 = int(np.ceil(minx/spacing - 1e-9)),int(np.ceil(miny/spacing - 1e-9))
+    kx1,ky1 = int(np.floor(maxx/spacing + 1e-9)),int(np.floor(maxy/spacing + 1e-9))
+
+    return Grid(np.round(kx0*spacing,10),np.round(ky0*spacing,10),spacing,kx1 - kx0 + 1,ky1 - ky0 + 1)
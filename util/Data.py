@@ -0,0 +1,210 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import json
+import pickle
+import time
+import geopandas
+from util.Geo import PolygonIndex
+from util.Features import aerodromeIndex, polygonIndexes
+
+## layers of a compiled data bundle and the file each one is stored in
+BUNDLE_LAYERS = {'bg_df': 'bg.feather',
+                 'airspace': 'airspace.feather',
+                 'ap': 'ap.feather',
+                 'states_df': 'states.feather'}
+
+## polygon indexes of a compiled data bundle: the layer they index and the start of the names of their files
+BUNDLE_INDEXES = {'bg_index': ('bg_df', 'bg'),
+                  'airspace_index': ('airspace', 'airspace')}
+
+
+class Data:
+    """
+    Container for the datasets referenced by the risk classification.
+
+
+    Parameters:
+    -----------
+    bg_df {geo dataframe}: census block groups with a 'density' column.
+    airspace {geo dataframe}: FAA NASR airspace class shelves.
+    ap {geo dataframe}: FAA aerodromes.
+    states_df {geo dataframe}: US state boundaries.
+
+
+    """
+
+    def __init__(self, bg_df, airspace, ap, states_df):
+        self.bg_df = bg_df
+        self.airspace = airspace
+        self.ap = ap
+        self.states_df = states_df
+
+
+
+def readData(path_to_emcore, bg_path='data/blockgroup/processed/BG.parquet'):
+    """
+    Reads the datasets from the em-core repository and the processed block group file.
+
+
+    Parameters:
+    -----------
+    path_to_emcore {string}: path to the em-core repository.
+    bg_path {string}: path to the processed census block group file, the GeoParquet layer of python/buildBG.py or a shapefile.
+
+
+    Returns:
+    --------
+    data {Data}: class object containing referenced data.
+
+
+    """
+
+    # reading in airport data
+    ap = geopandas.read_file('{}/data/FAA-Airports/Airports.dbf'.format(path_to_emcore))
+
+    ## airspace classes
+    airspace = geopandas.read_file('{}/data/FAA-NASR/Class_Airspace.dbf'.format(path_to_emcore))
+
+    ## state shape file
+    # reading from the em-core repository
+    states_df = geopandas.read_file('{}/data/NE-Adminstrative/ne_10m_admin_1_states_provinces.dbf'.format(path_to_emcore))
+    states_df = states_df.loc[states_df.iso_a2 == 'US']  ## only want to obtain US states
+    states_df.loc[:, 'iso_3166_2'] = states_df.loc[:, 'iso_3166_2'].apply(lambda x: x[3:]) ## slicing off 'US' from 'US-state'
+    states_df.loc[:, 'fips'] = states_df.loc[:, 'fips'].apply(lambda x: x[2:]) ## slicing off 'US' from 'USfips'
+
+    ## preprocessed census block group layer
+    if bg_path.endswith('.parquet'):
+        bg_df = readBlockGroups(bg_path)
+    else:
+        bg_df = geopandas.read_file(bg_path)
+
+    return Data(bg_df, airspace, ap, states_df)
+
+
+
+def readBlockGroups(path, bbox=None):
+    """
+    Reads the block group layer written by python/buildBG.py. The layer is sorted along a Hilbert curve and
+    stores the bounds of every block group, so a bbox read only loads the row groups whose bounds overlap it.
+
+
+    Parameters:
+    -----------
+    path {string}: path to the GeoParquet layer, i.e. data/blockgroup/processed/BG.parquet.
+    bbox {tuple}: (optional) (minx,miny,maxx,maxy) box. Only the block groups whose bounds overlap it are read.
+
+
+    Returns:
+    --------
+    bg_df {geo dataframe}: block groups with the columns geometry and density.
+
+
+    """
+
+    import pyarrow.parquet as pq
+
+    bounds = ['xmin','ymin','xmax','ymax']
+    pf = pq.ParquetFile(path)
+
+    groups = []
+    for i in range(pf.num_row_groups):
+        rg = pf.metadata.row_group(i)
+        stats = {rg.column(j).path_in_schema: rg.column(j).statistics for j in range(rg.num_columns)}
+        if bbox is not None and (stats['xmin'].min > bbox[2] or stats['xmax'].max < bbox[0] or
+                                 stats['ymin'].min > bbox[3] or stats['ymax'].max < bbox[1]):
+            continue
+        groups.append(i)
+
+    df = pf.read_row_groups(groups,columns=['geometry','density'] + bounds).to_pandas()
+    if bbox is not None:
+        df = df.loc[(df.xmin <= bbox[2]) & (df.xmax >= bbox[0]) & (df.ymin <= bbox[3]) & (df.ymax >= bbox[1])]
+
+    ## crs of the GeoParquet metadata
+    geo = json.loads(pf.schema_arrow.metadata.get(b'geo',b'{}'))
+    crs = geo.get('columns',{}).get('geometry',{}).get('crs')
+
+    # decoding all of the WKB geometries in one vectorized call
+    geometry = geopandas.GeoSeries.from_wkb(df.geometry.values,crs=crs)
+
+    return geopandas.GeoDataFrame({'density': df.density.values},geometry=geometry.values,crs=crs)
+
+
+
+def compileData(data, bundle_dir):
+    """
+    Writes the datasets to a compiled bundle that loadData can read back quickly. Every layer
+    is stored as an uncompressed Feather (Arrow IPC) file so it can be memory-mapped, and the
+    aerodrome index together with the airspace class of every aerodrome is stored pickled so
+    it does not need to be rebuilt. The bounds and cell covers of the block group and airspace
+    polygon indexes (PolygonIndex) are stored as .npy files, so they can be memory-mapped too.
+
+
+    Parameters:
+    -----------
+    data {Data}: class object containing referenced data.
+    bundle_dir {string}: directory to write the bundle to. Created if it does not exist.
+
+
+    """
+
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    for name, filename in BUNDLE_LAYERS.items():
+        layer = getattr(data, name).reset_index(drop=True)
+        layer.to_feather(os.path.join(bundle_dir, filename), compression='uncompressed')
+
+    ap_index, ap_class = aerodromeIndex(data)
+    with open(os.path.join(bundle_dir, 'ap_index.pkl'), 'wb') as f:
+        pickle.dump((ap_index, ap_class), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # building the cell covers here instead of in every process that loads the bundle
+    polygonIndexes(data)
+    for name, (layer, prefix) in BUNDLE_INDEXES.items():
+        getattr(data, name).save(os.path.join(bundle_dir, prefix))
+
+    manifest = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'layers': {name: {'file': filename, 'rows': int(len(getattr(data, name)))} for name, filename in BUNDLE_LAYERS.items()},
+                'indexes': {name: {'layer': layer, 'files': prefix + '_*'} for name, (layer, prefix) in BUNDLE_INDEXES.items()}}
+    with open(os.path.join(bundle_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+
+def loadData(bundle_dir):
+    """
+    Loads a bundle written by compileData. The Feather files and the arrays of the polygon indexes
+    are memory-mapped, so processes that load the same bundle share the pages of the attribute columns,
+    the polygon bounds and the cell covers through the page cache. The WKB geometry columns are decoded
+    into shapely geometries in every process, so the polygon layers themselves are not shared, and
+    they are prepared on first use.
+
+
+    Parameters:
+    -----------
+    bundle_dir {string}: directory of the bundle.
+
+
+    Returns:
+    --------
+    data {Data}: class object containing referenced data, with data.ap_index and data.ap_class already set,
+                 and data.bg_index and data.airspace_index if the bundle has them.
+
+
+    """
+
+    layers = {name: geopandas.read_feather(os.path.join(bundle_dir, filename), memory_map=True)
+              for name, filename in BUNDLE_LAYERS.items()}
+
+    data = Data(**layers)
+
+    with open(os.path.join(bundle_dir, 'ap_index.pkl'), 'rb') as f:
+        data.ap_index, data.ap_class = pickle.load(f)
+
+    # bundles compiled before the indexes were stored build them on first use
+    for name, (layer, prefix) in BUNDLE_INDEXES.items():
+        path = os.path.join(bundle_dir, prefix)
+        if os.path.exists(path + '_bounds.npy'):
+            setattr(data, name, PolygonIndex.load(getattr(data, layer).geometry, path))
+
+    return data
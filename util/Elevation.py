@@ -1,43 +1,63 @@
 # Copyright 2020, MIT Lincoln Laboratory
 # SPDX-License-Identifier: BSD-2-Clause
+import os
+import glob
+import time
+import sqlite3
+import threading
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
 import requests
 import urllib
+import numpy as np
+from p_tqdm import p_map
+from util.Instrument import *
 
 # Session object for querying Elevation API. Predefining results in faster query.
 sess = requests.Session()
 
+# meters to feet. Airspace shelf values are in feet, DEM tiles are usually in meters.
+M_TO_FT = 3.280839895
 
-def make_remote_request(url, params):
+# value returned when no elevation could be found for a point
+NO_ELEVATION = -1000000
+
+# USGS Elevation Point Query Service
+EPQS_URL = 'https://nationalmap.gov/epqs/pqs.php'
+
+
+def make_remote_request(url, params, max_tries=5, timeout=10, backoff=0.5, max_backoff=8):
     """
-    Continually makes requests to the url until response is recieved.
+    Makes requests to the url until a response is recieved or max_tries is reached.
 
 
     Parameters:
     -----------
     url {string}: url to connect to.
     params {dict}: dictionary containing url specific parameters (i.e. lat,lon)
+    max_tries {int}: maximum number of requests made before giving up.
+    timeout {float}: timeout in seconds for each request.
+    backoff {float}: wait in seconds after the first failed request. Doubled after every failure.
+    max_backoff {float}: cap in seconds on the wait between requests.
 
 
     Returns:
     --------
-    response {object}: Response from the API call. A request is attemped for up to 500 tries.
+    response {object}: Response from the API call. None if no response was recieved in max_tries requests.
 
 
     """
 
-    response = None
-    count = 1
-    while True:
+    for count in range(max_tries):
         try:
-            response = sess.get((url + urllib.parse.urlencode(params))).json()['USGS_Elevation_Point_Query_Service']['Elevation_Query']['Elevation']
-        except:
-            count += 1
-            continue
-        break
-
+            return sess.get((url + urllib.parse.urlencode(params)),timeout=timeout).json()['USGS_Elevation_Point_Query_Service']['Elevation_Query']['Elevation']
+        except Exception:
+            if count < max_tries - 1:
+                time.sleep(min(max_backoff,backoff*2**count))
 
-
-    return response
+    return None
 
 
 
@@ -59,7 +79,7 @@ def getElevation(x):
 
     """
 
-    url = 'https://nationalmap.gov/epqs/pqs.php?'
+    url = EPQS_URL + '?'
     params = {'x': x[0],
               'y': x[1],
               'units': 'feet',
@@ -71,3 +91,560 @@ def getElevation(x):
         return '-1000000'
     else:
         return result
+
+
+
+class EPQSElevation:
+    """
+    Elevation provider backed by the USGS Elevation Point Query Service. Every point
+    is a separate blocking HTTP request spread over p_map workers. AsyncEPQSElevation
+    is usually the better choice.
+
+
+    """
+
+    def getElevations(self, lonlats_deg):
+        """
+        Retrieves the elevation for an array of points, one API request per point.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+
+
+        Returns:
+        --------
+        elevation {array}: (N,) float array of elevations in feet. Points without an answer are -1000000.
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        if lonlats_deg.shape[0] == 0:
+            return np.empty(0,dtype=float)
+
+        elevation = np.array(p_map(getElevation,list(lonlats_deg)),dtype=float)
+        addCount('elevation_requests',len(elevation))
+        addCount('elevation_failures',int((elevation == NO_ELEVATION).sum()))
+
+        return elevation
+
+
+
+class AsyncEPQSElevation:
+    """
+    Batched, concurrent elevation provider for the USGS Elevation Point Query Service.
+    Points are deduplicated and fetched with asyncio over a pooled connection, limited to
+    a number of requests in flight and a request rate. Each request has a timeout and is
+    retried with capped exponential backoff; points still without an answer when the retries
+    or the overall deadline run out are returned as -1000000.
+
+
+    Parameters:
+    -----------
+    url {string}: query service url. Can be pointed to a local server for testing.
+    concurrency {int}: maximum number of requests in flight (and pooled connections).
+    rate {float}: maximum number of requests started per second.
+    timeout {float}: timeout in seconds for each request.
+    max_retries {int}: number of retries after the first failed request of a point.
+    backoff {float}: wait in seconds after the first failed request. Doubled after every failure.
+    max_backoff {float}: cap in seconds on the wait between retries.
+    deadline {float}: (optional) budget in seconds for a whole getElevations call.
+
+
+    """
+
+    def __init__(self, url=EPQS_URL, concurrency=32, rate=100, timeout=10, max_retries=4,
+                 backoff=0.5, max_backoff=8, deadline=None):
+
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+
+
+    def getElevations(self, lonlats_deg):
+        """
+        Retrieves the elevation for an array of points.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+
+
+        Returns:
+        --------
+        elevation {array}: (N,) float array of elevations in feet. Points without an answer are -1000000.
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        if lonlats_deg.shape[0] == 0:
+            return np.empty(0,dtype=float)
+
+        unique_lonlats,inverse = np.unique(lonlats_deg,axis=0,return_inverse=True)
+
+        # running the event loop in its own thread so this also works where a loop is already running (i.e. Jupyter)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            elevation = executor.submit(self._run,unique_lonlats).result()
+        addCount('elevation_failures',int((elevation == NO_ELEVATION).sum()))
+
+        return elevation[inverse.reshape(-1)]
+
+
+    def _run(self, lonlats_deg):
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._fetchAll(lonlats_deg))
+        finally:
+            loop.close()
+
+
+    async def _fetchAll(self, lonlats_deg):
+
+        loop = asyncio.get_event_loop()
+        elevation = np.full(len(lonlats_deg),NO_ELEVATION,dtype=float)
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._next_slot = loop.time()
+        self._end = loop.time() + self.deadline if self.deadline is not None else np.inf
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = [asyncio.ensure_future(self._fetch(session,lon,lat)) for lon,lat in lonlats_deg]
+
+            timeout = self.deadline if self.deadline is not None else None
+            done,pending = await asyncio.wait(tasks,timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+        for i,task in enumerate(tasks):
+            if task in done and task.exception() is None:
+                elevation[i] = task.result()
+
+        return elevation
+
+
+    async def _waitForSlot(self):
+        # spacing out request starts to respect the request rate
+        loop = asyncio.get_event_loop()
+        slot = max(loop.time(),self._next_slot)
+        self._next_slot = slot + 1.0/self.rate
+        await asyncio.sleep(slot - loop.time())
+
+
+    async def _fetch(self, session, lon, lat):
+
+        loop = asyncio.get_event_loop()
+        params = {'x': float(lon),
+                  'y': float(lat),
+                  'units': 'feet',
+                  'output': 'json'}
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                if loop.time() >= self._end:
+                    break
+                await self._waitForSlot()
+                addCount('elevation_requests')
+                try:
+                    async with session.get(self.url,params=params,timeout=timeout) as response:
+                        payload = await response.json(content_type=None)
+                    return float(payload['USGS_Elevation_Point_Query_Service']['Elevation_Query']['Elevation'])
+                except Exception:
+                    pass
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(min(self.max_backoff,self.backoff*2**attempt))
+
+        return NO_ELEVATION
+
+
+
+class DEMTile:
+    """
+    A single memory-mapped DEM tile stored in the ESRI GridFloat format (.flt/.hdr),
+    the format the USGS 3DEP distributes its 1 and 1/3 arc-second products in.
+
+
+    Parameters:
+    -----------
+    flt_path {string}: path to the .flt file. The .hdr file must sit next to it.
+    units {string}: vertical units of the tile, 'meters' or 'feet'.
+
+
+    """
+
+    def __init__(self, flt_path, units='meters'):
+
+        header = {}
+        with open(os.path.splitext(flt_path)[0] + '.hdr') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    header[parts[0].lower()] = parts[1]
+
+        self.ncols = int(header['ncols'])
+        self.nrows = int(header['nrows'])
+        self.cellsize = float(header['cellsize'])
+        self.nodata = float(header.get('nodata_value',-9999))
+
+        # corner may be given as the lower left corner of the cell or its center
+        if 'xllcorner' in header:
+            self.xmin = float(header['xllcorner'])
+            self.ymin = float(header['yllcorner'])
+        else:
+            self.xmin = float(header['xllcenter']) - self.cellsize/2
+            self.ymin = float(header['yllcenter']) - self.cellsize/2
+
+        self.xmax = self.xmin + self.ncols*self.cellsize
+        self.ymax = self.ymin + self.nrows*self.cellsize
+
+        byteorder = '>' if header.get('byteorder','lsbfirst').lower() == 'msbfirst' else '<'
+        self.scale = M_TO_FT if units == 'meters' else 1.0
+
+        # rows are stored north to south. The file is only paged in where it is sampled.
+        self.grid = np.memmap(flt_path,dtype=byteorder + 'f4',mode='r',shape=(self.nrows,self.ncols))
+
+
+    def contains(self, lon, lat):
+        """
+        Returns a boolean mask of the lon/lat points that fall on this tile.
+
+
+        """
+        return (lon >= self.xmin) & (lon <= self.xmax) & (lat >= self.ymin) & (lat <= self.ymax)
+
+
+    def sample(self, lon, lat):
+        """
+        Bilinearly interpolates the tile at the given lon/lat points (all must be on the tile).
+
+
+        Parameters:
+        -----------
+        lon {array}: longitudes in degrees.
+        lat {array}: latitudes in degrees.
+
+
+        Returns:
+        --------
+        elevation {array}: elevations in feet. Points touching a no-data cell are NaN.
+
+
+        """
+
+        # fractional row/col measured from the center of the upper left cell
+        col = np.clip((lon - self.xmin)/self.cellsize - 0.5,0,self.ncols - 1)
+        row = np.clip((self.ymax - lat)/self.cellsize - 0.5,0,self.nrows - 1)
+
+        c0 = np.floor(col).astype(np.int64)
+        r0 = np.floor(row).astype(np.int64)
+        c1 = np.minimum(c0 + 1,self.ncols - 1)
+        r1 = np.minimum(r0 + 1,self.nrows - 1)
+        dc = col - c0
+        dr = row - r0
+
+        z00 = self.grid[r0,c0].astype(float)
+        z01 = self.grid[r0,c1].astype(float)
+        z10 = self.grid[r1,c0].astype(float)
+        z11 = self.grid[r1,c1].astype(float)
+
+        z = (z00*(1 - dc) + z01*dc)*(1 - dr) + (z10*(1 - dc) + z11*dc)*dr
+
+        nodata = (z00 == self.nodata) | (z01 == self.nodata) | (z10 == self.nodata) | (z11 == self.nodata)
+        z[nodata] = np.nan
+
+        return z*self.scale
+
+
+
+class DEMElevation:
+    """
+    Elevation provider backed by local DEM tiles. All points are sampled in one vectorized
+    call per tile; points that are not covered by any tile (or hit no-data cells) are handed
+    to the fallback provider.
+
+
+    Parameters:
+    -----------
+    dem_dir {string}: directory containing GridFloat (.flt/.hdr) tiles. Searched recursively.
+    fallback {object}: (optional) provider used for points not on a tile, i.e. AsyncEPQSElevation().
+    units {string}: vertical units of the tiles, 'meters' (3DEP default) or 'feet'.
+
+
+    """
+
+    def __init__(self, dem_dir, fallback=None, units='meters'):
+
+        fp = sorted(glob.glob(os.path.join(dem_dir,'**','*.flt'),recursive=True))
+        self.tiles = [DEMTile(f,units=units) for f in fp]
+        self.fallback = fallback
+
+
+    def getElevations(self, lonlats_deg):
+        """
+        Retrieves the elevation for an array of points.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+
+
+        Returns:
+        --------
+        elevation {array}: (N,) float array of elevations in feet. Points without an answer are -1000000.
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        lon = lonlats_deg[:,0]
+        lat = lonlats_deg[:,1]
+
+        elevation = np.full(len(lon),np.nan)
+
+        for tile in self.tiles:
+            todo = np.isnan(elevation)
+            if not todo.any():
+                break
+
+            on_tile = np.zeros(len(lon),dtype=bool)
+            on_tile[todo] = tile.contains(lon[todo],lat[todo])
+            if on_tile.any():
+                elevation[on_tile] = tile.sample(lon[on_tile],lat[on_tile])
+
+        missing = np.isnan(elevation)
+        if missing.any() and self.fallback is not None:
+            elevation[missing] = self.fallback.getElevations(lonlats_deg[missing])
+
+        elevation[np.isnan(elevation)] = NO_ELEVATION
+
+        return elevation
+
+
+
+class CachedElevation:
+    """
+    Two-level elevation cache placed in front of another provider. Lookups are keyed by
+    lon/lat quantized to resolution_deg and go through a bounded in-memory LRU, then an
+    on-disk SQLite store, and only then to the wrapped provider. The SQLite store is opened
+    in WAL mode with one connection per process and thread, so it can be shared by p_map
+    workers, by the service thread and by consecutive runs of runState.py.
+
+
+    Parameters:
+    -----------
+    provider {object}: provider used on a cache miss, i.e. DEMElevation or AsyncEPQSElevation.
+    db_path {string}: (optional) path to the SQLite file. If not specified only the in-memory level is used.
+    maxsize {int}: maximum number of entries held in the in-memory LRU.
+    resolution_deg {float}: quantization of the lon/lat key in degrees (1e-5 deg is ~1 m).
+
+
+    Notes:
+    --------
+    Points without an answer (-1000000) are never cached so that they are retried on the next run.
+    Hit counters are kept per process.
+
+
+    """
+
+    def __init__(self, provider, db_path=None, maxsize=1000000, resolution_deg=1e-5):
+
+        self.provider = provider
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.resolution_deg = resolution_deg
+
+        self.lru = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._conn = None
+        self._owner = None
+
+
+    def __getstate__(self):
+        # connections can not be shared between processes or threads, workers open their own
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_owner'] = None
+        return state
+
+
+    def _connection(self):
+
+        owner = (os.getpid(),threading.get_ident())
+        if self._conn is None or self._owner != owner:
+            self._conn = sqlite3.connect(self.db_path,timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS elevation (key INTEGER PRIMARY KEY, elevation REAL)')
+            self._conn.commit()
+            self._owner = owner
+
+        return self._conn
+
+
+    def keys(self, lonlats_deg):
+        """
+        Returns the integer cache key for each lon/lat point.
+
+
+        """
+        q = np.round(np.asarray(lonlats_deg,dtype=float).reshape(-1,2)/self.resolution_deg).astype(np.int64)
+
+        # latitude needs 25 bits at 1e-5 deg, longitude is placed above it
+        return q[:,0]*(2**25) + (q[:,1] + 2**24)
+
+
+    def getElevations(self, lonlats_deg):
+        """
+        Retrieves the elevation for an array of points, going to the wrapped provider only for cache misses.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+
+
+        Returns:
+        --------
+        elevation {array}: (N,) float array of elevations in feet. Points without an answer are -1000000.
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        keys = self.keys(lonlats_deg)
+        elevation = np.full(len(keys),np.nan)
+
+        ## Level 1: in-memory LRU
+        for i,k in enumerate(keys.tolist()):
+            value = self.lru.get(k)
+            if value is not None:
+                self.lru.move_to_end(k)
+                elevation[i] = value
+        self.memory_hits += int((~np.isnan(elevation)).sum())
+        addCount('elevation_cache_hits',int((~np.isnan(elevation)).sum()))
+
+        ## Level 2: on-disk store
+        todo = np.flatnonzero(np.isnan(elevation))
+        if len(todo) > 0 and self.db_path is not None:
+            conn = self._connection()
+            found = {}
+            unique_keys = np.unique(keys[todo]).tolist()
+
+            # SQLite limits the number of bound parameters per statement
+            for j in range(0,len(unique_keys),500):
+                chunk = unique_keys[j:j + 500]
+                query = 'SELECT key, elevation FROM elevation WHERE key IN ({})'.format(','.join('?'*len(chunk)))
+                found.update(conn.execute(query,chunk).fetchall())
+
+            for i in todo:
+                value = found.get(int(keys[i]))
+                if value is not None:
+                    elevation[i] = value
+                    self._remember(int(keys[i]),value)
+            self.disk_hits += len(todo) - int(np.isnan(elevation[todo]).sum())
+            addCount('elevation_cache_hits',len(todo) - int(np.isnan(elevation[todo]).sum()))
+
+        ## Level 3: wrapped provider, each distinct key is only looked up once
+        todo = np.flatnonzero(np.isnan(elevation))
+        if len(todo) > 0:
+            self.misses += len(todo)
+            addCount('elevation_cache_misses',len(todo))
+            unique_keys,first,inverse = np.unique(keys[todo],return_index=True,return_inverse=True)
+            fetched = np.asarray(self.provider.getElevations(lonlats_deg[todo[first]]),dtype=float)
+            elevation[todo] = fetched[inverse]
+
+            valid = fetched != NO_ELEVATION
+            rows = list(zip(unique_keys[valid].tolist(),fetched[valid].tolist()))
+            for k,value in rows:
+                self._remember(k,value)
+
+            if self.db_path is not None and len(rows) > 0:
+                conn = self._connection()
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO elevation (key, elevation) VALUES (?,?)',rows)
+
+        return elevation
+
+
+    def _remember(self, key, value):
+
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+
+    def summary(self):
+        """
+        Returns a one line report of the cache hit rate.
+
+
+        """
+        total = self.memory_hits + self.disk_hits + self.misses
+        rate = 100*(self.memory_hits + self.disk_hits)/total if total > 0 else 0
+
+        return "Elevation cache: {} lookups | {} memory hits | {} disk hits | {} misses | hit rate {:.1f}%".format(
+            total,self.memory_hits,self.disk_hits,self.misses,rate)
+
+
+
+## Provider used by the airspace checks. Defaults to the USGS API, use setElevationProvider to
+## switch to local DEM tiles, i.e. setElevationProvider(DEMElevation(dem_dir,fallback=AsyncEPQSElevation())),
+## and wrap it in CachedElevation to keep answers between checks and between runs.
+elevation_provider = AsyncEPQSElevation()
+
+
+def setElevationProvider(provider):
+    """
+    Sets the elevation provider used by getElevations.
+
+
+    Parameters:
+    -----------
+    provider {object}: any object with a getElevations(lonlats_deg) method.
+
+
+    """
+    global elevation_provider
+    elevation_provider = provider
+
+
+
+def getElevations(lonlats_deg):
+    """
+    Retrieves the elevation for an array of lon/lat points from the current elevation provider.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+
+
+    Returns:
+    --------
+    elevation {array}: (N,) float array of elevations in feet. Points without an answer are -1000000.
+
+
+    """
+    addCount('elevation_calls')
+    addCount('elevation_points',len(lonlats_deg))
+
+    return elevation_provider.getElevations(lonlats_deg)
@@ -0,0 +1,288 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import numpy as np
+import pandas as pd
+from util.Geo import *
+from util.Elevation import *
+from util.Airspace import *
+
+
+# distance to aerodromes used by the low risk and medium risk rules
+AERODROME_NM = 5
+
+## columns of the airspace layer carried into the shelf stack
+SHELF_COLUMNS = ['CLASS','LOWER_VAL','LOWER_CODE','UPPER_VAL','UPPER_CODE']
+
+
+class Features:
+    """
+    Spatial features of a set of lon/lat/alt points that the low risk and medium risk rules
+    are evaluated from. Computing them once lets both rule sets share the block group join,
+    the aerodrome search and the airspace join.
+
+
+    Attributes:
+    -----------
+    lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+    alt {array}: (N,) altitude of every point in AGL.
+    density {array}: (N,) population density of the block group containing the point (NaN outside of all block groups).
+    d_ap {array}: (N,) distance to the closest aerodrome in nautical miles.
+    near_bcd {array}: (N,) True where an aerodrome in class B, C or D airspace is closer than 5 nm.
+    near_efg {array}: (N,) True where an aerodrome in class E, F or G airspace is closer than 5 nm.
+    stack {AirspaceStack}: airspace shelves above every point.
+    elevation {array}: (N,) elevation in feet, looked up on demand (NaN until then).
+
+
+    """
+
+    def __init__(self, lonlats_deg, alt, density, d_ap, near_bcd, near_efg, stack, elevation=None):
+
+        self.lonlats_deg = lonlats_deg
+        self.alt = alt
+        self.density = density
+        self.d_ap = d_ap
+        self.near_bcd = near_bcd
+        self.near_efg = near_efg
+        self.stack = stack
+
+        if elevation is None:
+            elevation = np.full(len(lonlats_deg),np.nan)
+        self.elevation = elevation
+
+
+    def __len__(self):
+        return len(self.lonlats_deg)
+
+
+    def take(self, mask):
+        """
+        Returns the features of a subset of the points.
+
+
+        Parameters:
+        -----------
+        mask {array}: boolean array selecting the points to keep.
+
+
+        Returns:
+        --------
+        features {Features}: features of the selected points.
+
+
+        """
+
+        return Features(self.lonlats_deg[mask],self.alt[mask],self.density[mask],self.d_ap[mask],self.near_bcd[mask],
+                        self.near_efg[mask],self.stack.take(mask),self.elevation[mask].copy())
+
+
+    def airspaceOutcome(self, idx, allowed_classes=()):
+        """
+        Evaluates the airspace shelves at the altitude of a subset of the points, looking up
+        elevation in one batch for the points that need it and do not have it yet.
+
+
+        Parameters:
+        -----------
+        idx {array}: indices of the points to evaluate.
+        allowed_classes {list}: airspace classes that are allowed at the altitude, i.e. ['B','C','D','E'].
+
+
+        Returns:
+        --------
+        outcome {array}: int8 array, one per index, of CLASS_G, IN_ALLOWED_AIRSPACE, IN_OTHER_AIRSPACE or NO_ELEV.
+
+
+        """
+
+        needs_elevation = self.stack.needsElevation()
+        todo = idx[needs_elevation[idx] & np.isnan(self.elevation[idx])]
+        if len(todo) > 0:
+            self.elevation[todo] = getElevations(self.lonlats_deg[todo])
+
+        outcome = verticalAirspace(self.stack,self.alt,self.elevation,allowed_classes)
+
+        return outcome[idx]
+
+
+
+def airspaceRows(airspace, point_idx, shelf_idx, n):
+    """
+    Returns the airspace shelves above a set of points in the layout of sjoin(points,airspace,how='left'),
+    ready for AirspaceStack.
+
+
+    Parameters:
+    -----------
+    airspace {geo dataframe}: FAA airspace class shelves.
+    point_idx {array}: point of every (point, shelf) pair.
+    shelf_idx {array}: position of the shelf in airspace of every pair.
+    n {int}: number of points.
+
+
+    Returns:
+    --------
+    aspace_df {dataframe}: one row per (point, shelf) with column 'number' and the shelf columns,
+                           plus an empty row for every point that is under no shelf.
+
+
+    """
+
+    aspace_df = airspace.iloc[shelf_idx].loc[:,SHELF_COLUMNS].reset_index(drop=True)
+    aspace_df.insert(0,'number',point_idx)
+
+    # points under no airspace get one empty row, as in a left join
+    uncovered = np.setdiff1d(np.arange(n),point_idx)
+    empty = pd.DataFrame({'number': uncovered})
+    for column in SHELF_COLUMNS:
+        empty[column] = np.full(len(uncovered),np.nan)
+
+    return pd.concat([aspace_df,empty],ignore_index=True)
+
+
+
+def aerodromeIndex(data):
+    """
+    Returns the aerodrome index of a data object and the lowest airspace class at every
+    aerodrome. Both are built on first use and kept on the data object (data.ap_index,
+    data.ap_class), so they are only built once per dataset load.
+
+
+    Parameters:
+    -----------
+    data {class}: class containing relevant data for processing.
+
+
+    Returns:
+    --------
+    ap_index {AerodromeIndex}: index of data.ap.
+    ap_class {array}: lowest airspace class at each aerodrome, in the row order of data.ap (NaN if not under airspace).
+
+
+    """
+
+    if getattr(data,'ap_index',None) is None:
+        ap = data.ap.reset_index(drop=True)
+        ap_index = AerodromeIndex(ap)
+
+        _,airspace_index = polygonIndexes(data)
+        point_idx,shelf_idx = pointsInPolygons(ap_index.lonlats,airspace_index)
+        airport_class = pd.Series(data.airspace.CLASS.values[shelf_idx],index=point_idx)
+
+        data.ap_class = airport_class.groupby(level=0).min().reindex(np.arange(len(ap))).values
+        data.ap_index = ap_index
+
+    return data.ap_index,data.ap_class
+
+
+
+def polygonIndexes(data):
+    """
+    Returns the polygon indexes of the block group and airspace layers of a data object. Both are built
+    on first use and kept on the data object (data.bg_index, data.airspace_index).
+
+
+    Parameters:
+    -----------
+    data {class}: class containing relevant data for processing.
+
+
+    Returns:
+    --------
+    bg_index {PolygonIndex}: index of data.bg_df.
+    airspace_index {PolygonIndex}: index of data.airspace.
+
+
+    """
+
+    if getattr(data,'bg_index',None) is None:
+        data.bg_index = PolygonIndex(data.bg_df.geometry)
+    if getattr(data,'airspace_index',None) is None:
+        data.airspace_index = PolygonIndex(data.airspace.geometry)
+
+    return data.bg_index,data.airspace_index
+
+
+
+def aerodromeFeatures(lonlats_deg, data):
+    """
+    Computes the aerodrome features of every point: the distance to the closest aerodrome
+    and whether any aerodrome closer than 5 nm is in class B/C/D or class E/F/G airspace.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+    data {class}: class containing relevant data for processing.
+
+
+    Returns:
+    --------
+    d_ap {array}: (N,) distance to the closest aerodrome in nautical miles.
+    near_bcd {array}: (N,) True where an aerodrome in class B, C or D airspace is closer than 5 nm.
+    near_efg {array}: (N,) True where an aerodrome in class E, F or G airspace is closer than 5 nm.
+
+
+    """
+
+    n = len(lonlats_deg)
+    ap_index,ap_class = aerodromeIndex(data)
+    d_ap,_ = ap_index.nearest(lonlats_deg)
+
+    point_idx,ap_idx,d = ap_index.within(lonlats_deg,AERODROME_NM)
+    point_idx,ap_idx = point_idx[d < AERODROME_NM],ap_idx[d < AERODROME_NM]
+
+    near_bcd = np.zeros(n,dtype=bool)
+    near_bcd[point_idx[np.isin(ap_class[ap_idx],['B','C','D'])]] = True
+    near_efg = np.zeros(n,dtype=bool)
+    near_efg[point_idx[np.isin(ap_class[ap_idx],['E','F','G'])]] = True
+
+    return d_ap,near_bcd,near_efg
+
+
+
+def extractFeatures(lonlats_deg, data, alt_ft_agl=500, points=None):
+    """
+    Computes the spatial features used by the low risk and medium risk rules for every point.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: array of lon/lat points in degrees.
+    data {class}: class containing relevant data for processing.
+    alt_ft_agl {float/int or array}: altitude for lon/lat points in AGL. Default is 500ft AGL.
+    points {array}: (optional, not used) array of shapely points. The features are computed from lonlats_deg.
+
+
+    Returns:
+    --------
+    features {Features}: features of every input point.
+
+
+    """
+
+    lonlats_deg = np.ascontiguousarray(lonlats_deg,dtype=float).reshape(-1,2)
+    n = len(lonlats_deg)
+
+    alt = np.broadcast_to(np.asarray(alt_ft_agl,dtype=float),(n,)).copy()
+
+
+    with Stage('features',n,title="Feature Extraction"):
+
+        bg_index,airspace_index = polygonIndexes(data)
+
+        ## census block group density. A point in overlapping block groups takes the highest density, a point on a block group boundary is in none.
+        with Stage('features.density',n):
+            point_idx,bg_idx = pointsInPolygons(lonlats_deg,bg_index)
+            density = np.full(n,np.nan)
+            np.fmax.at(density,point_idx,data.bg_df.density.values.astype(float)[bg_idx])
+
+        ## distance to the closest aerodrome, and the airspace classes of every aerodrome closer than 5 nm
+        with Stage('features.aerodrome',n):
+            d_ap,near_bcd,near_efg = aerodromeFeatures(lonlats_deg,data)
+
+        ## airspace shelves above every point
+        with Stage('features.airspace',n):
+            point_idx,shelf_idx = pointsInPolygons(lonlats_deg,airspace_index)
+            stack = AirspaceStack(airspaceRows(data.airspace,point_idx,shelf_idx,n))
+
+    return Features(lonlats_deg,alt,density,d_ap,near_bcd,near_efg,stack)
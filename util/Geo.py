@@ -1,10 +1,16 @@
 # Copyright 2020, MIT Lincoln Laboratory
 # SPDX-License-Identifier: BSD-2-Clause
-from shapely.ops import cascaded_union
+import os
+import json
+from shapely.ops import unary_union
 from geopy.distance import distance
 import numpy as np
 import numba as nb
 from scipy.spatial import cKDTree
+from scipy import ndimage
+from shapely.vectorized import contains
+from shapely.prepared import prep
+from util.Instrument import *
 
 def generate_grid_in_polygon(spacing, polygon):
     """
@@ -26,23 +32,17 @@ def generate_grid_in_polygon(spacing, polygon):
     """
 
     # Convert the GeoDataFrame to a single polygon
-    poly_in = cascaded_union([poly for poly in polygon.geometry])
+    poly_in = unary_union(list(polygon.geometry))
 
-    # Get the bounds of the polygon
-    minx, miny, maxx, maxy = poly_in.bounds
-
-    # Now generate the entire grid
-    x_coords = list(np.arange(np.floor(minx), int(np.ceil(maxx)), spacing))
-    y_coords = list(np.arange(np.floor(miny), int(np.ceil(maxy)), spacing))
+    x_coords,y_coords = gridAxes(spacing,poly_in.bounds)
 
     return poly_in,np.meshgrid(x_coords, y_coords)
 
 
 
-@nb.njit()
 def getLatLons(xcoord,ycoord):
     """
-    Returns a list of lon/lats for an input meshgrid.
+    Returns the lon/lats of an input meshgrid.
 
 
     Parameters:
@@ -52,17 +52,514 @@ def getLatLons(xcoord,ycoord):
 
     Returns:
     --------
-    lonlats {list}: A list of lon/lat coordinates.
+    lonlats {array}: (N,2) contiguous array of lon/lat coordinates.
+
+
+    """
+
+    return np.column_stack((np.ravel(xcoord),np.ravel(ycoord)))
+
+
+
+def gridAxes(spacing, bounds):
+    """
+    Returns the longitudes and latitudes of the grid over a (minx,miny,maxx,maxy) box: from the
+    whole degree below the box to the whole degree above it, every spacing degrees.
+
+
+    """
+
+    minx, miny, maxx, maxy = bounds
+
+    x = np.arange(np.floor(minx), int(np.ceil(maxx)), spacing)
+    y = np.arange(np.floor(miny), int(np.ceil(maxy)), spacing)
+
+    return x,y
+
+
+
+def polygonEdges(polygon):
+    """
+    Returns the edges of every ring (exteriors and holes) of a polygon or multipolygon.
+
+
+    Returns:
+    --------
+    edges {array}: (E,4) array of x1,y1,x2,y2.
+
+
+    """
+
+    rings = []
+    for part in getattr(polygon,'geoms',[polygon]):
+        if part.is_empty or not hasattr(part,'exterior'):
+            continue
+        for ring in [part.exterior] + list(part.interiors):
+            xy = np.asarray(ring.coords,dtype=float)[:,:2]
+            rings.append(np.column_stack((xy[:-1],xy[1:])))
+
+    if len(rings) == 0:
+        return np.empty((0,4))
+
+    return np.concatenate(rings)
+
+
+
+def gridMask(polygon, x, y, tol=1e-9):
+    """
+    Batched point-in-polygon test of the grid x by y, by scanline rasterization: the crossings of every
+    grid row with the polygon edges are computed at once and the cells between each pair of crossings
+    are filled. Cells within tol of a crossing, and rows within tol of a vertex, are decided with
+    shapely.vectorized.contains instead, so the mask is the same as contains(polygon, lon, lat):
+    points on the boundary are outside.
+
+
+    Parameters:
+    -----------
+    polygon {shapely geometry}: polygon or multipolygon, i.e. the union of a state.
+    x {array}: (nx,) increasing longitudes of the grid.
+    y {array}: (ny,) increasing latitudes of the grid.
+    tol {float}: distance in degrees under which a cell is tested exactly.
+
+
+    Returns:
+    --------
+    mask {array}: (ny,nx) boolean array, True for the cells inside the polygon.
+
+
+    """
+
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    nx,ny = len(x),len(y)
+
+    edges = polygonEdges(polygon)
+    x1,y1,x2,y2 = edges.T
+    edges = edges[y1 != y2]
+    x1,y1,x2,y2 = edges.T
+
+    ## rows crossed by each edge, half-open in y so that a vertex is only counted once
+    ylo,yhi = np.minimum(y1,y2),np.maximum(y1,y2)
+    r0 = np.searchsorted(y,ylo,side='left')
+    r1 = np.searchsorted(y,yhi,side='left')
+    counts = r1 - r0
+
+    edge = np.repeat(np.arange(len(edges)),counts)
+    row = np.repeat(r0,counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,counts))
+    xc = x1[edge] + (y[row] - y1[edge])*(x2[edge] - x1[edge])/(y2[edge] - y1[edge])
+
+    ## even-odd filling between consecutive crossings of every row
+    order = np.lexsort((xc,row))
+    row,xc = row[order],xc[order]
+    c0 = np.searchsorted(x,xc[0::2],side='right')
+    c1 = np.searchsorted(x,xc[1::2],side='left')
+
+    fill = np.zeros((ny,nx + 1),dtype=np.int8)
+    np.add.at(fill,(row[0::2],c0),1)
+    np.add.at(fill,(row[1::2],c1),-1)
+    mask = np.cumsum(fill[:,:nx],axis=1,dtype=np.int8) > 0
+
+    ## cells too close to the boundary for the scanline to decide
+    lo = np.searchsorted(x,xc - tol,side='left')
+    hi = np.searchsorted(x,xc + tol,side='right')
+    n = hi - lo
+    near_row = np.repeat(row,n)
+    near_col = np.repeat(lo,n) + (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n,n))
+
+    vertex_y = np.unique(edges[:,[1,3]])
+    near_vertex = np.searchsorted(vertex_y,y - tol,side='left') != np.searchsorted(vertex_y,y + tol,side='right')
+
+    check = np.zeros((ny,nx),dtype=bool)
+    check[near_row,near_col] = True
+    check[near_vertex] = True
+
+    rows,cols = np.nonzero(check)
+    if len(rows) > 0:
+        mask[rows,cols] = contains(polygon,x[cols],y[rows])
+
+    return mask
+
+
+
+def gridLonLats(spacing, polygon):
+    """
+    Returns the grid points within a polygon: the points of generate_grid_in_polygon, in the same order,
+    that are inside the polygon. Built from the grid axes and gridMask without creating the full meshgrid
+    as Python objects.
+
+
+    Parameters:
+    -----------
+    spacing {float}: distance between the points in coordinate units.
+    polygon {geo dataframe or shapely geometry}: boundary to generate points within.
+
+
+    Returns:
+    --------
+    lonlats {array}: (N,2) contiguous array of lon/lat points.
+
+
+    """
+
+    if hasattr(polygon,'geometry'):
+        polygon = unary_union(list(polygon.geometry))
+
+    x,y = gridAxes(spacing,polygon.bounds)
+    rows,cols = np.nonzero(gridMask(polygon,x,y))
+
+    return np.column_stack((x[cols],y[rows]))
+
+
+
+## number of fine cells of a CellCover over the bounds of its layer, number of fine cells along the side
+## of a coarse cell, and number of points from which pointsInPolygons builds the cover of a layer
+COVER_CELLS = 2**24
+COVER_BLOCK = 16
+COVER_MIN_POINTS = 100000
+
+## codes of the cells of a CellCover that are not inside exactly one polygon
+COVER_EXTERIOR = -1
+COVER_BOUNDARY = -2
+
+
+class CellCover:
+    """
+    Two-tier cell cover of a polygon layer. The bounds of the layer are split into square fine cells, and
+    every fine cell is either inside exactly one polygon (code: the position of the polygon), outside of
+    every polygon (COVER_EXTERIOR), or crossed by a boundary or inside several polygons (COVER_BOUNDARY).
+    Fine cells are stored by blocks of COVER_BLOCK x COVER_BLOCK coarse cells: a coarse cell whose fine
+    cells all have the same code keeps only that code. Points in interior and exterior cells are resolved
+    by looking up the code of their cell; only the points in boundary cells need an exact test.
+
+    Boundary cells are found by walking every edge (holes included) in steps of half a cell and marking the
+    cells of consecutive steps and the two cells diagonal between them, so that every cell a boundary
+    touches is marked. The other cells are grouped into connected components, which no boundary crosses,
+    and every component takes the polygons of the center of one of its cells. Cells are computed from the
+    coordinates with the same floor for the edges and the points, so a point on a boundary is always in a
+    boundary cell and the pairs are the same as with contains: points on an edge are not inside.
+
+
+    Parameters:
+    -----------
+    index {PolygonIndex}: polygons of the layer.
+    cells {int}: number of fine cells over the bounds of the layer.
+    block {int}: number of fine cells along the side of a coarse cell.
+
+
+    """
+
+    def __init__(self, index, cells=COVER_CELLS, block=COVER_BLOCK):
+        ## bounds of the layer, without the empty geometries
+        bounds = index.bounds[np.isfinite(index.bounds).all(axis=1)].reshape(-1,4)
+        minx,miny,maxx,maxy = np.r_[bounds[:,:2].min(axis=0),bounds[:,2:].max(axis=0)] if len(bounds) > 0 else (0.0,0.0,0.0,0.0)
+        w,h = maxx - minx,maxy - miny
+
+        self.x0,self.y0 = minx,miny
+        self.size = max(np.sqrt(w*h/cells),max(w,h)/cells,1e-9)
+        self.block = block
+
+        nx = int(np.ceil((self._cell(maxx,self.x0) + 1)/block))*block
+        ny = int(np.ceil((self._cell(maxy,self.y0) + 1)/block))*block
+
+        ## fine cells a boundary passes through, marked by chunks of about a million edges
+        boundary = np.zeros((ny,nx),dtype=bool)
+        edges,count = [],0
+        for geometry in index.geometries:
+            edges.append(polygonEdges(geometry))
+            count += len(edges[-1])
+            if count >= 2**20:
+                self._mark(boundary,np.concatenate(edges))
+                edges,count = [],0
+        self._mark(boundary,np.concatenate(edges + [np.empty((0,4))]))
+
+        ## every component of the other cells is inside or outside of each polygon as a whole
+        labels,n = ndimage.label(~boundary)
+        flat = labels.ravel()
+        cell = np.zeros(n + 1,dtype=np.int64)
+        cell[flat] = np.arange(len(flat))
+        cell = cell[1:]
+
+        centers = np.column_stack((self.x0 + (cell % nx + 0.5)*self.size,self.y0 + (cell//nx + 0.5)*self.size))
+        point_idx,geom_idx = pointsInPolygons(centers,index,exact=True)
+        inside = np.bincount(point_idx,minlength=n)
+
+        code = np.full(n + 1,COVER_BOUNDARY,dtype=np.int32)
+        code[1:][inside == 0] = COVER_EXTERIOR
+        single = np.flatnonzero(inside[point_idx] == 1)
+        code[1 + point_idx[single]] = geom_idx[single]
+
+        ## storing uniform coarse cells as one code
+        fine = code[labels].reshape(ny//block,block,nx//block,block).transpose(0,2,1,3).reshape(ny//block,nx//block,block*block)
+        uniform = (fine == fine[:,:,:1]).all(axis=2)
+
+        self.coarse = fine[:,:,0].copy()
+        self.blocks = fine[~uniform]
+        self.refined = np.full(uniform.shape,-1,dtype=np.int64)
+        self.refined[~uniform] = np.arange(len(self.blocks))
+
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Reads a cover written by save. The arrays are memory-mapped, so processes that load the same
+        cover share its pages through the page cache.
+
+
+        """
+
+        cover = cls.__new__(cls)
+        with open(path + '_cover.json') as f:
+            meta = json.load(f)
+        cover.x0,cover.y0,cover.size,cover.block = meta['x0'],meta['y0'],meta['size'],meta['block']
+        for k in ('coarse','blocks','refined'):
+            setattr(cover,k,np.load('{}_cover_{}.npy'.format(path,k),mmap_mode=mmap_mode))
+
+        return cover
+
+
+    def save(self, path):
+        """
+        Writes the cover to .npy files and a .json file whose names start with path, i.e. bundle/bg.
+
+
+        """
+
+        for k in ('coarse','blocks','refined'):
+            np.save('{}_cover_{}.npy'.format(path,k),getattr(self,k))
+        with open(path + '_cover.json','w') as f:
+            json.dump({'x0': float(self.x0),'y0': float(self.y0),'size': float(self.size),'block': int(self.block)},f)
+
+
+    def _cell(self, v, v0):
+        return np.floor((np.asarray(v,dtype=float) - v0)/self.size).astype(np.int64)
+
+
+    def _mark(self, boundary, edges):
+        ny,nx = boundary.shape
+        if len(edges) == 0:
+            return
+
+        x1,y1,x2,y2 = edges.T
+        pieces = np.maximum(np.ceil(2*np.maximum(np.abs(x2 - x1),np.abs(y2 - y1))/self.size),1).astype(np.int64)
+        edge = np.repeat(np.arange(len(edges)),pieces + 1)
+        t = (np.arange(len(edge)) - np.repeat(np.cumsum(pieces + 1) - (pieces + 1),pieces + 1))/pieces[edge]
+        ci = np.clip(self._cell(x1[edge] + t*(x2[edge] - x1[edge]),self.x0),0,nx - 1)
+        cj = np.clip(self._cell(y1[edge] + t*(y2[edge] - y1[edge]),self.y0),0,ny - 1)
+
+        ## a step crosses at most one column and one row of cells, through one of the two diagonal cells
+        step = np.flatnonzero(edge[1:] == edge[:-1])
+        boundary[cj,ci] = True
+        boundary[cj[step + 1],ci[step]] = True
+        boundary[cj[step],ci[step + 1]] = True
+
+
+    def lookup(self, x, y):
+        """
+        Returns the code of the cell of every point: the position of the polygon it is inside of,
+        COVER_EXTERIOR or COVER_BOUNDARY. Points outside of the bounds of the layer are exterior.
+
+
+        """
+
+        ci = self._cell(x,self.x0)
+        cj = self._cell(y,self.y0)
+        ny,nx = self.coarse.shape
+        ok = np.flatnonzero((ci >= 0) & (ci < nx*self.block) & (cj >= 0) & (cj < ny*self.block))
+        ci,cj = ci[ok],cj[ok]
+
+        code = np.full(len(np.atleast_1d(x)),COVER_EXTERIOR,dtype=np.int32)
+        c = self.coarse[cj//self.block,ci//self.block]
+        b = self.refined[cj//self.block,ci//self.block]
+        fine = b >= 0
+        c[fine] = self.blocks[b[fine],(cj[fine] % self.block)*self.block + ci[fine] % self.block]
+        code[ok] = c
+
+        return code
+
+
+
+class PolygonIndex:
+    """
+    Bounds, prepared geometries and cell cover (CellCover) of a set of polygons, kept between
+    pointsInPolygons calls so that repeated queries against the same layer do not recompute them.
+    Geometries are prepared on first use. The cover is built by the first join of at least
+    COVER_MIN_POINTS points, or by prepareAll(cover=True), and then used by every join.
+
+
+    Parameters:
+    -----------
+    geometries {geo series}: polygons to index, i.e. data.bg_df.geometry.
+    bounds {array}: (optional) (N,4) bounds of the geometries, i.e. from a saved index. Computed if not given.
+    cover {CellCover}: (optional) cell cover of the geometries, i.e. from a saved index.
 
 
     """
-    lonlats = []
 
-    for x in zip(xcoord.flatten(), ycoord.flatten()):
-        lonlats.append(x)
+    def __init__(self, geometries, bounds=None, cover=None):
+        self.geometries = list(geometries)
+        if bounds is None:
+            bounds = geometries.bounds.values
+        self.bounds = np.asarray(bounds,dtype=float).reshape(-1,4)
+        self._prepared = [None]*len(self.geometries)
+        self._cover = cover
+
+
+    def __len__(self):
+        return len(self.geometries)
+
+
+    def prepared(self, i):
+        if self._prepared[i] is None:
+            self._prepared[i] = prep(self.geometries[i])
+        return self._prepared[i]
+
+
+    @property
+    def covered(self):
+        return self._cover is not None
+
+
+    def cover(self):
+        if self._cover is None:
+            self._cover = CellCover(self)
+        return self._cover
+
+
+    def prepareAll(self, cover=False):
+        """
+        Prepares every geometry now instead of on first use, and builds the cell cover if cover is True.
+
+
+        """
+        for i in range(len(self.geometries)):
+            self.prepared(i)
+        if cover and len(self.geometries) > 0:
+            self.cover()
+
+
+    @classmethod
+    def load(cls, geometries, path, mmap_mode='r'):
+        """
+        Reads the bounds and cell cover written by save for the same geometries, in the same order.
+        The arrays are memory-mapped. The geometries are prepared on first use.
+
+
+        Parameters:
+        -----------
+        geometries {geo series}: the polygons the index was saved for.
+        path {string}: start of the file names given to save.
+        mmap_mode {string}: memory-map mode of the arrays, None to read them into memory.
+
+
+        Returns:
+        --------
+        index {PolygonIndex}: index of the geometries.
 
 
-    return lonlats
+        """
+
+        bounds = np.load(path + '_bounds.npy',mmap_mode=mmap_mode)
+        if len(bounds) != len(geometries):
+            raise ValueError('{} has the bounds of {} polygons, not {}'.format(path,len(bounds),len(geometries)))
+
+        cover = CellCover.load(path,mmap_mode=mmap_mode) if os.path.exists(path + '_cover.json') else None
+
+        return cls(geometries,bounds=bounds,cover=cover)
+
+
+    def save(self, path):
+        """
+        Writes the bounds and the cell cover of the index, built first if needed, to files whose names
+        start with path, i.e. bundle/bg. Prepared geometries can not be written.
+
+
+        """
+
+        np.save(path + '_bounds.npy',self.bounds)
+        if len(self.geometries) > 0:
+            self.cover().save(path)
+
+
+
+def pointsInPolygons(lonlats_deg, geometries, exact=False):
+    """
+    Vectorized point-in-polygon join of lon/lat arrays against a set of polygons. Gives the same pairs as
+    sjoin(points,polygons,op='within') (points on an edge are not inside) without building shapely points.
+    With a PolygonIndex, the points in the interior and exterior cells of its cell cover (CellCover) are
+    resolved from the cover, and only the points in boundary cells are tested against the geometries.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+    geometries {geo series or PolygonIndex}: polygons to test, i.e. data.bg_df.geometry.
+    exact {bool}: test every point against the geometries, without the cell cover.
+
+
+    Returns:
+    --------
+    point_idx {array}: index of the point of every (point, polygon) pair, sorted.
+    geom_idx {array}: position of the polygon (0..len(geometries)-1) of every pair.
+
+
+    """
+
+    lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+    x,y = lonlats_deg[:,0],lonlats_deg[:,1]
+
+    point_idx = [np.empty(0,dtype=np.int64)]
+    geom_idx = [np.empty(0,dtype=np.int64)]
+
+    if len(x) == 0 or len(geometries) == 0:
+        return point_idx[0],geom_idx[0]
+
+    if not isinstance(geometries,PolygonIndex):
+        geometries = PolygonIndex(geometries)
+
+    addCount('join_points',len(x))
+
+    ## points inside exactly one polygon or outside of all of them are resolved by the cell cover
+    todo = np.arange(len(x))
+    if not exact and (geometries.covered or len(x) >= COVER_MIN_POINTS):
+        code = geometries.cover().lookup(x,y)
+        inside = np.flatnonzero(code >= 0)
+        point_idx.append(inside)
+        geom_idx.append(code[inside].astype(np.int64))
+        todo = np.flatnonzero(code == COVER_BOUNDARY)
+        addCount('join_cover_points',len(x) - len(todo))
+
+    ## points without coordinates are in no polygon
+    todo = todo[np.isfinite(x[todo]) & np.isfinite(y[todo])]
+    if len(todo) > 0:
+        ## points sorted by longitude, so the points within the bounds of a polygon are one slice plus a latitude test
+        order = todo[np.argsort(x[todo],kind='stable')]
+        xs = x[order]
+        ymin,ymax = y[todo].min(),y[todo].max()
+
+        ## only the polygons whose bounds overlap the points need to be tested
+        bounds = geometries.bounds
+        overlap = (bounds[:,2] >= xs[0]) & (bounds[:,0] <= xs[-1]) & (bounds[:,3] >= ymin) & (bounds[:,1] <= ymax)
+
+        for i in np.flatnonzero(overlap):
+            minx,miny,maxx,maxy = bounds[i]
+            cand = order[np.searchsorted(xs,minx,side='left'):np.searchsorted(xs,maxx,side='right')]
+            cand = cand[(y[cand] >= miny) & (y[cand] <= maxy)]
+            if len(cand) == 0:
+                continue
+
+            inside = cand[contains(geometries.prepared(i),x[cand],y[cand])]
+            addCount('join_polygons')
+            addCount('join_candidates',len(cand))
+            point_idx.append(inside)
+            geom_idx.append(np.full(len(inside),i,dtype=np.int64))
+
+    point_idx = np.concatenate(point_idx)
+    geom_idx = np.concatenate(geom_idx)
+    order = np.lexsort((geom_idx,point_idx))
+    addCount('join_pairs',len(order))
+
+    return point_idx[order],geom_idx[order]
+
 
 
 ### fast closest airport function
@@ -84,18 +581,16 @@ def ckdnearest(gdA, gdB):
 
     Notes:
     --------
-    For more information regarding the approach used,
-    see https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.cKDTree.html
+    Builds an AerodromeIndex on every call. When querying the same aerodromes repeatedly,
+    build an AerodromeIndex once and use AerodromeIndex.nearest instead.
 
 
     """
 
-    nA = np.array(list(zip(gdA.geometry.x, gdA.geometry.y)) )
-    nB = np.array(list(zip(gdB.geometry.x, gdB.geometry.y)) )
-    btree = cKDTree(nB)
-    dist, idx = btree.query(nA, k=1)
+    lonlats = np.column_stack((gdA.geometry.x.values,gdA.geometry.y.values))
+    dist, idx = AerodromeIndex(gdB).nearest(lonlats)
 
-    min_airports = gdB.loc[idx,'geometry'].reset_index(drop=True)
+    min_airports = gdB.geometry.iloc[idx].reset_index(drop=True)
 
     return min_airports
 
@@ -121,3 +616,322 @@ def calc_distance(lat1,lon1,lat2,lon2):
 
     """
     return distance((lat1,lon1),(lat2,lon2)).nm
+
+
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+WGS84_B = WGS84_A*(1 - WGS84_F)
+
+# meters in a nautical mile
+NM_M = 1852.0
+
+
+@nb.njit(parallel=True)
+def _vincenty_m(lat1,lon1,lat2,lon2):
+    # distances in meters, -1 where the iteration does not converge (nearly antipodal or non-finite points)
+
+    n = lat1.shape[0]
+    s = np.empty(n)
+
+    for i in nb.prange(n):
+        L = np.radians(lon2[i] - lon1[i])
+        U1 = np.arctan((1 - WGS84_F)*np.tan(np.radians(lat1[i])))
+        U2 = np.arctan((1 - WGS84_F)*np.tan(np.radians(lat2[i])))
+        sinU1 = np.sin(U1)
+        cosU1 = np.cos(U1)
+        sinU2 = np.sin(U2)
+        cosU2 = np.cos(U2)
+
+        lam = L
+        sin_sigma = 0.0
+        cos_sigma = 1.0
+        sigma = 0.0
+        cos2_alpha = 1.0
+        cos_2sigma_m = 0.0
+        converged = False
+
+        for _ in range(200):
+            sin_lam = np.sin(lam)
+            cos_lam = np.cos(lam)
+            sin_sigma = np.sqrt((cosU2*sin_lam)**2 + (cosU1*sinU2 - sinU1*cosU2*cos_lam)**2)
+            if sin_sigma == 0.0:
+                converged = True
+                break
+            cos_sigma = sinU1*sinU2 + cosU1*cosU2*cos_lam
+            sigma = np.arctan2(sin_sigma,cos_sigma)
+            sin_alpha = cosU1*cosU2*sin_lam/sin_sigma
+            cos2_alpha = 1 - sin_alpha**2
+            cos_2sigma_m = cos_sigma - 2*sinU1*sinU2/cos2_alpha if cos2_alpha != 0.0 else 0.0
+            C = WGS84_F/16*cos2_alpha*(4 + WGS84_F*(4 - 3*cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C)*WGS84_F*sin_alpha*(sigma + C*sin_sigma*(cos_2sigma_m + C*cos_sigma*(-1 + 2*cos_2sigma_m**2)))
+            if abs(lam - lam_prev) < 1e-12:
+                converged = True
+                break
+
+        if not converged:
+            s[i] = -1.0
+            continue
+
+        if sin_sigma == 0.0:
+            s[i] = 0.0
+            continue
+
+        u2 = cos2_alpha*(WGS84_A**2 - WGS84_B**2)/WGS84_B**2
+        A = 1 + u2/16384*(4096 + u2*(-768 + u2*(320 - 175*u2)))
+        B = u2/1024*(256 + u2*(-128 + u2*(74 - 47*u2)))
+        delta_sigma = B*sin_sigma*(cos_2sigma_m + B/4*(cos_sigma*(-1 + 2*cos_2sigma_m**2)
+                      - B/6*cos_2sigma_m*(-3 + 4*sin_sigma**2)*(-3 + 4*cos_2sigma_m**2)))
+        s[i] = WGS84_B*A*(sigma - delta_sigma)
+
+    return s
+
+
+
+def geodesic_distance(lat1,lon1,lat2,lon2):
+    """
+    A vectorized version of calc_distance. Calculates the WGS84 ellipsoidal distance between
+    arrays of lat/lon points in one call using Vincenty's inverse formula.
+
+
+    Parameters:
+    -----------
+    lat1 {array}: latitudes of the first points in degrees.
+    lon1 {array}: longitudes of the first points in degrees.
+    lat2 {array}: latitudes of the second points in degrees.
+    lon2 {array}: longitudes of the second points in degrees.
+
+
+    Returns:
+    --------
+    distance {array}: distance between each pair of lat/lon points in nautical miles.
+
+
+    Notes:
+    --------
+    Vincenty's formula agrees with the geodesic used by geopy (Karney) to within 0.5 mm,
+    i.e. ~3e-7 nm, for any pair of points that are not nearly antipodal. For nearly antipodal
+    points (more than ~10,000 nm apart) the iteration may not converge, these pairs are
+    computed with geopy instead. Pairs with a non-finite coordinate are NaN.
+
+
+    """
+
+    lat1,lon1,lat2,lon2 = np.broadcast_arrays(*[np.asarray(v,dtype=np.float64).reshape(-1) for v in (lat1,lon1,lat2,lon2)])
+
+    d = _vincenty_m(np.ascontiguousarray(lat1),np.ascontiguousarray(lon1),
+                    np.ascontiguousarray(lat2),np.ascontiguousarray(lon2))/NM_M
+
+    ## pairs where the iteration did not converge
+    for i in np.flatnonzero(d < 0):
+        finite = np.isfinite([lat1[i],lon1[i],lat2[i],lon2[i]]).all()
+        d[i] = calc_distance(lat1[i],lon1[i],lat2[i],lon2[i]) if finite else np.nan
+
+    return d
+
+
+
+def geodesicCircles(lonlats_deg, radius_nm, n=256):
+    """
+    Returns n points on the circle of radius radius_nm (WGS84 geodesic distance) around every center,
+    at evenly spaced bearings. Points start on the spherical circle and are moved along their great
+    circle until geodesic_distance to the center is radius_nm.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: (M,2) array of lon/lat centers in degrees.
+    radius_nm {float}: radius of the circles in nautical miles.
+    n {int}: number of points per circle.
+
+
+    Returns:
+    --------
+    circles {array}: (M,n,2) array of lon/lat points in degrees.
+
+
+    """
+
+    lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+    shape = (len(lonlats_deg),n)
+
+    bearing = np.broadcast_to(np.linspace(0,2*np.pi,n,endpoint=False),shape)
+    lon1 = np.broadcast_to(np.radians(lonlats_deg[:,0])[:,None],shape)
+    lat1 = np.broadcast_to(np.radians(lonlats_deg[:,1])[:,None],shape)
+    angle = np.full(shape,radius_nm*NM_M/6371008.8)
+
+    for _ in range(3):
+        lat2 = np.arcsin(np.sin(lat1)*np.cos(angle) + np.cos(lat1)*np.sin(angle)*np.cos(bearing))
+        lon2 = lon1 + np.arctan2(np.sin(bearing)*np.sin(angle)*np.cos(lat1),np.cos(angle) - np.sin(lat1)*np.sin(lat2))
+
+        ## the geodesic distance grows linearly with the angle over a few nm
+        d = geodesic_distance(np.degrees(lat1),np.degrees(lon1),np.degrees(lat2),np.degrees(lon2)).reshape(shape)
+        angle = angle*radius_nm/d
+
+    return np.stack((np.degrees(lon2),np.degrees(lat2)),axis=-1)
+
+
+
+# Smallest radius of curvature of the WGS84 ellipsoid (meridional, at the equator). No geodesic of
+# length s turns the surface normal by more than s/WGS84_RMIN radians.
+WGS84_RMIN = WGS84_A*(1 - WGS84_F*(2 - WGS84_F))
+
+
+def lonlat_to_unit(lon,lat):
+    """
+    Converts lon/lat points to 3D ECEF unit vectors (the ellipsoid surface normal at each point).
+
+
+    Parameters:
+    -----------
+    lon {array}: longitudes in degrees.
+    lat {array}: latitudes in degrees.
+
+
+    Returns:
+    --------
+    xyz {array}: (N,3) array of unit vectors.
+
+
+    """
+    lon = np.radians(np.asarray(lon,dtype=float))
+    lat = np.radians(np.asarray(lat,dtype=float))
+
+    return np.column_stack((np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)))
+
+
+
+def _chord(distance_nm):
+    # chord between unit vectors that bounds every point within distance_nm
+    angle = np.minimum(np.asarray(distance_nm,dtype=float)*NM_M/WGS84_RMIN,np.pi)
+    return 2*np.sin(angle/2)*(1 + 1e-9)
+
+
+
+class AerodromeIndex:
+    """
+    Spatial index of aerodromes on 3D ECEF unit vectors. Unlike a KD-tree on raw lon/lat
+    degrees, nearness on the unit sphere does not depend on latitude, and every candidate is
+    refined with the WGS84 geodesic distance so results are exact in nautical miles.
+    Build it once per dataset load and reuse it for every query.
+
+
+    Parameters:
+    -----------
+    ap {geo dataframe}: dataframe containing the geometry of all aerodromes.
+
+
+    Attributes:
+    -----------
+    lonlats {array}: (M,2) lon/lat of every aerodrome, in the row order of ap.
+    tree {cKDTree}: KD-tree on the aerodrome unit vectors.
+
+
+    """
+
+    def __init__(self, ap):
+
+        self.lonlats = np.column_stack((ap.geometry.x.values,ap.geometry.y.values)).astype(float)
+        self.tree = cKDTree(lonlat_to_unit(self.lonlats[:,0],self.lonlats[:,1]))
+
+
+    def __len__(self):
+        return len(self.lonlats)
+
+
+    def _distance(self, lonlats, point_idx, ap_idx):
+        return geodesic_distance(lonlats[point_idx,1],lonlats[point_idx,0],self.lonlats[ap_idx,1],self.lonlats[ap_idx,0])
+
+
+    def nearest(self, lonlats_deg, k=1):
+        """
+        Finds the k closest aerodromes (by geodesic distance) to every point.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+        k {int}: number of aerodromes to return per point.
+
+
+        Returns:
+        --------
+        dist {array}: distance in nautical miles, (N,) if k == 1 else (N,k), closest first.
+        idx {array}: row of the aerodrome in ap, same shape as dist.
+
+
+        """
+
+        lonlats = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        n = len(lonlats)
+        m = min(len(self),k + 8)
+
+        # candidates by angle, then exact distances
+        _, cand = self.tree.query(lonlat_to_unit(lonlats[:,0],lonlats[:,1]),k=m)
+        cand = cand.reshape(n,m)
+        point_idx = np.repeat(np.arange(n),m)
+        d = self._distance(lonlats,point_idx,cand.reshape(-1)).reshape(n,m)
+
+        order = np.argsort(d,axis=1)[:,:k]
+        idx = np.take_along_axis(cand,order,axis=1)
+        dist = np.take_along_axis(d,order,axis=1)
+
+        ## An aerodrome outside the candidates is at least WGS84_RMIN * (angle of the last candidate) away.
+        ## Points where that bound does not clear the k-th distance are resolved with a radius query.
+        if m < len(self):
+            last = self.tree.data[cand[:,-1]]
+            angle = 2*np.arcsin(np.linalg.norm(lonlat_to_unit(lonlats[:,0],lonlats[:,1]) - last,axis=1)/2)
+            unsure = np.flatnonzero(angle*WGS84_RMIN/NM_M < dist[:,-1])
+
+            if len(unsure) > 0:
+                p,a,dd = self.within(lonlats[unsure],dist[unsure,-1])
+                for j in range(len(unsure)):
+                    sel = p == j
+                    o = np.argsort(dd[sel])[:k]
+                    idx[unsure[j],:len(o)] = a[sel][o]
+                    dist[unsure[j],:len(o)] = dd[sel][o]
+
+        if k == 1:
+            return dist[:,0],idx[:,0]
+
+        return dist,idx
+
+
+    def within(self, lonlats_deg, radius_nm):
+        """
+        Finds every aerodrome within a geodesic radius of every point.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+        radius_nm {float or array}: radius in nautical miles, one value or one per point.
+
+
+        Returns:
+        --------
+        point_idx {array}: index of the point of each (point, aerodrome) pair.
+        ap_idx {array}: row of the aerodrome in ap of each pair.
+        dist {array}: distance of each pair in nautical miles.
+
+
+        """
+
+        lonlats = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        radius_nm = np.broadcast_to(np.asarray(radius_nm,dtype=float),(len(lonlats),))
+        xyz = lonlat_to_unit(lonlats[:,0],lonlats[:,1])
+
+        # all candidate pairs in one tree-to-tree query, using the largest radius
+        pairs = cKDTree(xyz).sparse_distance_matrix(self.tree,float(_chord(radius_nm.max())) if len(lonlats) > 0 else 0.0,
+                                                    output_type='ndarray')
+        point_idx = pairs['i'].astype(np.int64)
+        ap_idx = pairs['j'].astype(np.int64)
+
+        # exact distances
+        dist = self._distance(lonlats,point_idx,ap_idx)
+        keep = dist <= radius_nm[point_idx]
+        order = np.lexsort((dist[keep],point_idx[keep]))
+
+        return point_idx[keep][order],ap_idx[keep][order],dist[keep][order]
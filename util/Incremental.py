@@ -0,0 +1,435 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+import geopandas
+from util.Stream import *
+from util.Output import *
+
+## attribute columns compared, with the geometry, to find the changed rows of each layer
+DIFF_COLUMNS = {'airspace': ['CLASS','LOWER_VAL','LOWER_CODE','UPPER_VAL','UPPER_CODE'],
+                'bg_df': ['density']}
+
+
+def rowKeys(df, columns):
+    """
+    Returns a hashable key of every row of a layer: the WKB of its geometry and the values of the columns.
+
+
+    """
+
+    values = [df[c].astype(str).values for c in columns]
+    return [(g.wkb,) + tuple(v[k] for v in values) for k,g in enumerate(df.geometry.values)]
+
+
+
+def changedRows(old_df, new_df, columns):
+    """
+    Diffs two versions of a layer.
+
+
+    Parameters:
+    -----------
+    old_df {geo dataframe}: old version of the layer.
+    new_df {geo dataframe}: new version of the layer.
+    columns {list}: attribute columns that are compared along with the geometry.
+
+
+    Returns:
+    --------
+    removed {array}: rows of old_df that are not in new_df.
+    added {array}: rows of new_df that are not in old_df.
+
+
+    """
+
+    old_keys = rowKeys(old_df,columns)
+    new_keys = rowKeys(new_df,columns)
+
+    old_set,new_set = set(old_keys),set(new_keys)
+    removed = np.array([k for k,key in enumerate(old_keys) if key not in new_set],dtype=np.int64)
+    added = np.array([k for k,key in enumerate(new_keys) if key not in old_set],dtype=np.int64)
+
+    return removed,added
+
+
+
+class Footprint:
+    """
+    Area whose classification may have changed between two versions of the datasets: the changed
+    airspace shelves and block groups (old and new geometries), and everything closer than 5 nm to an
+    aerodrome that was added, removed, moved or whose airspace class changed.
+
+
+    Parameters:
+    -----------
+    polygons {geo series}: changed airspace and block group polygons.
+    aerodromes {array}: (N,2) lon/lat of the changed aerodromes.
+
+
+    Attributes:
+    -----------
+    boxes {array}: (M,4) minx,miny,maxx,maxy boxes of every changed polygon and aerodrome circle. Outputs are
+                   only read where they overlap one of them.
+
+
+    """
+
+    def __init__(self, polygons, aerodromes):
+        self.polygons = geopandas.GeoSeries(list(polygons))
+        self.aerodromes = np.asarray(aerodromes,dtype=float).reshape(-1,2)
+
+        self.polygon_index = PolygonIndex(self.polygons)
+        self.ap_index = None
+        if len(self.aerodromes) > 0:
+            self.ap_index = AerodromeIndex(geopandas.GeoDataFrame(geometry=geopandas.points_from_xy(self.aerodromes[:,0],self.aerodromes[:,1])))
+
+        self.boxes = self._boxes()
+
+
+    def __len__(self):
+        return len(self.polygons) + len(self.aerodromes)
+
+
+    def _boxes(self):
+        # minx,miny,maxx,maxy boxes of every changed polygon and aerodrome circle
+        boxes = [self.polygon_index.bounds.reshape(-1,4)]
+        if len(self.aerodromes) > 0:
+            ## generous box around the 5 nm circles
+            dlat = AERODROME_NM/60.0 + 0.01
+            dlon = dlat/np.cos(np.radians(np.minimum(np.abs(self.aerodromes[:,1]) + dlat,89.0)))
+            boxes.append(np.column_stack((self.aerodromes[:,0] - dlon,self.aerodromes[:,1] - dlat,
+                                          self.aerodromes[:,0] + dlon,self.aerodromes[:,1] + dlat)))
+
+        b = np.concatenate(boxes)
+
+        return b[np.isfinite(b).all(axis=1)]
+
+
+    @property
+    def bounds(self):
+        """
+        Returns the (minx,miny,maxx,maxy) box of the footprint, or None if it is empty.
+
+
+        """
+
+        b = self.boxes
+        if len(b) == 0:
+            return None
+
+        return (b[:,0].min(),b[:,1].min(),b[:,2].max(),b[:,3].max())
+
+
+    def intersects(self, bbox):
+        """
+        Returns True if the box (minx,miny,maxx,maxy) overlaps the box of any change. Changes scattered over
+        the country have a union box covering most of it, so areas are tested against every box instead.
+
+
+        """
+
+        b = self.boxes
+
+        return bool(((b[:,2] >= bbox[0]) & (b[:,0] <= bbox[2]) & (b[:,3] >= bbox[1]) & (b[:,1] <= bbox[3])).any())
+
+
+    def contains(self, lonlats_deg):
+        """
+        Returns a boolean array, one per point, of the points within the footprint. Points on the edge of
+        a changed polygon are not within it (as in pointsInPolygons), and so were not affected by it.
+
+
+        """
+
+        lonlats_deg = np.ascontiguousarray(lonlats_deg,dtype=float).reshape(-1,2)
+        mask = np.zeros(len(lonlats_deg),dtype=bool)
+
+        if len(self.polygons) > 0:
+            point_idx,_ = pointsInPolygons(lonlats_deg,self.polygon_index)
+            mask[point_idx] = True
+
+        if len(self.aerodromes) > 0:
+            point_idx,_,d = self.ap_index.within(lonlats_deg,AERODROME_NM)
+            mask[point_idx[d <= AERODROME_NM]] = True
+
+        return mask
+
+
+
+def diffData(old, new):
+    """
+    Diffs two versions of the datasets and returns the footprint of the changes.
+
+
+    Parameters:
+    -----------
+    old {Data}: previous datasets, i.e. loadData(old_bundle).
+    new {Data}: new datasets, i.e. loadData(new_bundle).
+
+
+    Returns:
+    --------
+    footprint {Footprint}: area to reclassify.
+    changes {dict}: number of changed rows of every layer.
+
+
+    """
+
+    polygons = []
+    changes = {}
+    for layer,columns in DIFF_COLUMNS.items():
+        old_df,new_df = getattr(old,layer),getattr(new,layer)
+        removed,added = changedRows(old_df,new_df,columns)
+
+        polygons += list(old_df.geometry.values[removed]) + list(new_df.geometry.values[added])
+        changes[layer] = {'removed': len(removed),'added': len(added)}
+
+    ## aerodromes are compared on their location and the airspace class they are in, so aerodromes under
+    ## a changed shelf are found as well
+    keys = []
+    for data in (old,new):
+        ap_index,ap_class = aerodromeIndex(data)
+        keys.append([(x,y,str(c)) for (x,y),c in zip(ap_index.lonlats.tolist(),ap_class)])
+
+    old_set,new_set = set(keys[0]),set(keys[1])
+    removed = [k for k in keys[0] if k not in new_set]
+    added = [k for k in keys[1] if k not in old_set]
+    aerodromes = np.array([k[:2] for k in removed + added],dtype=float).reshape(-1,2)
+    changes['ap'] = {'removed': len(removed),'added': len(added)}
+
+    return Footprint(polygons,aerodromes),changes
+
+
+
+def pathSpacing(path):
+    """
+    Returns the grid spacing of an output from its spacing_<deg> directory, or None if it is not in one.
+
+
+    """
+
+    for part in reversed(os.path.normpath(path).split(os.sep)):
+        if part.startswith('spacing_'):
+            try:
+                return float(part[len('spacing_'):])
+            except ValueError:
+                return None
+
+    return None
+
+
+
+def patchResult(result, footprint, data, spacing=None):
+    """
+    Reclassifies the points of a result that are within the footprint.
+
+
+    Parameters:
+    -----------
+    result {RiskResult}: stored result.
+    footprint {Footprint}: area to reclassify.
+    data {Data}: new datasets.
+    spacing {float}: (optional) grid spacing of the points. The stored float32 coordinates are snapped
+                     back to the grid, so that points on polygon edges are classified as in the first run.
+
+
+    Returns:
+    --------
+    result {RiskResult}: patched result, in the same order.
+    reclassified {int}: number of points that were reclassified.
+    changed {int}: number of points whose risk class or status changed.
+
+
+    """
+
+    lonlats = np.column_stack((result.lon,result.lat)).astype(float)
+    if spacing is not None:
+        lonlats = np.round(np.round(lonlats/spacing)*spacing,10)
+
+    mask = footprint.contains(lonlats)
+    if not mask.any():
+        return result,0,0
+
+    new = classifyChunk(lonlats[mask],data,alt_ft_agl=result.alt[mask].astype(float))
+
+    patched = RiskResult(result.lon,result.lat,result.alt,result.risk_class.copy(),result.status.copy(),
+                         result.low_risk.copy(),result.lr_status.copy())
+    changed = (patched.risk_class[mask] != new.risk_class) | (patched.status[mask] != new.status)
+
+    patched.risk_class[mask] = new.risk_class
+    patched.status[mask] = new.status
+    patched.low_risk[mask] = new.low_risk
+    patched.lr_status[mask] = new.lr_status
+
+    return patched,int(mask.sum()),int(changed.sum())
+
+
+
+def patchGeoParquet(path, footprint, data, spacing=None):
+    """
+    Patches a RiskClass.parquet dataset in place. Only the partitions overlapping the footprint are read,
+    and only the ones with reclassified points are rewritten (atomically).
+
+
+    Returns:
+    --------
+    reclassified {int}: number of points that were reclassified.
+    changed {int}: number of points whose risk class or status changed.
+
+
+    """
+
+    import pyarrow.parquet as pq
+
+    if len(footprint.boxes) == 0:
+        return 0,0
+
+    reclassified,changed = 0,0
+    for f,b in Results(path).partitions.items():
+        if not footprint.intersects(b):
+            continue
+
+        df = geopandas.read_parquet(f)
+        result = RiskResult(df.geometry.x.values,df.geometry.y.values,df.alt.values,df.Risk_Class.values,
+                            df.Status.values,df.LR_Risk_Class.values,df.LR_Status.values)
+
+        result,n,c = patchResult(result,footprint,data,spacing=spacing)
+        if n > 0:
+            tmp = '{}.{}.tmp'.format(f,os.getpid())
+            pq.write_table(resultTable(result),tmp)
+            os.replace(tmp,f)
+
+        reclassified += n
+        changed += c
+
+    return reclassified,changed
+
+
+
+def patchGeoTIFF(path, footprint, data, spacing=None):
+    """
+    Patches a RiskClass.tif in place. Only the window around the changes overlapping the raster is read and written.
+
+
+    Returns:
+    --------
+    reclassified {int}: number of cells that were reclassified.
+    changed {int}: number of cells whose risk class or status changed.
+
+
+    """
+
+    import rasterio
+    from rasterio.windows import from_bounds, Window
+
+    with rasterio.open(path,'r+') as dst:
+        ## only the changes overlapping the raster, i.e. of its state
+        b = footprint.boxes
+        left,bottom,right,top = dst.bounds
+        b = b[(b[:,2] >= left) & (b[:,0] <= right) & (b[:,3] >= bottom) & (b[:,1] <= top)]
+        if len(b) == 0:
+            return 0,0
+
+        alt = json.loads(dst.tags().get('ALT_FT_AGL','[]'))
+        if len(alt) != 1:
+            raise ValueError('{} does not have a single altitude, it can not be reclassified'.format(path))
+
+        w = from_bounds(b[:,0].min(),b[:,1].min(),b[:,2].max(),b[:,3].max(),transform=dst.transform)
+        col0,row0 = max(int(np.floor(w.col_off)),0),max(int(np.floor(w.row_off)),0)
+        col1,row1 = min(int(np.ceil(w.col_off + w.width)),dst.width),min(int(np.ceil(w.row_off + w.height)),dst.height)
+        if col1 <= col0 or row1 <= row0:
+            return 0,0
+        window = Window(col0,row0,col1 - col0,row1 - row0)
+
+        bands = dst.read(window=window)
+        transform = dst.window_transform(window)
+
+        rows,cols = np.nonzero(bands[0] != NODATA)
+        lon = transform.c + (cols + 0.5)*transform.a
+        lat = transform.f + (rows + 0.5)*transform.e
+
+        result = RiskResult(lon,lat,alt[0],*[bands[k,rows,cols] for k in range(len(TIF_BANDS))])
+        result,n,c = patchResult(result,footprint,data,spacing=spacing)
+
+        if n > 0:
+            bands[0,rows,cols] = result.risk_class
+            bands[1,rows,cols] = result.status
+            bands[2,rows,cols] = result.low_risk
+            bands[3,rows,cols] = result.lr_status
+            dst.write(bands,window=window)
+
+    return n,c
+
+
+
+def patchTiles(tile_dir, footprint, data):
+    """
+    Patches the tile checkpoints of runBatch.py, so that merging them again gives the patched outputs.
+    The grid spacing of every tile is taken from its spacing_<deg> directory.
+
+
+    Returns:
+    --------
+    reclassified {int}: number of points that were reclassified.
+    changed {int}: number of points whose risk class or status changed.
+
+
+    """
+
+    if len(footprint.boxes) == 0:
+        return 0,0
+
+    reclassified,changed = 0,0
+    for f in sorted(glob.glob(os.path.join(tile_dir,'**','*.feather'),recursive=True)):
+        result = RiskResult.fromFrame(pd.read_feather(f))
+        if len(result) == 0 or not footprint.intersects((result.lon.min(),result.lat.min(),result.lon.max(),result.lat.max())):
+            continue
+
+        result,n,c = patchResult(result,footprint,data,spacing=pathSpacing(f))
+        if n > 0:
+            tmp = '{}.{}.tmp'.format(f,os.getpid())
+            result.toFrame().to_feather(tmp)
+            os.replace(tmp,f)
+
+        reclassified += n
+        changed += c
+
+    return reclassified,changed
+
+
+
+def patchOutput(path, footprint, data, spacing=None):
+    """
+    Patches a stored output in place: a RiskClass.parquet dataset or a RiskClass.tif.
+
+
+    Parameters:
+    -----------
+    path {string}: path to RiskClass.parquet or RiskClass.tif.
+    footprint {Footprint}: area to reclassify, from diffData.
+    data {Data}: new datasets.
+    spacing {float}: (optional) grid spacing of the points. Taken from the spacing_<deg> directory of
+                     the output if not specified, see patchResult.
+
+
+    Returns:
+    --------
+    reclassified {int}: number of points that were reclassified.
+    changed {int}: number of points whose risk class or status changed.
+
+
+    """
+
+    if spacing is None:
+        spacing = pathSpacing(path)
+
+    if os.path.splitext(path)[1].lower() in ('.tif','.tiff'):
+        return patchGeoTIFF(path,footprint,data,spacing=spacing)
+    elif os.path.exists(os.path.join(path,'_dataset.json')):
+        return patchGeoParquet(path,footprint,data,spacing=spacing)
+
+    raise ValueError('{} can not be patched, expected a RiskClass.parquet dataset or a RiskClass.tif'.format(path))
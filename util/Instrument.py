@@ -0,0 +1,485 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+import cProfile
+
+## Process wide event counters. Stages report how much each one changed while they ran.
+##   elevation_calls / elevation_points: getElevations calls and the points asked for
+##   elevation_requests / elevation_failures: HTTP requests sent to the query service and points left without an answer
+##   elevation_cache_hits / elevation_cache_misses: points answered by CachedElevation (memory or disk) or passed on
+##   join_points / join_cover_points: points given to pointsInPolygons and the ones resolved by the cell cover
+##   join_polygons / join_candidates / join_pairs: polygons tested, points tested against them (within their bounds)
+##   and (point, polygon) pairs found
+counters = {}
+
+_sinks = []
+_local = threading.local()
+
+## Stages reset the high-water mark of the kernel on entry, so that it measures their own peak. The peak of the
+## process and of the stages still running (in any thread) before the reset is kept here.
+_rss_lock = threading.Lock()
+_open = []
+_process_peak = 0.0
+
+
+def addCount(name, n=1):
+    """
+    Adds n to an event counter.
+
+
+    """
+
+    counters[name] = counters.get(name,0) + n
+
+
+
+def _status(field):
+    # field of /proc/self/status in MB (Linux), None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/1024.0
+    except OSError:
+        pass
+
+    return None
+
+
+
+def _clearPeak():
+    # resets the high-water mark of the process to its current size, after keeping it for the process
+    # and for the stages running. Needs the rss lock. Returns False where it cannot be reset.
+    global _process_peak
+
+    hwm = _status('VmHWM')
+    if hwm is None:
+        return False
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        return False
+
+    _process_peak = max(_process_peak,hwm)
+    for stage in _open:
+        stage._peak = max(stage._peak,hwm)
+
+    return True
+
+
+
+def resetPeakRSS():
+    """
+    Resets the peak resident set size of the process to its current size (Linux).
+
+
+    """
+
+    global _process_peak
+
+    with _rss_lock:
+        _clearPeak()
+        _process_peak = 0.0
+
+
+
+def peakRSS():
+    """
+    Returns the peak resident set size of the process in MB, since it started or since the last resetPeakRSS.
+
+
+    """
+
+    hwm = _status('VmHWM')
+    if hwm is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+    return max(hwm,_process_peak)
+
+
+
+def currentRSS():
+    """
+    Returns the resident set size of the process in MB, None where it is not known (Linux only).
+
+
+    """
+
+    return _status('VmRSS')
+
+
+
+def _stack():
+    # stages of the current thread, innermost last
+    if not hasattr(_local,'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+
+class Stage:
+    """
+    Timed stage of a classification, used as a context manager. On exit a record of the stage is
+    passed to every sink (see setStageSinks):
+
+        stage, parent, depth, pid, start, wall_s, cpu_s, points_in, points_out, start_rss_mb, peak_rss_mb,
+        rss_growth_mb, counters (change of every counter that moved), notes, error, and the fields given to set.
+
+    A stage without points_out reports the points_out of its last inner stage. CPU time is the time of
+    the whole process and the counters are process wide, so both include other threads.
+
+    start_rss_mb is the resident set size on entry and peak_rss_mb the highest one while the stage ran:
+    the high-water mark of the kernel is reset on entry, so it is the peak of the stage and not of the
+    process before it. rss_growth_mb is the difference, the memory the stage needed on top of what the
+    process already held. Where the high-water mark cannot be reset (not Linux) peak_rss_mb is the peak
+    of the process and rss_growth_mb is None. Memory is process wide, so both include other threads.
+
+
+    Parameters:
+    -----------
+    name {string}: machine readable name, i.e. 'low_risk.density'.
+    points_in {int}: (optional) number of points the stage starts with.
+    title {string}: (optional) banner printed by PrintSink. Stages without a title are only printed as part of their parent.
+
+
+    Attributes:
+    -----------
+    points_out {int}: number of points the stage ends with, i.e. the points still to check. Set within the stage.
+    record {dict}: record of the stage, once it has finished.
+
+
+    """
+
+    def __init__(self, name, points_in=None, title=None):
+        self.name = name
+        self.points_in = None if points_in is None else int(points_in)
+        self.title = title
+        self.points_out = None
+        self.notes = []
+        self.fields = {}
+        self.parent = None
+        self.depth = 0
+        self.record = None
+        self._last_out = None
+
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if len(stack) > 0 else None
+        self.depth = len(stack)
+        stack.append(self)
+
+        with _rss_lock:
+            self._peak = 0.0
+            self._tracked = _clearPeak()
+            self._rss = currentRSS()
+            _open.append(self)
+
+        self._counters = dict(counters)
+        self._time = time.time()
+        self._start = time.perf_counter()
+        self._cpu = time.process_time()
+
+        for sink in list(_sinks):
+            sink.start(self)
+
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._start
+        cpu = time.process_time() - self._cpu
+
+        with _rss_lock:
+            if self in _open:
+                _open.remove(self)
+            hwm = _status('VmHWM')
+        peak = max(hwm,self._peak) if self._tracked and hwm is not None else peakRSS()
+
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+
+        points_out = self.points_out if self.points_out is not None else self._last_out
+        if self.parent is not None and points_out is not None:
+            self.parent._last_out = points_out
+
+        self.record = {'stage': self.name,
+                       'parent': self.parent.name if self.parent is not None else None,
+                       'depth': self.depth,
+                       'pid': os.getpid(),
+                       'start': self._time,
+                       'wall_s': wall,
+                       'cpu_s': cpu,
+                       'points_in': self.points_in,
+                       'points_out': None if points_out is None else int(points_out),
+                       'start_rss_mb': self._rss,
+                       'peak_rss_mb': peak,
+                       'rss_growth_mb': max(0.0,peak - self._rss) if self._tracked and self._rss is not None else None,
+                       'counters': {k: v - self._counters.get(k,0) for k,v in counters.items() if v != self._counters.get(k,0)},
+                       'notes': list(self.notes),
+                       'error': None if exc_type is None else exc_type.__name__}
+        self.record.update(self.fields)
+
+        for sink in list(_sinks):
+            sink.end(self,self.record)
+
+        return False
+
+
+    @property
+    def elapsed(self):
+        # seconds since the stage started
+        return time.perf_counter() - self._start
+
+
+    def note(self, text):
+        """
+        Adds a line to the record of the stage, printed by PrintSink, i.e. how many points violated a criteria.
+
+
+        """
+
+        self.notes.append(text)
+
+
+    def set(self, **fields):
+        """
+        Adds fields to the record of the stage.
+
+
+        """
+
+        self.fields.update(fields)
+
+
+
+class PrintSink:
+    """
+    Prints a banner for every stage with a title: its number of points when it starts, and its wall
+    and CPU time, notes and counters when it finishes. The default sink.
+
+
+    """
+
+    def start(self, stage):
+        if stage.title is None:
+            return
+
+        print(stage.title)
+        print("------------------------------------------------------------------------------")
+        if stage.points_in is not None:
+            print("> Beginning on {} points...".format(stage.points_in))
+        print(" ")
+
+
+    def end(self, stage, record):
+        if stage.title is None:
+            return
+
+        line = "> Finished! Time: {:.3f}s | CPU: {:.3f}s".format(record['wall_s'],record['cpu_s'])
+        if stage.parent is not None:
+            line += " | Total Time: {:.3f}s".format(stage.parent.elapsed)
+        print(line)
+
+        for text in record['notes']:
+            print("> " + text)
+        if len(record['counters']) > 0:
+            print("> " + " | ".join("{}: {}".format(k,v) for k,v in sorted(record['counters'].items())))
+
+        print("------------------------------------------------------------------------------")
+        print("------------------------------------------------------------------------------")
+        print(" ")
+
+
+    def log(self, text):
+        print(text)
+
+
+
+class JSONLinesSink:
+    """
+    Appends the record of every stage to a JSON lines file. Each record is written with one append,
+    so processes forked from the one that set the sink can share the file.
+
+
+    Parameters:
+    -----------
+    path {string}: JSON lines file.
+
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+
+
+    def start(self, stage):
+        pass
+
+
+    def end(self, stage, record):
+        line = json.dumps(record,default=float) + '\n'
+        with open(self.path,'a') as f:
+            f.write(line)
+
+
+
+class CallbackSink:
+    """
+    Calls a function with the record of every stage.
+
+
+    Parameters:
+    -----------
+    callback {function}: called as callback(record).
+
+
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+
+    def start(self, stage):
+        pass
+
+
+    def end(self, stage, record):
+        self.callback(record)
+
+
+
+class ProfileSink:
+    """
+    Profiles stages with cProfile or pyinstrument and writes one profile per stage run to a directory:
+    <stage>_<pid>_<k>.prof (pstats, i.e. for snakeviz) or <stage>_<pid>_<k>.html. Profilers are not
+    nested: a stage started while another one is profiled is part of the outer profile.
+
+
+    Parameters:
+    -----------
+    out_dir {string}: directory of the profiles.
+    profiler {string}: 'cProfile' or 'pyinstrument' (needs the pyinstrument package).
+    stages {list}: (optional) names of the stages to profile. Default is every outermost stage.
+
+
+    """
+
+    def __init__(self, out_dir, profiler='cProfile', stages=None):
+        if profiler not in ('cProfile','pyinstrument'):
+            raise ValueError('unknown profiler {}'.format(profiler))
+        if profiler == 'pyinstrument':
+            # only needed when profiling with it
+            import pyinstrument
+
+        self.out_dir = out_dir
+        self.profiler = profiler
+        self.stages = None if stages is None else set(stages)
+        self.runs = 0
+        self._active = None
+        os.makedirs(out_dir,exist_ok=True)
+
+
+    def start(self, stage):
+        if self._active is not None or threading.current_thread() is not threading.main_thread():
+            return
+        if (self.stages is None and stage.depth > 0) or (self.stages is not None and stage.name not in self.stages):
+            return
+
+        if self.profiler == 'cProfile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            from pyinstrument import Profiler
+            self._profile = Profiler()
+            self._profile.start()
+        self._active = stage
+
+
+    def end(self, stage, record):
+        if stage is not self._active:
+            return
+
+        self._active = None
+        self.runs += 1
+        path = os.path.join(self.out_dir,'{}_{}_{}'.format(stage.name,os.getpid(),self.runs))
+
+        if self.profiler == 'cProfile':
+            self._profile.disable()
+            self._profile.dump_stats(path + '.prof')
+        else:
+            self._profile.stop()
+            with open(path + '.html','w') as f:
+                f.write(self._profile.output_html())
+
+
+
+def setStageSinks(*sinks):
+    """
+    Sets the sinks the stage records and progress lines go to. Default is PrintSink(). With no sinks
+    nothing is printed or recorded (quiet mode, i.e. for library use).
+
+
+    Parameters:
+    -----------
+    sinks {objects}: any objects with start(stage) and end(stage, record) methods, i.e. PrintSink,
+                     JSONLinesSink, CallbackSink or ProfileSink. Sinks with a log(text) method also get the progress lines.
+
+
+    """
+
+    _sinks[:] = sinks
+
+
+
+def stageSinks():
+    """
+    Returns the current sinks.
+
+
+    """
+
+    return list(_sinks)
+
+
+
+@contextlib.contextmanager
+def quietOutput():
+    """
+    Context manager that stops the PrintSink output within it. The other sinks still get the records.
+
+
+    """
+
+    sinks = list(_sinks)
+    _sinks[:] = [s for s in sinks if not isinstance(s,PrintSink)]
+    try:
+        yield
+    finally:
+        _sinks[:] = sinks
+
+
+
+def stageLog(text):
+    """
+    Prints a progress line through the sinks, i.e. PrintSink. Nothing is printed in quiet mode.
+
+
+    """
+
+    for sink in list(_sinks):
+        if hasattr(sink,'log'):
+            sink.log(text)
+
+
+
+setStageSinks(PrintSink())
@@ -0,0 +1,396 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+import geopandas
+from util.Result import *
+
+## bands of the GeoTIFF output, one per product
+TIF_BANDS = ['Risk_Class','Status','LR_Risk_Class','LR_Status']
+
+NODATA = -1
+
+
+def pointWKB(lon, lat):
+    """
+    Encodes points as a pyarrow array of little-endian WKB, without building shapely geometries.
+
+
+    """
+
+    import pyarrow as pa
+
+    n = len(lon)
+    wkb = np.empty(n,dtype=[('order','u1'),('type','<u4'),('x','<f8'),('y','<f8')]) ## 21 bytes per point
+    wkb['order'] = 1
+    wkb['type'] = 1
+    wkb['x'] = lon
+    wkb['y'] = lat
+
+    offsets = np.arange(n + 1,dtype=np.int32)*wkb.dtype.itemsize
+
+    return pa.Array.from_buffers(pa.binary(),n,[None,pa.py_buffer(offsets),pa.py_buffer(wkb.tobytes())])
+
+
+
+def geoParquetSchema():
+    """
+    Returns the schema of the GeoParquet partitions: WKB point geometry, float32 altitude and int8 codes.
+
+
+    """
+
+    import pyarrow as pa
+
+    # without a crs key the geometries are OGC:CRS84 (lon/lat WGS84). An explicit null would mean an undefined CRS.
+    geo = {'version': '1.0.0','primary_column': 'geometry',
+           'columns': {'geometry': {'encoding': 'WKB','geometry_types': ['Point']}}}
+
+    return pa.schema([('geometry',pa.binary()),('alt',pa.float32()),
+                      ('Risk_Class',pa.int8()),('Status',pa.int8()),
+                      ('LR_Risk_Class',pa.int8()),('LR_Status',pa.int8())],
+                     metadata={b'geo': json.dumps(geo).encode()})
+
+
+
+def resultTable(result):
+    """
+    Converts a RiskResult into a pyarrow table with the GeoParquet partition schema.
+
+
+    """
+
+    import pyarrow as pa
+
+    return pa.Table.from_arrays([pointWKB(result.lon,result.lat),
+                                 pa.array(result.alt),
+                                 pa.array(result.risk_class),
+                                 pa.array(result.status),
+                                 pa.array(result.low_risk),
+                                 pa.array(result.lr_status)],schema=geoParquetSchema())
+
+
+
+class ShapefileWriter:
+    """
+    Writes RiskClass.shp and LowRiskClass.shp. The first chunk creates the shapefiles and the next
+    ones are appended to them as they are written.
+
+
+    Parameters:
+    -----------
+    out_dir {string}: output directory.
+
+
+    """
+
+    def __init__(self, out_dir):
+        self.paths = [os.path.join(out_dir,'RiskClass.shp'),os.path.join(out_dir,'LowRiskClass.shp')]
+        self.started = False
+
+
+    def write(self, result):
+        if len(result) == 0:
+            return
+
+        mode = 'a' if self.started else 'w'
+        for df,path in zip(result.toGeoDataFrames(),self.paths):
+            df.to_file(path,mode=mode)
+        self.started = True
+
+
+    def close(self):
+        pass
+
+
+
+class GeoParquetWriter:
+    """
+    Writes the results as a GeoParquet dataset, RiskClass.parquet, partitioned into lon/lat tiles.
+    The classes and statuses are stored as int8 codes, the altitude as float32. The chunks are appended
+    to the partitions as they are written.
+
+
+    Parameters:
+    -----------
+    out_dir {string}: output directory.
+    tile_deg {float}: size of the partitions in degrees.
+
+
+    """
+
+    def __init__(self, out_dir, tile_deg=1.0):
+        self.path = os.path.join(out_dir,'RiskClass.parquet')
+        self.tile_deg = float(tile_deg)
+        self.writers = {}
+        self.bounds = {}
+
+        os.makedirs(self.path,exist_ok=True)
+        for f in glob.glob(os.path.join(self.path,'*.parquet')):
+            os.remove(f)
+
+
+    def schema(self):
+        return geoParquetSchema()
+
+
+    def write(self, result):
+        import pyarrow.parquet as pq
+
+        lon,lat = result.lon,result.lat
+        i = np.floor(lon/self.tile_deg).astype(int)
+        j = np.floor(lat/self.tile_deg).astype(int)
+
+        for (ti,tj),rows in pd.Series(np.arange(len(lon))).groupby([i,j]):
+            rows = rows.values
+            name = 'part_{}_{}.parquet'.format(ti,tj)
+            if name not in self.writers:
+                self.writers[name] = pq.ParquetWriter(os.path.join(self.path,name),self.schema())
+                self.bounds[name] = [np.inf,np.inf,-np.inf,-np.inf]
+
+            self.writers[name].write_table(resultTable(result.take(rows)))
+
+            b = self.bounds[name]
+            self.bounds[name] = [min(b[0],lon[rows].min()),min(b[1],lat[rows].min()),
+                                 max(b[2],lon[rows].max()),max(b[3],lat[rows].max())]
+
+
+    def close(self):
+        for w in self.writers.values():
+            w.close()
+
+        with open(os.path.join(self.path,'_dataset.json'),'w') as f:
+            json.dump({'tile_deg': self.tile_deg,'status': STATUS_MESSAGES,
+                       'partitions': {k: [float(v) for v in b] for k,b in self.bounds.items()}},f,indent=1)
+
+
+
+class GeoTIFFWriter:
+    """
+    Writes the results of a grid run as RiskClass.tif, a compressed, tiled, int8 GeoTIFF with one band per
+    product (see TIF_BANDS). Cells that were not classified are set to NODATA.
+
+
+    Parameters:
+    -----------
+    out_dir {string}: output directory.
+    grid {Grid}: grid the points were generated on, i.e. gridInPolygon(SPACING_deg,state).
+
+
+    """
+
+    def __init__(self, out_dir, grid):
+        self.path = os.path.join(out_dir,'RiskClass.tif')
+        self.grid = grid
+        self.bands = np.full((len(TIF_BANDS),) + grid.shape,NODATA,dtype=np.int8)
+        self.alt = set()
+
+
+    def write(self, result):
+        col = np.rint((result.lon - self.grid.lon0)/self.grid.spacing).astype(int)
+        row = self.grid.ny - 1 - np.rint((result.lat - self.grid.lat0)/self.grid.spacing).astype(int)
+
+        self.bands[0,row,col] = result.risk_class
+        self.bands[1,row,col] = result.status
+        self.bands[2,row,col] = result.low_risk
+        self.bands[3,row,col] = result.lr_status
+        self.alt.update(np.unique(result.alt).tolist())
+
+
+    def close(self):
+        import rasterio
+
+        block = 256 if min(self.grid.shape) >= 256 else None
+        profile = dict(driver='GTiff',height=self.grid.ny,width=self.grid.nx,count=len(TIF_BANDS),dtype='int8',
+                       crs='EPSG:4326',transform=self.grid.transform,nodata=NODATA,compress='deflate')
+        if block is not None:
+            profile.update(tiled=True,blockxsize=block,blockysize=block)
+
+        with rasterio.open(self.path,'w',**profile) as dst:
+            dst.write(self.bands)
+            for k,name in enumerate(TIF_BANDS):
+                dst.set_band_description(k + 1,name)
+            dst.update_tags(STATUS=json.dumps(STATUS_MESSAGES),ALT_FT_AGL=json.dumps(sorted(self.alt)))
+
+
+
+def resultWriter(fmt, out_dir, grid=None, tile_deg=1.0):
+    """
+    Returns the writer for an output format.
+
+
+    Parameters:
+    -----------
+    fmt {string}: 'parquet' (GeoParquet), 'tif' (GeoTIFF, grid runs only) or 'shp' (shapefiles).
+    out_dir {string}: output directory.
+    grid {Grid}: grid of the points, required for 'tif'.
+    tile_deg {float}: size of the GeoParquet partitions in degrees.
+
+
+    """
+
+    if fmt == 'parquet':
+        return GeoParquetWriter(out_dir,tile_deg=tile_deg)
+    elif fmt == 'tif':
+        if grid is None:
+            raise ValueError('a grid is required to write a GeoTIFF')
+        return GeoTIFFWriter(out_dir,grid)
+    elif fmt == 'shp':
+        return ShapefileWriter(out_dir)
+
+    raise ValueError('unknown output format {}, expected parquet, tif or shp'.format(fmt))
+
+
+
+class Results:
+    """
+    Lazy reader of the results written by GeoParquetWriter (RiskClass.parquet) or GeoTIFFWriter (RiskClass.tif).
+    Nothing is read until read() is called, and then only the partitions or the window overlapping bbox.
+
+
+    Parameters:
+    -----------
+    path {string}: path to RiskClass.parquet or RiskClass.tif.
+
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_tif = os.path.splitext(path)[1].lower() in ('.tif','.tiff')
+
+        if not self.is_tif:
+            with open(os.path.join(path,'_dataset.json')) as f:
+                self.meta = json.load(f)
+
+
+    @property
+    def partitions(self):
+        """
+        Returns the partition files and their (minx,miny,maxx,maxy) bounds.
+
+
+        """
+        return {os.path.join(self.path,k): b for k,b in self.meta['partitions'].items()}
+
+
+    def read(self, bbox=None, columns=None, decode=True):
+        """
+        Reads the classified points.
+
+
+        Parameters:
+        -----------
+        bbox {tuple}: (optional) (minx,miny,maxx,maxy) box to read. All points are read if not specified.
+        columns {list}: (optional) columns to read, from alt, Risk_Class, Status, LR_Risk_Class and LR_Status.
+        decode {bool}: if True, the status codes are decoded to their messages and a Type column is added.
+
+
+        Returns:
+        --------
+        df {geo dataframe}: classified points.
+
+
+        """
+
+        if self.is_tif:
+            df = self._readTif(bbox)
+        else:
+            df = self._readParquet(bbox,columns)
+
+        if columns is not None:
+            df = df.loc[:,[c for c in columns if c in df.columns] + ['geometry']]
+
+        if decode:
+            for c in ('Status','LR_Status'):
+                if c in df.columns:
+                    df[c] = decodeStatus(df[c].values)
+            if 'Risk_Class' in df.columns:
+                df['Type'] = np.array(['LR','MR','HR'],dtype=object)[df.Risk_Class.values.astype(int)]
+
+        return df
+
+
+    def result(self, bbox=None):
+        """
+        Reads the classified points as a RiskResult.
+
+
+        """
+
+        df = self.read(bbox=bbox,decode=False)
+        alt = df.alt.values if 'alt' in df.columns else np.nan
+
+        return RiskResult(df.geometry.x.values,df.geometry.y.values,alt,df.Risk_Class.values,df.Status.values,
+                          df.LR_Risk_Class.values,df.LR_Status.values)
+
+
+    def frames(self, bbox=None):
+        """
+        Reads the classified points as the (df, lr_df) geo dataframes returned by RiskClassification.
+
+
+        """
+
+        return self.result(bbox=bbox).toGeoDataFrames()
+
+
+    def _readParquet(self, bbox, columns):
+        files = [f for f,b in self.partitions.items()
+                 if bbox is None or not (b[2] < bbox[0] or b[0] > bbox[2] or b[3] < bbox[1] or b[1] > bbox[3])]
+
+        read_columns = None if columns is None else ['geometry'] + [c for c in columns if c != 'geometry']
+        parts = [geopandas.read_parquet(f,columns=read_columns) for f in sorted(files)]
+        if len(parts) == 0:
+            return geopandas.GeoDataFrame(geometry=geopandas.points_from_xy([],[]))
+
+        df = pd.concat(parts,ignore_index=True)
+        if bbox is not None:
+            x,y = df.geometry.x.values,df.geometry.y.values
+            df = df.loc[(x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])].reset_index(drop=True)
+
+        return geopandas.GeoDataFrame(df,geometry='geometry')
+
+
+    def _readTif(self, bbox):
+        import rasterio
+        from rasterio.windows import from_bounds, Window
+
+        with rasterio.open(self.path) as src:
+            if bbox is None:
+                window = Window(0,0,src.width,src.height)
+            else:
+                window = from_bounds(*bbox,transform=src.transform).round_offsets().round_lengths()
+                window = window.intersection(Window(0,0,src.width,src.height))
+
+            bands = src.read(window=window)
+            transform = src.window_transform(window)
+            alt = json.loads(src.tags().get('ALT_FT_AGL','[]'))
+
+        rows,cols = np.nonzero(bands[0] != NODATA)
+        lon = transform.c + (cols + 0.5)*transform.a
+        lat = transform.f + (rows + 0.5)*transform.e
+
+        df = geopandas.GeoDataFrame({name: bands[k,rows,cols] for k,name in enumerate(TIF_BANDS)},
+                                    geometry=geopandas.points_from_xy(lon,lat))
+        if len(alt) == 1:
+            df.insert(0,'alt',np.float32(alt[0]))
+
+        if bbox is not None:
+            df = df.loc[(lon >= bbox[0]) & (lon <= bbox[2]) & (lat >= bbox[1]) & (lat <= bbox[3])].reset_index(drop=True)
+
+        return df
+
+
+
+def readResults(path, bbox=None, columns=None):
+    """
+    Reads the results written by runState.py/runBatch.py. See Results for reading them lazily.
+
+
+    """
+
+    return Results(path).read(bbox=bbox,columns=columns)
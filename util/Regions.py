@@ -0,0 +1,296 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import time
+import numpy as np
+import geopandas
+from shapely.geometry import Polygon, box
+from shapely.ops import polygonize
+from util.AirspaceRiskClassification import *
+from util.Stream import *
+from util.Result import *
+
+## code columns of a region layer
+REGION_COLUMNS = ['Risk_Class','Status','LR_Risk_Class','LR_Status','Pointwise']
+
+
+def aerodromeBuffers(lonlats_deg, radius_nm=AERODROME_NM, n=256):
+    """
+    Returns the radius_nm geodesic buffer of every aerodrome as a polygon of n vertices. The vertices are
+    on the circle, so the polygon is within radius_nm*(1 - cos(pi/n)) of it (0.7 m for 5 nm and 256 vertices).
+    With radius_nm/cos(pi/n) the edges touch the circle instead and the polygon contains it.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: (M,2) array of aerodrome lon/lats in degrees.
+    radius_nm {float}: radius of the buffers in nautical miles.
+    n {int}: number of vertices per buffer.
+
+
+    Returns:
+    --------
+    buffers {list}: one shapely polygon per aerodrome.
+
+
+    """
+
+    lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+    if len(lonlats_deg) == 0:
+        return []
+
+    return [Polygon(ring) for ring in geodesicCircles(lonlats_deg,radius_nm,n)]
+
+
+
+def regionLines(polygon, data, n=256):
+    """
+    Returns the boundaries of every layer the rules depend on within the bounds of a polygon: the polygon,
+    the block groups, the 5 nm buffers of the aerodromes and the airspace shelves. The class is constant
+    within each face of their overlay, except in the thin band between the polygon inscribed in each 5 nm
+    circle and the polygon circumscribed about it. Every block group boundary is kept, not only the boundary of the
+    dense ones, since a point on a block group boundary is in no block group.
+
+
+    Parameters:
+    -----------
+    polygon {shapely geometry}: area of the layer, i.e. the union of a state.
+    data {class}: class object containing referenced data.
+    n {int}: number of vertices of the aerodrome buffers.
+
+
+    Returns:
+    --------
+    lines {list}: shapely boundaries, clipped to the bounds of polygon.
+
+
+    """
+
+    bounds = polygon.bounds
+    clip = box(*bounds)
+
+    def overlapping(index):
+        b = index.bounds
+        return np.flatnonzero((b[:,2] >= bounds[0]) & (b[:,0] <= bounds[2]) & (b[:,3] >= bounds[1]) & (b[:,1] <= bounds[3]))
+
+    bg_index,airspace_index = polygonIndexes(data)
+
+    ## aerodromes whose 5 nm buffer can reach the polygon
+    ap_index,_ = aerodromeIndex(data)
+    pad = 2*AERODROME_NM/60.0/max(np.cos(np.radians(max(abs(bounds[1]),abs(bounds[3])))),0.1)
+    ap = ap_index.lonlats
+    ap = ap[(ap[:,0] >= bounds[0] - pad) & (ap[:,0] <= bounds[2] + pad) & (ap[:,1] >= bounds[1] - pad) & (ap[:,1] <= bounds[3] + pad)]
+
+    bgs = [bg_index.geometries[k] for k in overlapping(bg_index)]
+    shelves = [airspace_index.geometries[k] for k in overlapping(airspace_index)]
+
+    lines = [polygon.boundary]
+    rings = aerodromeBuffers(ap,n=n) + aerodromeBuffers(ap,AERODROME_NM/np.cos(np.pi/n)*(1 + 1e-6),n=n)
+    for g in bgs + rings + shelves:
+        if not g.is_empty and g.intersects(clip):
+            lines.append(g.boundary.intersection(clip))
+
+    return lines
+
+
+
+def buildRegions(polygon, data, alt_ft_agl=500, n=256):
+    """
+    Builds the exact LR/MR/HR region layer of a polygon at one altitude. The boundaries of the block groups,
+    5 nm aerodrome buffers and airspace shelves are overlaid and every face of the overlay is classified once,
+    at a point inside it, with the Low_Risk_Airspace and Medium_Risk_Airspace rules.
+
+
+    Parameters:
+    -----------
+    polygon {shapely geometry}: area of the layer, i.e. the union of a state.
+    data {class}: class object containing referenced data.
+    alt_ft_agl {float/int}: altitude of the layer in AGL. Default is 500ft AGL.
+    n {int}: number of vertices of the aerodrome buffers.
+
+
+    Returns:
+    --------
+    layer {RegionLayer}: classified faces, and the regions they dissolve into.
+
+
+    Notes:
+    --------
+    Under airspace shelves referenced to MSL the class can change with the terrain. Faces where it does
+    are classified as if the elevation was not available (High Risk, STATUS_NO_ELEV). These faces and the
+    faces within the band around the 5 nm circles have Pointwise set to 1: RegionLayer.classify evaluates
+    the points in them one by one.
+
+
+    """
+
+    start = time.time()
+
+    stageLog("Region Layer")
+    stageLog("------------------------------------------------------------------------------")
+
+    lines = regionLines(polygon,data,n=n)
+    faces = list(polygonize(unary_union(lines)))
+
+    ## keeping the faces within the polygon, its boundary is part of the overlay
+    points = np.array([f.representative_point().coords[0] for f in faces]).reshape(-1,2)
+    inside = contains(polygon,points[:,0],points[:,1])
+    faces = [f for f,keep in zip(faces,inside) if keep]
+    points = points[inside]
+
+    stageLog("> {} boundaries | {} faces | Time: {:.1f}s".format(len(lines),len(faces),time.time() - start))
+
+    ## one classification per face. Faces that need elevation are evaluated as if it were not available.
+    features = extractFeatures(points,data,alt_ft_agl=alt_ft_agl)
+    features.elevation[features.stack.needsElevation()] = NO_ELEVATION
+    risk_class,status,low_risk,lr_status = classifyFeatures(points,data,features)
+    terrain = (status == STATUS_NO_ELEV)
+
+    ## faces between the inscribed and circumscribed polygons of a 5 nm circle
+    ap_index,_ = aerodromeIndex(data)
+    point_idx,_,d = ap_index.within(points,AERODROME_NM/np.cos(np.pi/n)*(1 + 1e-5))
+    point_idx = point_idx[(d >= AERODROME_NM*np.cos(np.pi/n)*(1 - 1e-5)) & (d <= AERODROME_NM/np.cos(np.pi/n)*(1 + 1e-5))]
+    band = np.zeros(len(points),dtype=bool)
+    band[point_idx] = True
+
+    faces = geopandas.GeoDataFrame({'Risk_Class': risk_class.astype(np.int8),'Status': status.astype(np.int8),
+                                    'LR_Risk_Class': low_risk.astype(np.int8),'LR_Status': lr_status.astype(np.int8),
+                                    'Pointwise': (terrain | band).astype(np.int8)},geometry=faces,crs='EPSG:4326')
+
+    faces['alt'] = float(alt_ft_agl)
+    layer = RegionLayer(faces)
+
+    stageLog("> {} regions | {} terrain dependent faces | {} faces around 5 nm circles | Time: {:.1f}s".format(
+        len(layer.regions),int(terrain.sum()),int((band & ~terrain).sum()),time.time() - start))
+    stageLog("------------------------------------------------------------------------------")
+    stageLog(" ")
+
+    return layer
+
+
+
+class RegionLayer:
+    """
+    LR/MR/HR region layer of one altitude (see buildRegions). Points are classified by looking up the face
+    they are in, with the same bounds-filtered, prepared polygon index as the block group and airspace
+    joins (PolygonIndex). Points on the boundary of a face (i.e. on a block group boundary) are in no face,
+    as they are in no block group, and are classified with classifyChunk.
+
+
+    Parameters:
+    -----------
+    faces {geo dataframe}: faces of the overlay with the REGION_COLUMNS codes and the altitude in column 'alt'.
+
+
+    Attributes:
+    -----------
+    regions {geo dataframe}: the faces dissolved by REGION_COLUMNS, with the altitude and Type (LR, MR or HR).
+
+
+    """
+
+    def __init__(self, faces):
+        self.faces = faces.reset_index(drop=True)
+        self.alt = float(self.faces.alt.iloc[0]) if len(self.faces) > 0 else np.nan
+        self.index = PolygonIndex(self.faces.geometry)
+        self.codes = {c: self.faces[c].values.astype(np.int8) for c in REGION_COLUMNS}
+
+        regions = self.faces.loc[:,REGION_COLUMNS + ['geometry']].dissolve(by=REGION_COLUMNS).reset_index()
+        regions['alt'] = self.alt
+        regions['Type'] = np.array(['LR','MR','HR'],dtype=object)[regions.Risk_Class.values.astype(int)]
+        self.regions = regions
+
+
+    def __len__(self):
+        return len(self.faces)
+
+
+    def lookup(self, lonlats_deg):
+        """
+        Returns the face of every point, -1 for points outside of every face (off the layer or on the
+        boundary of a face).
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        face = np.full(len(lonlats_deg),-1,dtype=np.int64)
+
+        point_idx,face_idx = pointsInPolygons(lonlats_deg,self.index)
+        face[point_idx] = face_idx
+
+        return face
+
+
+    def classify(self, lonlats_deg, data):
+        """
+        Classifies points from the region layer. Points outside of every face or in a Pointwise face are
+        classified with classifyChunk instead.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+        data {class}: class object containing referenced data, the one the layer was built from.
+
+
+        Returns:
+        --------
+        result {RiskResult}: classification of every point at the altitude of the layer.
+
+
+        """
+
+        lonlats_deg = np.ascontiguousarray(lonlats_deg,dtype=float).reshape(-1,2)
+        n = len(lonlats_deg)
+
+        face = self.lookup(lonlats_deg)
+        resolved = face >= 0
+        resolved[resolved] = self.codes['Pointwise'][face[resolved]] == 0
+
+        k = face[resolved]
+        result = RiskResult(lonlats_deg[:,0],lonlats_deg[:,1],self.alt,np.zeros(n),np.zeros(n),np.zeros(n),np.zeros(n))
+        result.risk_class[resolved] = self.codes['Risk_Class'][k]
+        result.status[resolved] = self.codes['Status'][k]
+        result.low_risk[resolved] = self.codes['LR_Risk_Class'][k]
+        result.lr_status[resolved] = self.codes['LR_Status'][k]
+
+        todo = np.flatnonzero(~resolved)
+        if len(todo) > 0:
+            r = classifyChunk(lonlats_deg[todo],data,alt_ft_agl=self.alt)
+            result.risk_class[todo] = r.risk_class
+            result.status[todo] = r.status
+            result.low_risk[todo] = r.low_risk
+            result.lr_status[todo] = r.lr_status
+
+        return result
+
+
+    def save(self, path):
+        """
+        Saves the faces as GeoParquet (.parquet) or a shapefile (any other extension).
+
+
+        """
+
+        if path.endswith('.parquet'):
+            self.faces.to_parquet(path)
+        else:
+            self.faces.to_file(path)
+
+
+
+def readRegions(path):
+    """
+    Reads a region layer saved by RegionLayer.save.
+
+
+    """
+
+    if path.endswith('.parquet'):
+        faces = geopandas.read_parquet(path)
+    else:
+        ## shapefile field names are cut to 10 characters
+        faces = geopandas.read_file(path)
+        faces = faces.rename(columns={c[:10]: c for c in REGION_COLUMNS})
+
+    return RegionLayer(faces)
@@ -0,0 +1,172 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import numpy as np
+import pandas as pd
+import geopandas
+
+## Status codes, the reason a point is not in Low Risk (low risk rules) or not in Medium Risk (medium risk rules)
+STATUS_NONE = 0          # Low Risk, no status
+STATUS_ALT = 1           # low risk: altitude at or above 500 ft AGL
+STATUS_UA = 2            # low risk: block group density of an urban area
+STATUS_AERODROME = 3     # low risk: aerodrome closer than 5 nm
+STATUS_NOT_CLASS_G = 4   # low risk: not in class G airspace
+STATUS_MR_UA = 5         # medium risk: at or above 500 ft AGL over an urban area
+STATUS_MR_EFG = 6        # medium risk: aerodrome in class E, F or G closer than 5 nm, at or above 500 ft AGL
+STATUS_MR_BCD = 7        # medium risk: aerodrome in class B, C or D closer than 5 nm
+STATUS_MR_AIRSPACE = 8   # medium risk: at or above 500 ft AGL in class B, C, D or E airspace
+STATUS_NO_ELEV = 9       # medium risk: the elevation was needed but not available
+
+## Lookup table from status code to the status message of the outputs
+STATUS_MESSAGES = [None,
+                   '>= 500 ft AGL',
+                   'UA',
+                   'd_ap < 5nm',
+                   'not in class G airspace',
+                   'alt >= 500ft AGL over UA',
+                   'd_ap < 5, in class [E,F,G] and alt > 500ft AGL',
+                   'd_ap < 5, in class [B,C,D]',
+                   'alt >= 500ft AGL in [B,C,D,E] airspace',
+                   'Elevation API returned -1000000 (no elev.)']
+
+## columns of RiskResult.toFrame
+RESULT_COLUMNS = ['lon','lat','alt','Risk_Class','Status','LR_Risk_Class','LR_Status']
+
+
+def decodeStatus(codes):
+    """
+    Returns the status message of every status code (see STATUS_MESSAGES).
+
+
+    """
+
+    return np.array(STATUS_MESSAGES,dtype=object)[np.asarray(codes,dtype=int)]
+
+
+
+class RiskResult:
+    """
+    Compact, array-backed classification result: float32 lon/lat/alt and int8 classes and status codes,
+    16 bytes per point. Geometries and status messages are only created on demand (toGeoDataFrames).
+
+
+    Parameters:
+    -----------
+    lon {array}: longitude of the points in degrees.
+    lat {array}: latitude of the points in degrees.
+    alt {array}: altitude of the points in ft AGL.
+    risk_class {array}: 0 (Low Risk), 1 (Medium Risk) or 2 (High Risk).
+    status {array}: status code of the risk class (see STATUS_MESSAGES).
+    low_risk {array}: 1 (Low Risk) or 0 (Not Low Risk), from the low risk rules only.
+    lr_status {array}: status code of the low risk rules.
+
+
+    """
+
+    def __init__(self, lon, lat, alt, risk_class, status, low_risk, lr_status):
+        n = len(lon)
+        self.lon = np.asarray(lon,dtype=np.float32)
+        self.lat = np.asarray(lat,dtype=np.float32)
+        self.alt = np.broadcast_to(np.asarray(alt,dtype=np.float32),(n,)).copy()
+        self.risk_class = np.asarray(risk_class,dtype=np.int8)
+        self.status = np.asarray(status,dtype=np.int8)
+        self.low_risk = np.asarray(low_risk,dtype=np.int8)
+        self.lr_status = np.asarray(lr_status,dtype=np.int8)
+
+
+    def __len__(self):
+        return len(self.lon)
+
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.lon,self.lat,self.alt,self.risk_class,self.status,self.low_risk,self.lr_status))
+
+
+    @classmethod
+    def empty(cls):
+        return cls(*([np.array([])]*7))
+
+
+    @classmethod
+    def concat(cls, results):
+        """
+        Concatenates a list of results.
+
+
+        """
+
+        results = list(results)
+        if len(results) == 0:
+            return cls.empty()
+
+        return cls(*[np.concatenate([getattr(r,a) for r in results]) for a in
+                     ('lon','lat','alt','risk_class','status','low_risk','lr_status')])
+
+
+    def take(self, idx):
+        """
+        Returns the result of a subset of the points (boolean mask or index array).
+
+
+        """
+
+        return RiskResult(self.lon[idx],self.lat[idx],self.alt[idx],self.risk_class[idx],
+                          self.status[idx],self.low_risk[idx],self.lr_status[idx])
+
+
+    def toFrame(self):
+        """
+        Returns the result as a flat dataframe (RESULT_COLUMNS) of the compact columns.
+
+
+        """
+
+        return pd.DataFrame({'lon': self.lon,'lat': self.lat,'alt': self.alt,
+                             'Risk_Class': self.risk_class,'Status': self.status,
+                             'LR_Risk_Class': self.low_risk,'LR_Status': self.lr_status})
+
+
+    @classmethod
+    def fromFrame(cls, df):
+        """
+        Builds a result from a flat dataframe with the RESULT_COLUMNS (i.e. from toFrame).
+
+
+        """
+
+        return cls(*[df[c].values for c in RESULT_COLUMNS])
+
+
+    def toGeoDataFrames(self, lon=None, lat=None):
+        """
+        Converts the result into the two geo dataframes returned by RiskClassification.
+
+
+        Parameters:
+        -----------
+        lon {array}: (optional) full precision longitudes to use for the geometries instead of the float32 ones.
+        lat {array}: (optional) full precision latitudes to use for the geometries instead of the float32 ones.
+
+
+        Returns:
+        --------
+        df {geo dataframe}: classified points in High Risk, Medium Risk, and Low Risk.
+        lr_df {geo dataframe}: classified points in only Low Risk/ Not Low Risk.
+
+
+        """
+
+        lon = self.lon.astype(float) if lon is None else lon
+        lat = self.lat.astype(float) if lat is None else lat
+
+        geometry = geopandas.points_from_xy(lon,lat)
+
+        df = geopandas.GeoDataFrame({'Risk_Class': self.risk_class.astype(int),'Status': decodeStatus(self.status),
+                                     'Type': np.array(['LR','MR','HR'],dtype=object)[self.risk_class]},geometry=geometry)
+        df = df.loc[:,['geometry','Risk_Class','Status','Type']]
+
+        lr_df = geopandas.GeoDataFrame({'Risk_Class': self.low_risk.astype(int),'Status': decodeStatus(self.lr_status),
+                                        'Type': np.array(['Not LR','LR'],dtype=object)[self.low_risk]},geometry=geometry)
+        lr_df = lr_df.loc[:,['geometry','Risk_Class','Status','Type']]
+
+        return df,lr_df
@@ -0,0 +1,286 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import time
+import numpy as np
+import pandas as pd
+from util.AirspaceRiskClassification import *
+from util.Result import *
+
+def resampleRoutes(routes, step_nm=0.5, alt_ft_agl=500):
+    """
+    Resamples routes (polylines of waypoints) every step_nm nautical miles. Every segment between two
+    waypoints is cut into the smallest number of equal pieces no longer than step_nm; the samples are
+    placed along the great circle between the waypoints and the altitude is interpolated linearly.
+    Every waypoint is a sample.
+
+
+    Parameters:
+    -----------
+    routes {list}: list of (N,3) arrays of lon, lat (degrees) and alt (ft AGL) waypoints, or of (N,2)
+                   lon/lat arrays flown at alt_ft_agl. Every route needs at least one waypoint.
+    step_nm {float}: maximum distance between consecutive samples in nautical miles.
+    alt_ft_agl {float/int}: altitude of the routes given without one.
+
+
+    Returns:
+    --------
+    lonlats {array}: (M,2) array of lon/lat samples, route by route, in flight order.
+    alt {array}: (M,) altitude of every sample in ft AGL.
+    route {array}: (M,) route number of every sample.
+    segment {array}: (M,) segment number, within its route, of every sample. The last waypoint of a
+                     route belongs to its last segment.
+
+
+    """
+
+    waypoints = []
+    for r in routes:
+        r = np.asarray(r,dtype=float)
+        if r.ndim != 2 or r.shape[1] not in (2,3) or len(r) == 0:
+            raise ValueError('a route is an (N,3) lon/lat/alt or (N,2) lon/lat array of at least one waypoint')
+        if r.shape[1] == 2:
+            r = np.column_stack((r,np.full(len(r),float(alt_ft_agl))))
+        waypoints.append(r)
+
+    n_wp = np.array([len(r) for r in waypoints],dtype=np.int64)
+    wp = np.concatenate(waypoints) if len(waypoints) > 0 else np.empty((0,3))
+    wp_route = np.repeat(np.arange(len(waypoints)),n_wp)
+
+    ## segments are pairs of consecutive waypoints of the same route
+    first = np.r_[True,wp_route[1:] != wp_route[:-1]] if len(wp) > 0 else np.empty(0,dtype=bool)
+    last = np.r_[wp_route[1:] != wp_route[:-1],True] if len(wp) > 0 else np.empty(0,dtype=bool)
+    a = np.flatnonzero(~last)
+    b = a + 1
+
+    length = geodesic_distance(wp[a,1],wp[a,0],wp[b,1],wp[b,0])
+    pieces = np.maximum(np.ceil(length/step_nm),1).astype(np.int64)
+
+    ## samples of every segment at fractions 0, 1/n, ..., (n-1)/n, then the last waypoint of every route
+    seg = np.repeat(np.arange(len(a)),pieces)
+    t = np.arange(len(seg)) - np.repeat(np.cumsum(pieces) - pieces,pieces)
+    t = t/pieces[seg]
+
+    u = lonlat_to_unit(wp[:,0],wp[:,1])
+    ua,ub = u[a[seg]],u[b[seg]]
+    omega = np.arccos(np.clip(np.sum(ua*ub,axis=1),-1,1))
+    sin_omega = np.sin(omega)
+    straight = sin_omega < 1e-12
+    with np.errstate(invalid='ignore',divide='ignore'):
+        wa = np.where(straight,1 - t,np.sin((1 - t)*omega)/sin_omega)
+        wb = np.where(straight,t,np.sin(t*omega)/sin_omega)
+    v = wa[:,None]*ua + wb[:,None]*ub
+
+    seg_lonlats = np.column_stack((np.degrees(np.arctan2(v[:,1],v[:,0])),
+                                   np.degrees(np.arctan2(v[:,2],np.hypot(v[:,0],v[:,1])))))
+    ## exact when both waypoints are at the same altitude
+    seg_alt = wp[a[seg],2] + t*(wp[b[seg],2] - wp[a[seg],2])
+
+    ## the waypoints are kept exactly as given
+    at_wp = t == 0
+    seg_lonlats[at_wp] = wp[a[seg[at_wp]],:2]
+
+    ## segment number within the route
+    seg_number = a - np.flatnonzero(first)[wp_route[a]]
+
+    ends = np.flatnonzero(last)
+    lonlats = np.concatenate((seg_lonlats,wp[ends,:2]))
+    alt = np.concatenate((seg_alt,wp[ends,2]))
+    route = np.concatenate((wp_route[a[seg]],wp_route[ends]))
+    segment = np.concatenate((seg_number[seg],np.maximum(n_wp - 2,0)))
+
+    ## ordering the samples route by route in flight order (the route end after its last segment)
+    order = np.lexsort((np.r_[np.zeros(len(seg)),np.ones(len(ends))],segment,route))
+
+    return lonlats[order],alt[order],route[order],segment[order]
+
+
+
+def sameAsPrevious(point_idx, geom_idx, n):
+    """
+    Returns, for every point, whether it is in exactly the same set of polygons as the point before it.
+
+
+    Parameters:
+    -----------
+    point_idx {array}: point of every (point,polygon) pair, sorted by point then polygon (i.e. from pointsInPolygons).
+    geom_idx {array}: polygon of every pair.
+    n {int}: number of points.
+
+
+    Returns:
+    --------
+    same {array}: (n,) boolean array, False for the first point.
+
+
+    """
+
+    counts = np.bincount(point_idx,minlength=n)
+    starts = np.cumsum(counts) - counts
+
+    same = np.r_[False,counts[1:] == counts[:-1]]
+
+    ## comparing the pairs of points with the same number of polygons row by row
+    candidate = same[point_idx]
+    rows = np.flatnonzero(candidate)
+    p = point_idx[rows]
+    offset = rows - starts[p]
+    differs = geom_idx[rows] != geom_idx[starts[p - 1] + offset]
+    same[p[differs]] = False
+
+    return same
+
+
+
+class RouteResult:
+    """
+    Classification of a set of routes.
+
+
+    Attributes:
+    -----------
+    samples {RiskResult}: classification of every sample of the routes.
+    route {array}: route number of every sample.
+    segment {array}: segment number, within its route, of every sample.
+    segments {dataframe}: one row per segment: route, segment, Risk_Class, Status and Type of the worst
+                          sample of the segment (its two waypoints included), samples and length_nm.
+    routes {dataframe}: one row per route: route, Risk_Class, Status and Type of the worst sample of the
+                        route, the segment it is in, samples and length_nm.
+
+
+    """
+
+    def __init__(self, samples, route, segment, n_routes):
+        self.samples = samples
+        self.route = route
+        self.segment = segment
+
+        n = len(samples)
+        lon,lat = samples.lon.astype(float),samples.lat.astype(float)
+
+        ## the worst sample of a group is the one with the highest risk class, the first one on a tie
+        key = samples.risk_class.astype(np.int64)*(n + 1) + (n - np.arange(n))
+
+        step = np.r_[geodesic_distance(lat[:-1],lon[:-1],lat[1:],lon[1:]),0.0] if n > 1 else np.zeros(n)
+        next_same_route = np.r_[route[1:] == route[:-1],False][:n]
+        step[~next_same_route] = 0.0
+
+        ## segments: own samples, plus the first sample of the next segment (its end waypoint). The last
+        ## waypoint of a route is already a sample of the last segment.
+        starts = np.flatnonzero(np.r_[True,(route[1:] != route[:-1]) | (segment[1:] != segment[:-1])]) if n > 0 else np.empty(0,dtype=np.int64)
+        counts = np.diff(np.r_[starts,n])
+        seg_key = np.maximum.reduceat(key,starts) if n > 0 else np.empty(0,dtype=np.int64)
+        seg_end = np.minimum(starts + counts,n - 1)
+        has_end = (starts + counts < n) & (route[seg_end] == route[starts])
+        seg_key[has_end] = np.maximum(seg_key[has_end],key[seg_end[has_end]])
+        worst = n - seg_key % (n + 1)
+
+        self.segments = pd.DataFrame({'route': route[starts],'segment': segment[starts],
+                                      'Risk_Class': samples.risk_class[worst].astype(int),
+                                      'Status': decodeStatus(samples.status[worst]),
+                                      'Type': np.array(['LR','MR','HR'],dtype=object)[samples.risk_class[worst]],
+                                      'samples': counts + has_end,
+                                      'length_nm': np.add.reduceat(step,starts) if n > 0 else np.zeros(0)})
+
+        ## routes: worst sample over all of their samples
+        route_starts = np.flatnonzero(np.r_[True,route[1:] != route[:-1]]) if n > 0 else np.empty(0,dtype=np.int64)
+        route_key = np.maximum.reduceat(key,route_starts) if n > 0 else np.empty(0,dtype=np.int64)
+        worst = n - route_key % (n + 1)
+
+        routes = pd.DataFrame({'route': route[route_starts],'Risk_Class': samples.risk_class[worst].astype(int),
+                               'Status': decodeStatus(samples.status[worst]),
+                               'Type': np.array(['LR','MR','HR'],dtype=object)[samples.risk_class[worst]],
+                               'segment': segment[worst],
+                               'samples': np.diff(np.r_[route_starts,n]),
+                               'length_nm': np.add.reduceat(step,route_starts) if n > 0 else np.zeros(0)})
+        self.routes = routes.set_index('route').reindex(np.arange(n_routes)).rename_axis('route').reset_index()
+
+
+
+def classifyRoutes(routes, data, step_nm=0.5, alt_ft_agl=500):
+    """
+    Classifies routes flown at per-waypoint AGL altitudes. The routes are resampled every step_nm and
+    all of their samples go through the block group, aerodrome and airspace searches in one batch.
+    The rules are then evaluated once per run of consecutive samples of a route that fall in the same
+    block group density class, the same aerodrome neighborhood (closer than 5 nm, B/C/D or E/F/G
+    aerodromes within 5 nm) and the same airspace shelves at the same altitude, and the result is
+    shared by the whole run. Samples whose shelves have to be converted to AGL are evaluated on their own,
+    since their outcome depends on their own elevation.
+
+
+    Parameters:
+    -----------
+    routes {list}: list of (N,3) arrays of lon, lat (degrees) and alt (ft AGL) waypoints, or of (N,2)
+                   lon/lat arrays flown at alt_ft_agl.
+    data {class}: class object containing referenced data.
+    step_nm {float}: maximum distance between consecutive samples in nautical miles.
+    alt_ft_agl {float/int}: altitude of the routes given without one.
+
+
+    Returns:
+    --------
+    result {RouteResult}: per-sample, per-segment and worst-case classes of the routes.
+
+
+    """
+
+    routes = list(routes)
+    lonlats,alt,route,segment = resampleRoutes(routes,step_nm=step_nm,alt_ft_agl=alt_ft_agl)
+    lonlats = np.ascontiguousarray(lonlats)
+    n = len(lonlats)
+
+    stageLog("Route Classification")
+    stageLog("------------------------------------------------------------------------------")
+    stageLog("> {} routes | {} samples at {} nm".format(len(routes),n,step_nm))
+
+    start = time.time()
+
+    if n == 0:
+        return RouteResult(RiskResult.empty(),route,segment,len(routes))
+
+    bg_index,airspace_index = polygonIndexes(data)
+
+    ## census block group density. A point in overlapping block groups takes the highest density, a point on a block group boundary is in none.
+    point_idx,bg_idx = pointsInPolygons(lonlats,bg_index)
+    density = np.full(n,np.nan)
+    np.fmax.at(density,point_idx,data.bg_df.density.values.astype(float)[bg_idx])
+
+    ## aerodrome neighborhood
+    d_ap,near_bcd,near_efg = aerodromeFeatures(lonlats,data)
+
+    ## airspace shelves
+    point_idx,shelf_idx = pointsInPolygons(lonlats,airspace_index)
+
+    under_airspace = np.bincount(point_idx,minlength=n) > 0
+    lower_sfc = np.zeros(n,dtype=bool)
+    lower_sfc[point_idx[data.airspace.LOWER_CODE.values[shelf_idx] == 'SFC']] = True
+    upper_sfc = np.zeros(n,dtype=bool)
+    upper_sfc[point_idx[data.airspace.UPPER_CODE.values[shelf_idx] == 'SFC']] = True
+    needs_elevation = under_airspace & ~(lower_sfc & upper_sfc)
+
+    ## runs of consecutive samples on which the rules give the same answer
+    ua = density >= 100
+    near = d_ap < AERODROME_NM
+    same = sameAsPrevious(point_idx,shelf_idx,n)
+    for v in (route,ua,near,near_bcd,near_efg,alt):
+        same[1:] &= v[1:] == v[:-1]
+    same &= ~needs_elevation
+
+    reps = np.flatnonzero(~same)
+    run = np.cumsum(~same) - 1
+
+    ## airspace shelves of the representative samples only
+    is_rep = ~same
+    keep = is_rep[point_idx]
+    rep_number = np.cumsum(is_rep) - 1
+    stack = AirspaceStack(airspaceRows(data.airspace,rep_number[point_idx[keep]],shelf_idx[keep],len(reps)))
+
+    features = Features(lonlats[reps],alt[reps],density[reps],d_ap[reps],near_bcd[reps],near_efg[reps],stack)
+    risk_class,status,low_risk,lr_status = classifyFeatures(lonlats[reps],data,features)
+
+    samples = RiskResult(lonlats[:,0],lonlats[:,1],alt,risk_class[run],status[run],low_risk[run],lr_status[run])
+
+    stageLog("> {} samples evaluated for {} samples | Time: {:.2f}s".format(len(reps),n,time.time()-start))
+    stageLog("------------------------------------------------------------------------------")
+    stageLog(" ")
+
+    return RouteResult(samples,route,segment,len(routes))
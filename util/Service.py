@@ -0,0 +1,369 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import json
+import time
+import socket
+import threading
+import socketserver
+import http.client
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from util.Stream import *
+from util.Result import *
+
+
+def warmData(data):
+    """
+    Builds the aerodrome index and the block group/airspace polygon indexes of a data object and
+    prepares all of their geometries and cell covers, so that the first request does not pay for them.
+
+
+    Parameters:
+    -----------
+    data {class}: class object containing referenced data.
+
+
+    Returns:
+    --------
+    data {class}: the same object, with data.ap_index, data.bg_index and data.airspace_index set.
+
+
+    """
+
+    aerodromeIndex(data)
+    bg_index,airspace_index = polygonIndexes(data)
+    bg_index.prepareAll(cover=True)
+    airspace_index.prepareAll(cover=True)
+
+    return data
+
+
+
+class ClassificationService:
+    """
+    Keeps the datasets, their indexes and the elevation cache loaded between classification requests.
+    Requests are run one at a time on a single worker thread, which also owns the elevation cache
+    connection. reload() loads and warms a new copy of the datasets next to the current one and then
+    swaps it in, requests running meanwhile finish on the old copy.
+
+
+    Parameters:
+    -----------
+    load {function}: function without arguments returning the data object, i.e. lambda: loadData(bundle_dir).
+
+
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.data = None
+        self.version = 0
+        self.loaded = None
+        self.requests = 0
+        self.points = 0
+        self.seconds = 0.0
+
+        self.reload()
+
+
+    def reload(self):
+        """
+        Loads the datasets again and swaps them in once they are warm.
+
+
+        Returns:
+        --------
+        seconds {float}: time taken to load and warm the datasets.
+
+
+        """
+
+        start = time.time()
+        with quietOutput():
+            data = warmData(self.load())
+
+        with self.lock:
+            self.data = data
+            self.version += 1
+            self.loaded = time.time()
+
+        return time.time() - start
+
+
+    def classify(self, lonlats_deg, alt_ft_agl=500):
+        """
+        Classifies a batch of points on the warm datasets.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+        alt_ft_agl {int, float, or array}: altitude of the points in ft AGL.
+
+
+        Returns:
+        --------
+        result {RiskResult}: result of the points, in the input order.
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        alt_ft_agl = np.broadcast_to(np.asarray(alt_ft_agl,dtype=float),(len(lonlats_deg),))
+
+        with self.lock:
+            data = self.data
+
+        start = time.time()
+        result = self.executor.submit(self._classify,lonlats_deg,data,alt_ft_agl).result()
+
+        with self.lock:
+            self.requests += 1
+            self.points += len(result)
+            self.seconds += time.time() - start
+
+        return result
+
+
+    def _classify(self, lonlats_deg, data, alt_ft_agl):
+        # the per step prints of the classification are not wanted in a long running service
+        with quietOutput():
+            return classifyChunk(lonlats_deg,data,alt_ft_agl=alt_ft_agl)
+
+
+    def health(self):
+        """
+        Returns the state of the service: data version, load time and request counters.
+
+
+        """
+
+        with self.lock:
+            return {'status': 'ok','version': self.version,'loaded': self.loaded,
+                    'requests': self.requests,'points': self.points,
+                    'ms_per_point': 1000*self.seconds/self.points if self.points > 0 else None,
+                    'status_messages': STATUS_MESSAGES}
+
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the classification service.
+
+        GET  /health    state of the service (ClassificationService.health).
+        POST /classify  {"lonlats": [[lon,lat],...], "alt_ft_agl": 500 or [alt,...]}, returns the
+                        Risk_Class, Status, LR_Risk_Class and LR_Status codes of every point.
+        POST /reload    reloads the datasets without restarting.
+
+
+    """
+
+    service = None
+    verbose = False
+
+    def do_GET(self):
+        if self.path == '/health':
+            return self._reply(200,self.service.health())
+
+        self._reply(404,{'error': 'unknown path {}'.format(self.path)})
+
+
+    def do_POST(self):
+        try:
+            if self.path == '/classify':
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))) or b'{}')
+                result = self.service.classify(request['lonlats'],request.get('alt_ft_agl',500))
+
+                return self._reply(200,{'alt': result.alt.tolist(),
+                                        'Risk_Class': result.risk_class.tolist(),
+                                        'Status': result.status.tolist(),
+                                        'LR_Risk_Class': result.low_risk.tolist(),
+                                        'LR_Status': result.lr_status.tolist()})
+
+            elif self.path == '/reload':
+                seconds = self.service.reload()
+                return self._reply(200,{'version': self.service.version,'seconds': seconds})
+
+            self._reply(404,{'error': 'unknown path {}'.format(self.path)})
+
+        except (KeyError,ValueError,TypeError) as e:
+            self._reply(400,{'error': '{}: {}'.format(type(e).__name__,e)})
+        except Exception as e:
+            self._reply(500,{'error': '{}: {}'.format(type(e).__name__,e)})
+
+
+    def _reply(self, code, body):
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def address_string(self):
+        # Unix socket clients do not have a host/port
+        return self.client_address[0] if isinstance(self.client_address,tuple) and self.client_address else 'unix'
+
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            BaseHTTPRequestHandler.log_message(self,format,*args)
+
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+
+def makeServer(service, host='127.0.0.1', port=8765, socket_path=None, verbose=False):
+    """
+    Returns the HTTP server of a classification service, listening on host:port or on a Unix socket.
+
+
+    Parameters:
+    -----------
+    service {ClassificationService}: service answering the requests.
+    host {string}: address to listen on. Only local addresses are meant to be used.
+    port {int}: port to listen on.
+    socket_path {string}: (optional) path of a Unix socket to listen on instead of host:port.
+    verbose {bool}: if True, every request is logged to stderr.
+
+
+    Returns:
+    --------
+    server {socketserver}: server, run it with server.serve_forever().
+
+
+    """
+
+    handler = type('Handler',(ServiceHandler,),{'service': service,'verbose': verbose})
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path,handler)
+
+    return ThreadingHTTPServer((host,port),handler)
+
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+
+
+    """
+
+    def __init__(self, socket_path, timeout=60):
+        http.client.HTTPConnection.__init__(self,'localhost',timeout=timeout)
+        self.socket_path = socket_path
+
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+
+class ServiceClient:
+    """
+    Python client of the classification service (runService.py).
+
+
+    Parameters:
+    -----------
+    host {string}: address of the service.
+    port {int}: port of the service.
+    socket_path {string}: (optional) Unix socket of the service, used instead of host:port.
+    timeout {float}: timeout of the requests in seconds.
+
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, socket_path=None, timeout=60):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+
+    def _request(self, method, path, body=None):
+        if self.socket_path is not None:
+            conn = UnixHTTPConnection(self.socket_path,timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host,self.port,timeout=self.timeout)
+
+        try:
+            payload = None if body is None else json.dumps(body).encode()
+            conn.request(method,path,body=payload,headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            reply = json.loads(response.read())
+        finally:
+            conn.close()
+
+        if response.status != 200:
+            raise RuntimeError('classification service returned {}: {}'.format(response.status,reply.get('error')))
+
+        return reply
+
+
+    def classify(self, lonlats_deg, alt_ft_agl=500):
+        """
+        Classifies a batch of points.
+
+
+        Parameters:
+        -----------
+        lonlats_deg {array}: (N,2) array of lon/lat points in degrees.
+        alt_ft_agl {int, float, or array}: altitude of the points in ft AGL.
+
+
+        Returns:
+        --------
+        result {RiskResult}: result of the points, in the input order.
+
+
+        """
+
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        alt = np.asarray(alt_ft_agl,dtype=float)
+
+        reply = self._request('POST','/classify',{'lonlats': lonlats_deg.tolist(),'alt_ft_agl': alt.tolist()})
+
+        return RiskResult(lonlats_deg[:,0],lonlats_deg[:,1],reply['alt'],reply['Risk_Class'],reply['Status'],
+                          reply['LR_Risk_Class'],reply['LR_Status'])
+
+
+    def reload(self):
+        """
+        Asks the service to reload its datasets. Returns once the new datasets are in use.
+
+
+        """
+        return self._request('POST','/reload')
+
+
+    def health(self):
+        """
+        Returns the state of the service.
+
+
+        """
+        return self._request('GET','/health')
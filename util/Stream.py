@@ -0,0 +1,257 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import time
+import numpy as np
+import pandas as pd
+from util.AirspaceRiskClassification import *
+from util.Result import *
+
+def gridChunks(spacing, polygon, chunk_size=100000, alt_ft_agl=500):
+    """
+    Yields the lon/lat grid points within a polygon in chunks. The grid is the same as the one from
+    generate_grid_in_polygon, in the same order, but only a block of rows of the grid is built at a time.
+
+
+    Parameters:
+    -----------
+    spacing {float}: distance between the points in degrees.
+    polygon {shapely geometry}: boundary to generate points within.
+    chunk_size {int}: maximum number of points per chunk.
+    alt_ft_agl {float/int}: altitude of the points in AGL. Default is 500ft AGL.
+
+
+    Yields:
+    --------
+    lonlats {array}: (N,2) array of lon/lat points, N <= chunk_size.
+    alt {array}: altitude of every point.
+
+
+    """
+
+    x,y = gridAxes(spacing,polygon.bounds)
+
+    ## masking blocks of about chunk_size grid points at a time
+    block = max(1,chunk_size//max(len(x),1))
+
+    buf,n = [],0
+    for b in range(0,len(y),block):
+        rows,cols = np.nonzero(gridMask(polygon,x,y[b:b + block]))
+        points = np.column_stack((x[cols],y[b + rows]))
+
+        while len(points) > 0:
+            take = min(chunk_size - n,len(points))
+            buf.append(points[:take])
+            n += take
+            points = points[take:]
+
+            if n == chunk_size:
+                lonlats = np.concatenate(buf)
+                yield lonlats,np.full(len(lonlats),float(alt_ft_agl))
+                buf,n = [],0
+
+    if n > 0:
+        lonlats = np.concatenate(buf)
+        yield lonlats,np.full(len(lonlats),float(alt_ft_agl))
+
+
+
+def fileChunks(path, chunk_size=100000, lon='lon', lat='lat', alt='alt', alt_ft_agl=500):
+    """
+    Yields the points of a CSV or Parquet file in chunks, without reading the whole file.
+
+
+    Parameters:
+    -----------
+    path {string}: path to a .csv or .parquet file with one point per row.
+    chunk_size {int}: maximum number of points per chunk.
+    lon {string}: name of the longitude column (degrees).
+    lat {string}: name of the latitude column (degrees).
+    alt {string}: name of the altitude column (ft AGL). If the file does not have it, alt_ft_agl is used.
+    alt_ft_agl {float/int}: altitude used when the file does not have an altitude column.
+
+
+    Yields:
+    --------
+    lonlats {array}: (N,2) array of lon/lat points, N <= chunk_size.
+    alt {array}: altitude of every point.
+
+
+    """
+
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == '.csv':
+        chunks = pd.read_csv(path,chunksize=chunk_size)
+    elif ext in ('.parquet','.pq'):
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size))
+    else:
+        raise ValueError('unsupported point file {}, expected .csv or .parquet'.format(path))
+
+    for df in chunks:
+        lonlats = np.column_stack((df[lon].values,df[lat].values)).astype(float)
+        if alt in df.columns:
+            yield lonlats,df[alt].values.astype(float)
+        else:
+            yield lonlats,np.full(len(lonlats),float(alt_ft_agl))
+
+
+
+def classifyChunk(lonlats_deg, data, alt_ft_agl=500):
+    """
+    Classifies a chunk of points.
+
+
+    Parameters:
+    -----------
+    lonlats_deg {array}: (lon,lat) array of input points.
+    data {class}: class object containing referenced data.
+    alt_ft_agl {int, float, or array}: altitude for lon lat points.
+
+
+    Returns:
+    --------
+    result {RiskResult}: compact result of the chunk.
+
+
+    """
+
+    lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+
+    if len(lonlats_deg) == 0:
+        return RiskResult.empty()
+
+    with Stage('classification',len(lonlats_deg)) as stage:
+        features = extractFeatures(lonlats_deg,data,alt_ft_agl=alt_ft_agl)
+        risk_class,status,low_risk,lr_status = classifyFeatures(lonlats_deg,data,features)
+        stage.points_out = len(lonlats_deg)
+
+    return RiskResult(lonlats_deg[:,0],lonlats_deg[:,1],features.alt,risk_class,status,low_risk,lr_status)
+
+
+
+class ParquetChunkWriter:
+    """
+    Appends classified chunks to a single Parquet file as they are produced. The status codes are
+    kept as int8, the lookup table is stored in the file metadata.
+
+
+    Parameters:
+    -----------
+    path {string}: output .parquet file.
+
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.n = 0
+
+
+    def write(self, result):
+        import json
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(result.toFrame(),preserve_index=False)
+        table = table.replace_schema_metadata({b'status': json.dumps(STATUS_MESSAGES).encode()})
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path,table.schema)
+
+        self.writer.write_table(table)
+        self.n += len(result)
+
+
+    def close(self):
+        if self.writer is None:
+            self.write(RiskResult.empty())
+        self.writer.close()
+
+
+
+class CSVChunkWriter:
+    """
+    Appends classified chunks to a single CSV file as they are produced, with the status messages.
+
+
+    Parameters:
+    -----------
+    path {string}: output .csv file.
+
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.n = 0
+        pd.DataFrame(columns=RESULT_COLUMNS).to_csv(path,index=False)
+
+
+    def write(self, result):
+        df = result.toFrame()
+        df['Status'] = decodeStatus(result.status)
+        df['LR_Status'] = decodeStatus(result.lr_status)
+        df.to_csv(self.path,mode='a',header=False,index=False)
+        self.n += len(result)
+
+
+    def close(self):
+        pass
+
+
+
+def chunkWriter(path):
+    """
+    Returns the chunk writer for an output path, based on its extension (.parquet or .csv).
+
+
+    """
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return CSVChunkWriter(path)
+    elif ext in ('.parquet','.pq'):
+        return ParquetChunkWriter(path)
+
+    raise ValueError('unsupported output file {}, expected .csv or .parquet'.format(path))
+
+
+
+def StreamClassification(chunks, data, writer):
+    """
+    Classifies a stream of point chunks and hands every classified chunk to the writer before the next
+    chunk is read, so that the peak memory is set by the chunk size instead of the number of points.
+
+
+    Parameters:
+    -----------
+    chunks {iterable}: (lonlats, alt) chunks, i.e. from gridChunks or fileChunks.
+    data {class}: class object containing referenced data.
+    writer {object}: object with write(result) and close() methods, i.e. from chunkWriter or resultWriter.
+
+
+    Returns:
+    --------
+    n {int}: number of classified points.
+
+
+    """
+
+    start = time.time()
+    n = 0
+
+    try:
+        for k,(lonlats,alt) in enumerate(chunks):
+            result = classifyChunk(lonlats,data,alt_ft_agl=alt)
+            writer.write(result)
+            n += len(result)
+
+            stageLog("> Chunk {}: {} points | {} points total | Total Time: {}s".format(k + 1,len(result),n,int(time.time()-start)))
+            del result
+    finally:
+        writer.close()
+
+    return n
@@ -0,0 +1,275 @@
+# Copyright 2020, MIT Lincoln Laboratory
+# SPDX-License-Identifier: BSD-2-Clause
+import socket
+import asyncio
+import threading
+import numpy as np
+import pandas as pd
+import geopandas
+from aiohttp import web
+from shapely.geometry import Polygon, MultiPoint, Point, box
+from shapely.ops import voronoi_diagram
+from util.Data import *
+from util.Stream import *
+
+## km per degree of latitude, and square miles per square km
+KM_DEG = 111.32
+SQ_MILES_KM2 = 0.386102
+
+## mean radius of the earth in nautical miles
+EARTH_NM = 3440.065
+
+## US averages: about 220,000 census block groups and 19,600 aerodromes over 9.1 million km2
+BG_KM2 = 41.0
+AP_KM2 = 465.0
+
+
+def syntheticElevation(lon, lat):
+    """
+    Smooth synthetic terrain, between about 200 and 3800 ft, used in place of the USGS elevations.
+
+
+    Parameters:
+    -----------
+    lon {array}: longitudes in degrees.
+    lat {array}: latitudes in degrees.
+
+
+    Returns:
+    --------
+    elevation {array}: elevations in feet.
+
+
+    """
+
+    lon = np.asarray(lon,dtype=float)
+    lat = np.asarray(lat,dtype=float)
+
+    return 2000 + 1200*np.sin(1.7*lon)*np.cos(2.3*lat) + 600*np.sin(5.1*lon + 3.7*lat)
+
+
+
+class SyntheticElevation:
+    """
+    Elevation provider of the synthetic terrain (syntheticElevation), answered in process.
+
+
+    """
+
+    def getElevations(self, lonlats_deg):
+        lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+        return syntheticElevation(lonlats_deg[:,0],lonlats_deg[:,1])
+
+
+
+class ElevationStub:
+    """
+    Local stand-in for the USGS Elevation Point Query Service. Serves the synthetic terrain with aiohttp on
+    a background thread, so that AsyncEPQSElevation can be run against it without network access.
+
+
+    Parameters:
+    -----------
+    host {string}: address to listen on.
+    port {int}: port to listen on, 0 for any free port.
+
+
+    Attributes:
+    -----------
+    url {string}: query url to give to AsyncEPQSElevation.
+    requests {int}: number of elevations served.
+
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.requests = 0
+
+        # bound here so that the port is known before the server starts, with room for the connections of several workers
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self._socket.bind((host,port))
+        self._socket.listen(1024)
+        self.url = 'http://{}:{}/epqs'.format(*self._socket.getsockname()[:2])
+
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._serve,daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+
+        app = web.Application()
+        app.router.add_get('/epqs',self._handle)
+        self._runner = web.AppRunner(app,access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.SockSite(self._runner,self._socket).start())
+
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+
+    async def _handle(self, request):
+        try:
+            elevation = float(syntheticElevation(float(request.query['x']),float(request.query['y'])))
+        except (KeyError,ValueError):
+            return web.Response(status=400)
+
+        self.requests += 1
+        return web.json_response({'USGS_Elevation_Point_Query_Service': {'Elevation_Query': {'Elevation': elevation}}})
+
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+
+def circles(lonlats_deg, radius_nm, n=64):
+    """
+    Returns the circle of radius_nm around every center, on a sphere, as a polygon of n vertices.
+    Computed with numpy only, so that generating the data does not start the numba threads
+    before the benchmark forks.
+
+
+    """
+
+    lonlats_deg = np.asarray(lonlats_deg,dtype=float).reshape(-1,2)
+    if len(lonlats_deg) == 0:
+        return []
+
+    lon,lat = np.radians(lonlats_deg[:,:1]),np.radians(lonlats_deg[:,1:])
+    theta = np.linspace(0,2*np.pi,n,endpoint=False)[None,:]
+    delta = radius_nm/EARTH_NM
+
+    lat2 = np.arcsin(np.sin(lat)*np.cos(delta) + np.cos(lat)*np.sin(delta)*np.cos(theta))
+    lon2 = lon + np.arctan2(np.sin(theta)*np.sin(delta)*np.cos(lat),np.cos(delta) - np.sin(lat)*np.sin(lat2))
+
+    return [Polygon(np.column_stack((x,y))) for x,y in zip(np.degrees(lon2),np.degrees(lat2))]
+
+
+
+def syntheticAirspace(hubs, airports, bounds, rng):
+    """
+    Returns layered airspace shelves in the NASR columns (CLASS, LOWER_VAL, LOWER_CODE, UPPER_VAL, UPPER_CODE).
+    The first hub gets a class B of three tiers, the next two a class C of two tiers, and towered airports a
+    class D with a surface E. Half of the airports get a 700 ft AGL class E transition area, and the
+    whole area is under 1200 ft AGL class E, in 1 degree tiles. Tiers above the surface have MSL floors.
+
+
+    Parameters:
+    -----------
+    hubs {array}: (H,2) lon/lats of the busiest airports, in decreasing order.
+    airports {array}: (M,2) lon/lats of the other airports.
+    bounds {tuple}: (minx,miny,maxx,maxy) of the synthetic area.
+    rng {Generator}: random number generator.
+
+
+    Returns:
+    --------
+    airspace {geo dataframe}: one row per shelf.
+
+
+    """
+
+    rows = []
+    def add(cls, lower, lower_code, upper, upper_code, geometries):
+        rows.extend([(cls,str(lower),lower_code,str(upper),upper_code,g) for g in geometries])
+
+    b,c,d = hubs[:1],hubs[1:3],hubs[3:]
+
+    ## class B: surface area and two rings with MSL floors
+    add('B',0,'SFC',10000,'MSL',circles(b,10))
+    add('B',1500,'MSL',10000,'MSL',[o.difference(i) for o,i in zip(circles(b,20),circles(b,10))])
+    add('B',3000,'MSL',10000,'MSL',[o.difference(i) for o,i in zip(circles(b,30),circles(b,20))])
+
+    ## class C: surface area and one ring with an MSL floor
+    add('C',0,'SFC',4000,'MSL',circles(c,5))
+    add('C',1200,'MSL',4000,'MSL',[o.difference(i) for o,i in zip(circles(c,10),circles(c,5))])
+
+    ## class D at the other hubs and at one airport in six, with a surface E around it
+    towered = np.concatenate((d,airports[rng.random(len(airports)) < 1/6.0]))
+    add('D',0,'SFC',2500,'MSL',circles(towered,4))
+    add('E',0,'SFC',-9998,'MSL',circles(towered,5))
+
+    ## class E transition areas from 700 ft AGL and the 1200 ft AGL floor everywhere
+    add('E',700,'SFC',-9998,'MSL',circles(airports[rng.random(len(airports)) < 0.5],7))
+    minx,miny,maxx,maxy = bounds
+    tiles = [box(x,y,min(x + 1,maxx),min(y + 1,maxy)) for x in np.arange(minx,maxx,1.0) for y in np.arange(miny,maxy,1.0)]
+    add('E',1200,'SFC',-9998,'MSL',tiles)
+
+    columns = ['CLASS','LOWER_VAL','LOWER_CODE','UPPER_VAL','UPPER_CODE']
+    return geopandas.GeoDataFrame(pd.DataFrame([r[:5] for r in rows],columns=columns),geometry=[r[5] for r in rows],crs='EPSG:4326')
+
+
+
+def syntheticData(bounds=(-80.0,35.0,-77.0,37.0), seed=0, bg_km2=BG_KM2, ap_km2=AP_KM2, urban=0.6):
+    """
+    Generates a Data object with the layers of a synthetic state, at the densities of the US datasets:
+    census block groups tessellating the state (Voronoi cells, smaller in cities, with 600 to 3000
+    people each), aerodromes, and layered airspace shelves around them (see syntheticAirspace).
+
+
+    Parameters:
+    -----------
+    bounds {tuple}: (minx,miny,maxx,maxy) of the synthetic state in degrees.
+    seed {int}: seed of the random number generator.
+    bg_km2 {float}: average area of a block group in km2.
+    ap_km2 {float}: area per aerodrome in km2.
+    urban {float}: fraction of the block groups within the cities.
+
+
+    Returns:
+    --------
+    data {Data}: block groups, airspace, aerodromes and the state (iso_3166_2 'XX').
+
+
+    """
+
+    rng = np.random.default_rng(seed)
+    minx,miny,maxx,maxy = bounds
+    frame = box(*bounds)
+
+    area_km2 = (maxx - minx)*(maxy - miny)*KM_DEG**2*np.cos(np.radians((miny + maxy)/2))
+    n_bg = max(int(area_km2/bg_km2),4)
+    n_ap = max(int(area_km2/ap_km2),4)
+    n_city = max(int(area_km2/20000),1)
+
+    ## cities, the busiest first
+    cities = np.column_stack((rng.uniform(minx + 0.2*(maxx - minx),maxx - 0.2*(maxx - minx),n_city),
+                              rng.uniform(miny + 0.2*(maxy - miny),maxy - 0.2*(maxy - miny),n_city)))
+    sizes = np.sort(rng.pareto(1.5,n_city) + 1)[::-1]
+
+    ## block groups: Voronoi cells of seeds clustered around the cities and spread over the state
+    n_urban = int(urban*n_bg)
+    city = rng.choice(n_city,n_urban,p=sizes/sizes.sum())
+    seeds = np.concatenate((cities[city] + rng.normal(0,0.04,(n_urban,2))*np.sqrt(sizes[city])[:,None],
+                            np.column_stack((rng.uniform(minx,maxx,n_bg - n_urban),rng.uniform(miny,maxy,n_bg - n_urban)))))
+    seeds = seeds[(seeds[:,0] > minx) & (seeds[:,0] < maxx) & (seeds[:,1] > miny) & (seeds[:,1] < maxy)]
+
+    cells = [g.intersection(frame) for g in voronoi_diagram(MultiPoint([tuple(p) for p in seeds]),envelope=frame).geoms]
+    bg_df = geopandas.GeoDataFrame(geometry=[g for g in cells if not g.is_empty],crs='EPSG:4326')
+
+    cos_lat = np.cos(np.radians(bg_df.geometry.centroid.y.values))
+    area_sq_miles = bg_df.geometry.area.values*KM_DEG**2*cos_lat*SQ_MILES_KM2
+    bg_df['density'] = rng.uniform(600,3000,len(bg_df))/area_sq_miles
+
+    ## aerodromes, one at each city
+    ap = np.concatenate((cities,np.column_stack((rng.uniform(minx,maxx,n_ap),rng.uniform(miny,maxy,n_ap)))))
+    ap_df = geopandas.GeoDataFrame(geometry=[Point(p) for p in ap],crs='EPSG:4326')
+
+    airspace = syntheticAirspace(cities,ap[n_city:],bounds,rng)
+
+    ## the state: the bounds with a wavy boundary
+    t = np.linspace(0,2*np.pi,720,endpoint=False)
+    wave = 1 - 0.03*(1 + np.sin(7*t))
+    cx,cy = (minx + maxx)/2,(miny + maxy)/2
+    ring = np.column_stack((cx + (maxx - minx)/2*wave*np.clip(1.2*np.cos(t),-1,1),cy + (maxy - miny)/2*wave*np.clip(1.2*np.sin(t),-1,1)))
+    states_df = geopandas.GeoDataFrame({'iso_3166_2': ['XX'],'name': ['Synthetic']},geometry=[Polygon(ring)],crs='EPSG:4326')
+
+    return Data(bg_df,airspace,ap_df,states_df)